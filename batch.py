@@ -0,0 +1,214 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import asyncio
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+# before the services import: they read their settings from the environment at import
+load_dotenv()
+# quiet by default so progress lines stay readable; LOG_LEVEL in the shell or .env wins
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from services import llm_composer
+from services.midi_exporter import save_midi_file
+from services.llm_transport import get_transport
+
+MANIFEST_NAME = "manifest.jsonl"
+RATE_WINDOW = 50
+SAFE_ID = re.compile(r"[^A-Za-z0-9_.-]+")
+
+def read_prompts(path):
+    """Read prompts from plain text (one per line) or JSONL ({"prompt", "id"?, "seed"?, "mode"?})."""
+    items = []
+    seen = set()
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            text = line.strip()
+            if not text or text.startswith("#"):
+                continue
+            if text.startswith("{"):
+                try:
+                    record = json.loads(text)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"{path}:{line_no}: invalid JSON ({e})")
+            else:
+                record = {"prompt": text}
+            if not str(record.get("prompt", "")).strip():
+                raise ValueError(f"{path}:{line_no}: missing prompt")
+
+            item_id = SAFE_ID.sub("_", str(record.get("id") or f"item-{len(items):06d}"))
+            if item_id in seen:
+                raise ValueError(f"{path}:{line_no}: duplicate id {item_id!r}")
+            seen.add(item_id)
+            items.append(dict(record, id=item_id, prompt=str(record["prompt"]).strip()))
+    return items
+
+def read_manifest(path):
+    # last entry per id wins, so a retried item's success replaces its earlier failure
+    entries = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line cut short by a crash
+                entries[entry.get("id")] = entry
+    return entries
+
+def is_complete(item, entry, out_dir):
+    return (
+        entry is not None
+        and entry.get("status") == "done"
+        and entry.get("prompt") == item["prompt"]
+        and all(os.path.exists(os.path.join(out_dir, entry[key])) for key in ("midi", "json"))
+    )
+
+def item_seed(item, base_seed):
+    if item.get("seed") is not None:
+        return int(item["seed"])
+    if base_seed is None:
+        return llm_composer.new_seed()
+    return zlib.crc32(f"{base_seed}:{item['id']}".encode())
+
+def render_item(song, seed, output_format, json_path, midi_path):
+    """Process-pool worker: render notes and write both outputs, each via a temp file."""
+    music = llm_composer.render_music(song, seed, output_format)
+    with open(json_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(music, f)
+    os.replace(json_path + ".tmp", json_path)
+    save_midi_file(music, midi_path + ".tmp")
+    os.replace(midi_path + ".tmp", midi_path)
+    return {"bars": song.get("total_bars"), "sections": len(song["sections"]), "bytes": os.path.getsize(midi_path)}
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+class Progress:
+    def __init__(self, total, skipped):
+        self.total = total
+        self.skipped = skipped
+        self.done = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+        # recent completions only, so worker start-up doesn't skew the ETA for the whole run
+        self.recent = deque([self.started], maxlen=RATE_WINDOW)
+
+    def update(self, item_id, status, detail=""):
+        if status == "done":
+            self.done += 1
+        else:
+            self.failed += 1
+        finished = self.done + self.failed
+        self.recent.append(time.perf_counter())
+        window = self.recent[-1] - self.recent[0]
+        rate = (len(self.recent) - 1) / window if window else 0.0
+        eta = format_eta((self.total - finished) / rate) if rate else "?"
+        width = len(str(self.total))
+        print(f"[{finished:>{width}}/{self.total}] {status:<6} {item_id}  {rate:.2f} songs/s  ETA {eta}"
+              f"{f'  failed {self.failed}' if self.failed else ''}{f'  ({detail})' if detail else ''}", flush=True)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        rate = (self.done + self.failed) / elapsed if elapsed else 0.0
+        return (f"done {self.done}, failed {self.failed}, skipped {self.skipped} (already complete) "
+                f"in {elapsed:.1f}s, {rate:.2f} songs/s")
+
+async def run_batch(items, args, manifest_path, progress):
+    loop = asyncio.get_running_loop()
+    # spawned workers only render; they never touch the event loop or the LLM client
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"))
+    llm_slots = asyncio.Semaphore(args.jobs)
+    pending = iter(items)
+
+    async def process(item, manifest):
+        seed = item_seed(item, args.seed)
+        entry = {"id": item["id"], "prompt": item["prompt"], "seed": seed}
+        started = time.perf_counter()
+        try:
+            async with llm_slots:
+                song = await llm_composer.compose_song(
+                    item["prompt"], args.concurrency, use_cache=not args.fresh, mode=item.get("mode") or args.mode
+                )
+            midi_name, json_name = f"{item['id']}.mid", f"{item['id']}.json"
+            stats = await loop.run_in_executor(
+                pool, render_item, song, seed, args.format,
+                os.path.join(args.out, json_name), os.path.join(args.out, midi_name)
+            )
+            entry.update(status="done", midi=midi_name, json=json_name, seconds=round(time.perf_counter() - started, 3), **stats)
+        except Exception as e:
+            entry.update(status="failed", error=f"{type(e).__name__}: {e}", seconds=round(time.perf_counter() - started, 3))
+
+        manifest.write(json.dumps(entry) + "\n")
+        manifest.flush()
+        progress.update(item["id"], entry["status"], entry.get("error", ""))
+
+    async def worker(manifest):
+        # enough workers to keep every LLM slot and every render process busy, no more in memory
+        for item in pending:
+            await process(item, manifest)
+
+    try:
+        with open(manifest_path, "a", encoding="utf-8") as manifest:
+            await asyncio.gather(*(worker(manifest) for _ in range(args.jobs + args.workers)))
+    finally:
+        pool.shutdown(cancel_futures=True)
+        # close the connection pool while this loop can still do it
+        await get_transport().aclose()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate MIDI + JSON for every prompt in a file (resumable)")
+    parser.add_argument("prompts", help="text file with one prompt per line, or JSONL with a prompt (and optional id, seed, mode) per line")
+    parser.add_argument("--out", default="batch_output", help="output directory, also holds the manifest (default: batch_output)")
+    parser.add_argument("--jobs", type=int, default=8, help="songs composing (LLM-bound) at once")
+    parser.add_argument("--concurrency", type=int, default=llm_composer.LLM_CONCURRENCY, help="parallel section calls per song")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="render/export processes")
+    parser.add_argument("--mode", choices=llm_composer.COMPOSE_MODES, default=llm_composer.COMPOSE_MODE)
+    parser.add_argument("--format", choices=("standard", "compact"), default="standard", help="JSON output format")
+    parser.add_argument("--seed", type=int, help="base seed: per-item seeds are derived from it and the item id")
+    parser.add_argument("--fresh", action="store_true", help="bypass the LLM response cache")
+    parser.add_argument("--limit", type=int, help="process at most this many pending items")
+    args = parser.parse_args(argv)
+    if min(args.jobs, args.concurrency, args.workers) < 1:
+        parser.error("--jobs, --concurrency and --workers must be at least 1")
+
+    try:
+        items = read_prompts(args.prompts)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    os.makedirs(args.out, exist_ok=True)
+    manifest_path = os.path.join(args.out, MANIFEST_NAME)
+    manifest = read_manifest(manifest_path)
+    todo = [item for item in items if not is_complete(item, manifest.get(item["id"]), args.out)]
+    skipped = len(items) - len(todo)
+    if args.limit is not None:
+        todo = todo[:args.limit]
+
+    print(f"{len(items)} prompts, {skipped} already complete, {len(todo)} to generate "
+          f"(up to {args.jobs} songs x {args.concurrency} LLM calls, {args.workers} render processes)")
+    progress = Progress(len(todo), skipped)
+    if todo:
+        try:
+            asyncio.run(run_batch(todo, args, manifest_path, progress))
+        except KeyboardInterrupt:
+            print("interrupted; rerun the same command to resume", file=sys.stderr)
+            return 130
+    print(progress.summary())
+    return 1 if progress.failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import sys
+import time
+import random
+import argparse
+
+from mido import MidiFile
+from services.midi_exporter import schedule_events, render_midi_bytes
+
+TRACKS = [
+    {"id": "t_piano", "instrument": "Electric Piano", "type": "instrument"},
+    {"id": "t_bass", "instrument": "Finger Bass", "type": "instrument"},
+    {"id": "t_kick", "instrument": "Kick", "type": "percussion"},
+    {"id": "t_snare", "instrument": "Snare", "type": "percussion"},
+    {"id": "t_hat", "instrument": "HiHat", "type": "percussion"},
+]
+
+def make_arrangement(total_notes, notes_per_clip=64, seed=0):
+    rng = random.Random(seed)
+    data = {"bpm": 120, "tracks": TRACKS, "clips": {}, "arrangement": []}
+    clip_count = max(1, total_notes // notes_per_clip)
+    for i in range(clip_count):
+        track = TRACKS[i % len(TRACKS)]
+        clip_id = f"c{i}"
+        data["clips"][clip_id] = [
+            {"note": rng.randint(36, 84), "start": rng.randint(0, 63) * 0.25, "duration": 0.25 * rng.randint(1, 4),
+             "velocity": rng.randint(50, 120), "track_id": track["id"]}
+            for _ in range(notes_per_clip)
+        ]
+        data["arrangement"].append({"section": "S", "start_bar": (i // len(TRACKS)) * 16, "track_id": track["id"], "clip_id": clip_id})
+    return data
+
+def legacy_schedule(data, track_ids, ticks_per_beat):
+    all_events = []
+    for item in data.get("arrangement", []):
+        if item["track_id"] not in track_ids: continue
+        notes = data["clips"].get(item["clip_id"], [])
+        section_start_beat = item["start_bar"] * 4.0
+        for note in notes:
+            abs_start = int((section_start_beat + float(note["start"])) * ticks_per_beat)
+            abs_dur = int(float(note["duration"]) * ticks_per_beat)
+            vel = int(note.get("velocity", 90))
+            note_val = max(0, min(127, int(note["note"])))
+            all_events.append({"time": abs_start, "type": "note_on", "note": note_val, "vel": vel, "track": item["track_id"]})
+            all_events.append({"time": abs_start + abs_dur, "type": "note_off", "note": note_val, "vel": 0, "track": item["track_id"]})
+    return {tr: sorted([e for e in all_events if e["track"] == tr], key=lambda x: x["time"]) for tr in track_ids}
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - started
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MIDI export scheduling benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--skip-legacy-above", type=int, default=100_000)
+    parser.add_argument("--full-render-up-to", type=int, default=100_000)
+    args = parser.parse_args(argv)
+
+    track_ids = [t["id"] for t in TRACKS]
+    ticks_per_beat = MidiFile().ticks_per_beat
+    print(f"{'notes':>10} {'legacy sched':>14} {'bucketed sched':>16} {'speedup':>8} {'render_midi_bytes':>18}")
+    for size in args.sizes:
+        data = make_arrangement(size)
+        new = timed(schedule_events, data, track_ids, ticks_per_beat)
+        old = timed(legacy_schedule, data, track_ids, ticks_per_beat) if size <= args.skip_legacy_above else None
+        full = timed(render_midi_bytes, data) if size <= args.full_render_up_to else None
+        print(f"{size:>10,} {(f'{old * 1000:.1f} ms' if old else '-'):>14} {new * 1000:>13.1f} ms "
+              f"{(f'{old / new:.1f}x' if old else '-'):>8} {(f'{full * 1000:.1f} ms' if full else '-'):>18}")
+
+if __name__ == "__main__":
+    sys.exit(main())
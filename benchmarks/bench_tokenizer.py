@@ -0,0 +1,63 @@
+import re
+import sys
+import time
+import random
+import argparse
+
+from services.music_engine import DURATIONS, compile_stream, stream_notes, parse_duration_stream
+
+STREAMS = [
+    ["x4n", ".4n", "x8n", "x8n", ".4n"],
+    [".4n", "x4n", ".4n", "X4n"],
+    ["x8n"] * 8,
+    ["x16n"] * 16,
+    ["1_4n", ".8n", "5_8n", "3_4n", "1_4n"],
+    ["1_8t"] * 12,
+    [".8n", "x8n", ".4n", "x8t", "x8t", "x8t", ".4n"],
+    [".16n", "g16n", "x8n", "X4n", ".2n"],
+]
+
+def legacy_parse_duration_stream(stream):
+    notes = []
+    current_time_beats = 0.0
+    for item in stream:
+        match = re.match(r'^([A-Za-z0-9_\-\.]+?)(1n|2n|4n|8n|16n|32n|4t|8t|16t)$', str(item).strip())
+        if not match:
+            current_time_beats += 0.25
+            continue
+        event_char = match.group(1)
+        duration_beats = DURATIONS[match.group(2)]
+        if event_char not in ['.', 'rest']:
+            velocity = 100
+            if event_char == 'X': velocity = 127
+            elif event_char == 'g': velocity = 50
+            notes.append({"start_time": current_time_beats, "duration": duration_beats, "event": event_char, "velocity": velocity})
+        current_time_beats += duration_beats
+    return notes
+
+def run(label, fn, streams, repeat):
+    tokens = sum(len(s) for s in streams) * repeat
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for stream in streams:
+            fn(stream)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {tokens / elapsed:>14,.0f} tokens/s  ({elapsed * 1000:.1f} ms)")
+    return tokens / elapsed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Duration stream tokenizer microbenchmark")
+    parser.add_argument("--repeat", type=int, default=3000)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(0)
+    streams = [list(rng.choice(STREAMS)) for _ in range(64)]
+
+    base = run("legacy re.match per token", legacy_parse_duration_stream, streams, args.repeat)
+    fast = run("parse_duration_stream", parse_duration_stream, streams, args.repeat)
+    compiled = [compile_stream(s) for s in streams]
+    reuse = run("stream_notes (precompiled)", stream_notes, compiled, args.repeat)
+    print(f"speedup: {fast / base:.1f}x (dict API), {reuse / base:.1f}x (precompiled)")
+
+if __name__ == "__main__":
+    sys.exit(main())
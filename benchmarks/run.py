@@ -0,0 +1,317 @@
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+import contextlib
+
+os.environ.setdefault("LLM_CACHE", "0")
+os.environ.setdefault("PATTERN_LIBRARY", "off")
+os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+
+from dotenv import load_dotenv
+
+# after the defaults above (which .env can't override), before the services read their settings
+load_dotenv()
+
+from benchmarks.stub_llm import install_stub, FIXTURES_PATH
+from benchmarks.bench_midi_export import make_arrangement
+from services import llm_composer
+from services.music_engine import (
+    parse_duration_stream, parse_drum_grid, parse_harmonic_grid, parse_chord_comping, compile_stream
+)
+from services.midi_exporter import save_midi_file
+from services.session_store import SessionStore
+from services.audio_renderer import PreviewRender, stem_cache
+from services.llm_transport import get_transport
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def summarize(latencies, wall, items, unit):
+    return {
+        "iterations": len(latencies),
+        "throughput": items / wall if wall else 0.0,
+        "unit": f"{unit}/s",
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "wall_s": wall,
+    }
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        with quiet():
+            fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_sync(fn, iterations, items_per_call, unit):
+    latencies = []
+    with quiet():
+        started = time.perf_counter()
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - t0)
+        wall = time.perf_counter() - started
+    result = summarize(latencies, wall, items_per_call * iterations, unit)
+    result["peak_mem_kb"] = peak_memory(fn) / 1024
+    return result
+
+def bench_async(make_coro, iterations, concurrency, items_per_call, unit):
+    async def drive():
+        limiter = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def one():
+            async with limiter:
+                t0 = time.perf_counter()
+                await make_coro()
+                latencies.append(time.perf_counter() - t0)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(iterations)))
+        return latencies, time.perf_counter() - started
+
+    with quiet():
+        latencies, wall = asyncio.run(drive())
+    result = summarize(latencies, wall, items_per_call * iterations, unit)
+    result["concurrency"] = concurrency
+    result["peak_mem_kb"] = peak_memory(lambda: asyncio.run(make_coro())) / 1024
+    return result
+
+def load_fixtures():
+    with open(FIXTURES_PATH) as f:
+        return json.load(f)
+
+def suite_parsers(args):
+    pattern = load_fixtures()["pattern"][0]
+    streams = [v for k, v in pattern.items() if isinstance(v, list)]
+    tokens = sum(len(s) for s in streams)
+    n = args.iterations * 20
+    return {
+        "parse_duration_stream": bench_sync(lambda: [parse_duration_stream(s) for s in streams], n, tokens, "tokens"),
+        "parse_drum_grid": bench_sync(lambda: [parse_drum_grid(s, "t_kick", 36, "swing") for s in streams], n, len(streams), "bars"),
+        "parse_harmonic_grid": bench_sync(lambda: [parse_harmonic_grid(s, "Am7", "bass", "t_bass", "swing") for s in streams], n, len(streams), "bars"),
+        "parse_chord_comping": bench_sync(lambda: [parse_chord_comping(s, "Fmaj7", "t_piano", "swing") for s in streams], n, len(streams), "bars"),
+        "compile_stream": bench_sync(lambda: [compile_stream(s) for s in streams], n, tokens, "tokens"),
+    }
+
+def suite_section(args):
+    section = load_fixtures()["structure"][0]["sections"][0]
+    make = lambda: llm_composer.generate_section_clips(section, "lofi hip hop", 84, llm_composer.TRACK_IDS, use_cache=False)
+    return {"generate_section_clips": bench_async(make, args.iterations, 1, 1, "sections")}
+
+def suite_song(args):
+    make = lambda: llm_composer.generate_music_json("lofi hip hop", use_cache=False)
+    return {
+        "generate_music_json": bench_async(make, args.iterations, 1, 1, "songs"),
+        "generate_music_json_concurrent": bench_async(make, args.iterations, args.concurrency, 1, "songs"),
+    }
+
+def suite_modes(args):
+    # per-section (1 + N calls) vs single-call composition: LLM calls and tokens per song, then wall time
+    stub = get_transport().client
+    results = {}
+    for mode in llm_composer.COMPOSE_MODES:
+        make = lambda: llm_composer.generate_music_json("lofi hip hop", use_cache=False, mode=mode)
+        before = stub.stats()
+        with quiet():
+            asyncio.run(make())
+        usage = {key: value - before[key] for key, value in stub.stats().items()}
+        result = bench_async(make, args.iterations, 1, 1, "songs")
+        result.update(llm_calls=usage["calls"], prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"])
+        results[f"compose_{mode}"] = result
+    return results
+
+def suite_variations(args, count=4):
+    # N options from one structure call and n-choice section calls vs pressing Generate N times
+    stub = get_transport().client
+
+    async def generate_each():
+        return await asyncio.gather(*(llm_composer.generate_music_json("lofi hip hop", use_cache=False) for _ in range(count)))
+
+    runs = {
+        f"generate_x{count}": generate_each,
+        f"variations_{count}": lambda: llm_composer.generate_variations("lofi hip hop", count, use_cache=False),
+    }
+    results = {}
+    for name, make in runs.items():
+        before = stub.stats()
+        with quiet():
+            asyncio.run(make())
+        usage = {key: value - before[key] for key, value in stub.stats().items()}
+        result = bench_async(make, args.iterations, 1, count, "songs")
+        result.update(llm_calls=usage["calls"], prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"])
+        results[name] = result
+    return results
+
+def suite_export(args):
+    with quiet():
+        song = asyncio.run(llm_composer.generate_music_json("lofi hip hop", use_cache=False))
+    notes = sum(len(c) for c in song["clips"].values())
+    large = make_arrangement(args.export_notes)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.mid")
+        results["save_midi_file"] = bench_sync(lambda: save_midi_file(song, path), args.iterations, notes, "notes")
+        results[f"save_midi_file_{args.export_notes}"] = bench_sync(lambda: save_midi_file(large, path), max(1, args.iterations // 10), args.export_notes, "notes")
+
+    # edit-export cycle on a session: one velocity change, then only that track is re-encoded
+    store = SessionStore(ttl=float("inf"))
+    session = store.create(large)
+    with quiet():
+        store.export(session.id)
+    clip_id = next(iter(session.clips))
+    note_id = next(iter(session.clips[clip_id]))
+    velocities = iter(range(1 << 30))
+
+    def edit_and_export():
+        store.patch(session.id, [{"op": "update", "clip": clip_id, "id": note_id, "changes": {"velocity": 40 + next(velocities) % 80}}])
+        return store.export(session.id)
+
+    results[f"session_edit_export_{args.export_notes}"] = bench_sync(edit_and_export, max(1, args.iterations // 10), args.export_notes, "notes")
+    return results
+
+def suite_audio(args):
+    # throughput is audio seconds rendered per wall second, i.e. the real-time factor on one core
+    with quiet():
+        song = asyncio.run(llm_composer.generate_music_json("lofi hip hop", use_cache=False))
+    seconds = PreviewRender(song).seconds
+
+    def render(cold):
+        if cold:
+            stem_cache.clear()
+        for _ in PreviewRender(song):
+            pass
+
+    return {
+        "preview_wav_cold": bench_sync(lambda: render(True), args.iterations, seconds, "audio s"),
+        "preview_wav_cached_stems": bench_sync(lambda: render(False), args.iterations, seconds, "audio s"),
+    }
+
+def suite_http(args):
+    import httpx
+    import main
+
+    with quiet():
+        song = asyncio.run(llm_composer.generate_music_json("lofi hip hop", use_cache=False))
+
+    async def request(path, payload):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            resp = await client.post(path, json=payload)
+            resp.raise_for_status()
+            return resp.content
+
+    total = args.iterations * args.concurrency
+    return {
+        "http_generate": bench_async(lambda: request("/api/generate", {"prompt": "lofi hip hop", "fresh": True}), total, args.concurrency, 1, "requests"),
+        "http_export": bench_async(lambda: request("/api/export", song), total, args.concurrency, 1, "requests"),
+    }
+
+SUITES = {
+    "parsers": suite_parsers,
+    "section": suite_section,
+    "song": suite_song,
+    "modes": suite_modes,
+    "variations": suite_variations,
+    "export": suite_export,
+    "audio": suite_audio,
+    "http": suite_http,
+}
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def latest_result():
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    files = sorted(f for f in os.listdir(RESULTS_DIR) if f.endswith(".json"))
+    return os.path.join(RESULTS_DIR, files[-1]) if files else None
+
+def compare(current, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)["results"]
+    print(f"\ncompared with {previous_path}")
+    for name, res in current.items():
+        old = previous.get(name)
+        if not old:
+            continue
+        tput = (res["throughput"] / old["throughput"] - 1) * 100 if old["throughput"] else 0.0
+        p50 = (res["p50_ms"] / old["p50_ms"] - 1) * 100 if old["p50_ms"] else 0.0
+        print(f"  {name:<34} throughput {tput:+7.1f}%   p50 {p50:+7.1f}%")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BeatFlow offline benchmark suite (stub LLM, no provider calls)")
+    parser.add_argument("suites", nargs="*", help=f"subset of: {', '.join(SUITES)} (default: all)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0, help="stub LLM latency per call in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="extra stub latency per completion token in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra uniform stub latency in seconds")
+    parser.add_argument("--export-notes", type=int, default=100_000)
+    parser.add_argument("--compare", nargs="?", const="latest", help="previous result file (default: latest)")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.suites if name not in SUITES]
+    if unknown:
+        parser.error(f"unknown suite(s): {', '.join(unknown)}")
+
+    previous = latest_result() if args.compare == "latest" else args.compare
+    stub = install_stub(args.latency, args.jitter, token_latency=args.token_latency)
+
+    results = {}
+    for name in args.suites or list(SUITES):
+        print(f"[{name}]")
+        for bench, res in SUITES[name](args).items():
+            results[bench] = res
+            print(f"  {bench:<34} {res['throughput']:>12,.1f} {res['unit']:<12} p50 {res['p50_ms']:>9.2f} ms  "
+                  f"p99 {res['p99_ms']:>9.2f} ms  peak {res['peak_mem_kb']:>9,.0f} KiB")
+            if "llm_calls" in res:
+                print(f"  {'':<34} {res['llm_calls']} LLM calls, {res['prompt_tokens']:,} prompt + "
+                      f"{res['completion_tokens']:,} completion tokens per run")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "args": {k: v for k, v in vars(args).items() if k != "compare"},
+        "stub": stub.stats(),
+        "results": results,
+    }
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nsaved {path}")
+    if previous:
+        compare(results, previous)
+
+if __name__ == "__main__":
+    sys.exit(main())
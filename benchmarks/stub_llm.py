@@ -0,0 +1,91 @@
+import os
+import json
+import asyncio
+import random
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "recorded_responses.json")
+
+class StubUsage:
+    def __init__(self, prompt_tokens, completion_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.total_tokens = prompt_tokens + completion_tokens
+
+class StubMessage:
+    def __init__(self, content):
+        self.content = content
+
+class StubChoice:
+    def __init__(self, content):
+        self.message = StubMessage(content)
+
+class StubCompletion:
+    def __init__(self, contents, usage):
+        self.choices = [StubChoice(c) for c in contents]
+        self.usage = usage
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+class StubCompletions:
+    def __init__(self, llm):
+        self.llm = llm
+
+    async def create(self, model=None, messages=None, n=1, **kwargs):
+        return await self.llm.complete(messages or [], n)
+
+class StubLLM:
+    # AsyncOpenAI-shaped client serving recorded responses with configurable latency
+    def __init__(self, latency=0.0, jitter=0.0, fixtures_path=FIXTURES_PATH, seed=0, token_latency=0.0):
+        with open(fixtures_path) as f:
+            self.fixtures = json.load(f)
+        self.latency = latency
+        self.jitter = jitter
+        self.token_latency = token_latency
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.chat = type("StubChat", (), {})()
+        self.chat.completions = StubCompletions(self)
+
+    def pick(self, prompt, choice=0):
+        if "whole song" in prompt:
+            # single-call mode: the recorded structure with a recorded pattern set per section
+            structure = self.fixtures["structure"][self.calls % len(self.fixtures["structure"])]
+            patterns = self.fixtures["pattern"]
+            sections = [dict(sec, patterns=patterns[i % len(patterns)]) for i, sec in enumerate(structure["sections"])]
+            return dict(structure, sections=sections)
+        if "Music Director" in prompt and "Rhythm Composer" not in prompt:
+            kind = "structure"
+        else:
+            kind = "pattern"
+        # with n > 1 each choice is a different recording, like independent samples
+        return self.fixtures[kind][(self.calls + choice) % len(self.fixtures[kind])]
+
+    async def complete(self, messages, n=1):
+        self.calls += 1
+        prompt = "\n".join(m.get("content", "") for m in messages)
+        contents = [json.dumps(self.pick(prompt, i)) for i in range(max(1, n))]
+        usage = StubUsage(estimate_tokens(prompt), sum(estimate_tokens(c) for c in contents))
+
+        # decoding time grows with the answer, which matters when comparing one long call with many short ones;
+        # n choices are sampled side by side, so only the longest counts
+        delay = self.latency + self.token_latency * max(estimate_tokens(c) for c in contents)
+        delay += self.rng.uniform(0, self.jitter) if self.jitter else 0.0
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        self.prompt_tokens += usage.prompt_tokens
+        self.completion_tokens += usage.completion_tokens
+        return StubCompletion(contents, usage)
+
+    def stats(self):
+        return {"calls": self.calls, "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens}
+
+def install_stub(latency=0.0, jitter=0.0, **kwargs):
+    from services.llm_transport import get_transport
+
+    stub = StubLLM(latency, jitter, **kwargs)
+    get_transport().client = stub
+    return stub
@@ -18,8 +18,16 @@ export async function POST(request: NextRequest) {
       )
     }
 
-    const data = await res.json()
-    return NextResponse.json(data)
+    const headers = new Headers({
+      "Content-Type": res.headers.get("Content-Type") ?? "audio/midi",
+      "Content-Disposition":
+        res.headers.get("Content-Disposition") ?? 'attachment; filename="generated-music.mid"',
+    })
+    // streamed (chunked) exports have no length; an empty header would be invalid
+    const length = res.headers.get("Content-Length")
+    if (length) headers.set("Content-Length", length)
+
+    return new NextResponse(res.body, { headers })
   } catch {
     return NextResponse.json(
       { error: "Failed to connect to backend" },
@@ -1,11 +1,55 @@
 "use client"
 
 import { create } from "zustand"
-import { NoteEvent, MusicData, Track, DEFAULT_TRACKS, flattenMusicData, notesToMusicData } from "@/lib/music-types"
+import { NoteEvent, MusicData, CompactMusicData, Track, GenerateStreamEvent, DEFAULT_TRACKS, expandCompactMusicData, flattenMusicData, notesToMusicData, diffNotes } from "@/lib/music-types"
 import { startPlayback, PlaybackController, preloadSounds, updatePlayhead, globalCurrentBeat } from "@/lib/audio-engine"
 
 const MAX_HISTORY = 50
 
+// the backend's copy of what was last exported, so later exports only send edits
+interface ExportSession {
+  id: string
+  version: number
+  bpm: number
+  notes: Map<string, NoteEvent>
+}
+
+function syncedSession(id: string, version: number, bpm: number, notes: NoteEvent[]): ExportSession {
+  return { id, version, bpm, notes: new Map(notes.map((n) => [n.id, n])) }
+}
+
+async function syncSession(session: ExportSession | null, notes: NoteEvent[], bpm: number, tracks: Track[]): Promise<ExportSession> {
+  if (session) {
+    const ops = diffNotes(session.notes, notes)
+    if (bpm !== session.bpm) ops.push({ op: "bpm", value: bpm })
+    if (ops.length === 0) return session
+
+    const res = await fetch(`/backend/sessions/${session.id}`, {
+      method: "PATCH",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ ops, version: session.version }),
+    })
+    if (res.ok) {
+      const { version } = await res.json()
+      return syncedSession(session.id, version, bpm, notes)
+    }
+    // expired (404) or out of step (409): start over with a full upload
+  }
+
+  const res = await fetch("/backend/sessions", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(notesToMusicData(notes, bpm, tracks)),
+  })
+  if (!res.ok) throw new Error("Export failed")
+  const { session_id, version } = await res.json()
+  return syncedSession(session_id, version, bpm, notes)
+}
+
+function dropSession(session: ExportSession | null) {
+  if (session) fetch(`/backend/sessions/${session.id}`, { method: "DELETE" }).catch(() => {})
+}
+
 interface MusicState {
   notes: NoteEvent[]
   selectedNoteIds: Set<string>
@@ -21,6 +65,7 @@ interface MusicState {
   history: NoteEvent[][]
   historyIndex: number
   playbackController: PlaybackController | null
+  exportSession: ExportSession | null
 
   initAudio: () => Promise<void>
   pushHistory: (newNotes: NoteEvent[]) => void
@@ -35,7 +80,7 @@ interface MusicState {
   seek: (beat: number) => void
   rewind: () => void
   generate: (prompt: string) => Promise<void>
-  applyJson: (data: MusicData) => void
+  applyJson: (data: MusicData | CompactMusicData) => void
   toggleHidden: (id: string) => void
   toggleMute: (id: string) => void
   exportMidi: () => Promise<void>
@@ -63,6 +108,7 @@ export const useMusicStore = create<MusicState>((set, get) => ({
   history: [[]],
   historyIndex: 0,
   playbackController: null,
+  exportSession: null,
 
   initAudio: async () => {
     await preloadSounds()
@@ -160,17 +206,57 @@ export const useMusicStore = create<MusicState>((set, get) => ({
   generate: async (prompt) => {
     set({ isGenerating: true })
     try {
-      const res = await fetch("http://127.0.0.1:8000/api/generate", {
+      const res = await fetch("http://127.0.0.1:8000/api/generate/stream", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ prompt }),
+        body: JSON.stringify({ prompt, swap_late: true }),
       })
-      const data: MusicData = await res.json()
-      if (data.bpm) set({ bpm: data.bpm })
-      if (data.tracks?.length) {
-        set({ tracks: data.tracks, activeTrackId: data.tracks[0].id })
+      if (!res.ok || !res.body) throw new Error("Generation failed")
+
+      const reader = res.body.getReader()
+      const decoder = new TextDecoder()
+      let buffer = ""
+      let notes: NoteEvent[] = []
+      // per-section notes, so a late LLM section can replace its procedural stand-in
+      const sectionNotes = new Map<number, NoteEvent[]>()
+
+      const handleEvent = (event: GenerateStreamEvent) => {
+        if (event.type === "structure") {
+          if (event.bpm) set({ bpm: event.bpm })
+          if (event.tracks?.length) {
+            set({ tracks: event.tracks, activeTrackId: event.tracks[0].id })
+          }
+          notes = []
+          sectionNotes.clear()
+          dropSession(get().exportSession)
+          set({ notes, exportSession: null })
+        } else if (event.type === "section") {
+          sectionNotes.set(event.index, flattenMusicData({
+            bpm: get().bpm,
+            tracks: get().tracks,
+            clips: event.clips,
+            arrangement: event.arrangement,
+          }))
+          notes = Array.from(sectionNotes.values()).flat()
+          set({ notes })
+        } else if (event.type === "error") {
+          throw new Error(event.error)
+        }
+      }
+
+      while (true) {
+        const { done, value } = await reader.read()
+        if (done) break
+        buffer += decoder.decode(value, { stream: true })
+        const lines = buffer.split("\n")
+        buffer = lines.pop() ?? ""
+        for (const line of lines) {
+          if (line.trim()) handleEvent(JSON.parse(line))
+        }
       }
-      get().setNotes(flattenMusicData(data))
+      if (buffer.trim()) handleEvent(JSON.parse(buffer))
+
+      get().pushHistory(notes)
     } catch (err) {
       console.error(err)
     } finally {
@@ -178,7 +264,10 @@ export const useMusicStore = create<MusicState>((set, get) => ({
     }
   },
 
-  applyJson: (data) => {
+  applyJson: (raw) => {
+    const data = expandCompactMusicData(raw)
+    dropSession(get().exportSession)
+    set({ exportSession: null })
     if (data.bpm) set({ bpm: data.bpm })
     if (data.tracks) set({ tracks: data.tracks })
     get().setNotes(flattenMusicData(data))
@@ -200,13 +289,10 @@ export const useMusicStore = create<MusicState>((set, get) => ({
 
   exportMidi: async () => {
     const state = get()
-    const currentMusicData = notesToMusicData(state.notes, state.bpm, state.tracks)
     try {
-      const res = await fetch("/backend/export", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify(currentMusicData),
-      })
+      const session = await syncSession(state.exportSession, state.notes, state.bpm, state.tracks)
+      set({ exportSession: session })
+      const res = await fetch(`/backend/sessions/${session.id}/export`)
       if (!res.ok) throw new Error("Export failed")
       const blob = await res.blob()
       const url = window.URL.createObjectURL(blob)
@@ -28,8 +28,61 @@ export interface MusicData {
   tracks: Track[]
   clips: Record<string, NoteEvent[]>
   arrangement: ArrangementItem[]
+  prompt?: string
+  seed?: number
+  sections?: SectionPlan[]
 }
 
+export type CompactNote = [number, number, number, number]
+
+export interface CompactPattern {
+  track_id: string
+  notes: CompactNote[]
+  humanize: { jitter: number; velocity: [number, number] | null } | null
+}
+
+// [pattern_id, bar, seed] plus, for spiced drum bars, the notes that differ from the pattern
+export type CompactInstance = [string, number, number] | [string, number, number, CompactNote[]]
+
+export interface CompactArrangementItem extends ArrangementItem {
+  instances: CompactInstance[]
+}
+
+export interface CompactMusicData {
+  format: "compact"
+  bpm: number
+  tracks: Track[]
+  patterns: Record<string, CompactPattern>
+  arrangement: CompactArrangementItem[]
+}
+
+export interface SectionPlan {
+  name: string
+  length: number
+  energy?: string
+  texture?: string
+  chords: string[]
+  start_bar: number
+  groove?: string
+  patterns?: Record<string, unknown>
+}
+
+export type GenerateStreamEvent =
+  | { type: "structure"; bpm: number; tracks: Track[]; sections: SectionPlan[]; total_bars: number; seed: number }
+  | {
+      type: "section"
+      index: number
+      section: string
+      start_bar: number
+      groove: string
+      patterns: Record<string, unknown>
+      replaces?: boolean
+      clips: Record<string, NoteEvent[]>
+      arrangement: ArrangementItem[]
+    }
+  | { type: "done" }
+  | { type: "error"; error: string }
+
 export interface PianoRollState {
   notes: NoteEvent[]
   selectedNoteIds: Set<string>
@@ -69,6 +122,78 @@ export function generateId(): string {
   return Math.random().toString(36).substring(2, 10)
 }
 
+// Must stay in sync with services/compact_format.py so previews match exports
+function mulberry32(seed: number): () => number {
+  let state = seed >>> 0
+  return () => {
+    state = (state + 0x6d2b79f5) >>> 0
+    let t = Math.imul(state ^ (state >>> 15), state | 1)
+    t = ((t + Math.imul(t ^ (t >>> 7), t | 61)) ^ t) >>> 0
+    return ((t ^ (t >>> 14)) >>> 0) / 4294967296
+  }
+}
+
+// variant notes replace the pattern note with the same pitch and start, or are added, in time order
+function instanceNotes(pattern: CompactPattern, variant?: CompactNote[]): CompactNote[] {
+  if (!variant || variant.length === 0) return pattern.notes
+  const changed = new Map(variant.map((n) => [`${n[0]}:${n[1]}`, n] as const))
+  const notes = pattern.notes.map((n) => {
+    const key = `${n[0]}:${n[1]}`
+    const replacement = changed.get(key)
+    changed.delete(key)
+    return replacement ?? n
+  })
+  return [...notes, ...changed.values()].sort((a, b) => a[1] - b[1])
+}
+
+export function isCompactMusicData(data: MusicData | CompactMusicData): data is CompactMusicData {
+  return (data as CompactMusicData).format === "compact"
+}
+
+export function expandCompactMusicData(data: MusicData | CompactMusicData): MusicData {
+  if (!isCompactMusicData(data)) return data
+
+  const clips: Record<string, NoteEvent[]> = {}
+  const arrangement: ArrangementItem[] = []
+  for (const item of data.arrangement) {
+    const events: NoteEvent[] = []
+    for (const [patternId, bar, seed, variant] of item.instances) {
+      const pattern = data.patterns[patternId]
+      if (!pattern) continue
+      const rand = mulberry32(seed)
+      const jitter = pattern.humanize?.jitter ?? 0
+      const velocityRange = pattern.humanize?.velocity
+      const draws = new Map<number, [number, number]>()
+      for (const [note, start, duration, velocity] of instanceNotes(pattern, variant)) {
+        let draw = draws.get(start)
+        if (!draw) {
+          const shift = (rand() * 2 - 1) * jitter
+          let vel = velocity
+          if (velocityRange) {
+            const [lo, hi] = velocityRange
+            vel = lo + Math.floor(rand() * (hi - lo + 1))
+          }
+          draw = [Math.max(0, start + shift), vel]
+          draws.set(start, draw)
+        }
+        events.push({
+          id: generateId(),
+          note,
+          start: draw[0] + bar * 4,
+          duration,
+          velocity: draw[1],
+          track_id: pattern.track_id,
+        })
+      }
+    }
+    clips[item.clip_id] = events
+    const { instances: _instances, ...rest } = item
+    arrangement.push(rest)
+  }
+
+  return { bpm: data.bpm, tracks: data.tracks, clips, arrangement }
+}
+
 export function flattenMusicData(data: MusicData): NoteEvent[] {
   const notes: NoteEvent[] = []
   for (const item of data.arrangement) {
@@ -107,13 +232,13 @@ export function notesToMusicData(
         track_id: n.track_id,
       }))
     if (trackNotes.length > 0) {
-      clipMap[`clip_${track.id}`] = trackNotes
+      clipMap[sessionClipId(track.id)] = trackNotes
     }
   }
 
   const arrangement: ArrangementItem[] = []
   for (const track of tracks) {
-    const clipId = `clip_${track.id}`
+    const clipId = sessionClipId(track.id)
     if (clipMap[clipId]) {
       arrangement.push({
         section: "Full",
@@ -127,6 +252,51 @@ export function notesToMusicData(
   return { bpm, tracks, clips: clipMap, arrangement }
 }
 
+// Edits sent to a backend session (services/session_store.py); notes live in one clip per track
+export type SessionOp =
+  | { op: "add"; clip: string; note: NoteEvent }
+  | { op: "update"; clip: string; id: string; changes: Partial<NoteEvent> }
+  | { op: "remove"; clip: string; id: string }
+  | { op: "clip"; clip: string; track_id: string; start_bar: number; notes: NoteEvent[] }
+  | { op: "bpm"; value: number }
+
+const NOTE_FIELDS = ["note", "start", "duration", "velocity"] as const
+
+export function sessionClipId(trackId: string): string {
+  return `clip_${trackId}`
+}
+
+export function diffNotes(synced: Map<string, NoteEvent>, notes: NoteEvent[]): SessionOp[] {
+  const ops: SessionOp[] = []
+  const clips = new Set(Array.from(synced.values(), (n) => sessionClipId(n.track_id)))
+  const seen = new Set<string>()
+
+  for (const note of notes) {
+    seen.add(note.id)
+    const prev = synced.get(note.id)
+    const clip = sessionClipId(note.track_id)
+    if (prev && prev.track_id === note.track_id) {
+      const changes: Partial<NoteEvent> = {}
+      for (const key of NOTE_FIELDS) {
+        if (prev[key] !== note[key]) changes[key] = note[key]
+      }
+      if (Object.keys(changes).length > 0) ops.push({ op: "update", clip, id: note.id, changes })
+      continue
+    }
+    if (prev) ops.push({ op: "remove", clip: sessionClipId(prev.track_id), id: note.id })
+    if (!clips.has(clip)) {
+      ops.push({ op: "clip", clip, track_id: note.track_id, start_bar: 0, notes: [] })
+      clips.add(clip)
+    }
+    ops.push({ op: "add", clip, note })
+  }
+
+  for (const [id, prev] of synced) {
+    if (!seen.has(id)) ops.push({ op: "remove", clip: sessionClipId(prev.track_id), id })
+  }
+  return ops
+}
+
 export const DEFAULT_TRACKS: Track[] = [
   { id: "t_piano", instrument: "Piano", type: "instrument" },
   { id: "t_bass", instrument: "Finger Bass", type: "instrument" },
@@ -1,15 +1,39 @@
-import uuid
 import os
-from fastapi import FastAPI, BackgroundTasks, Request
+import json
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from typing import Literal, List, Optional, Union
 from pydantic import BaseModel
 import uvicorn
-from services.llm_composer import generate_music_json
-from services.midi_exporter import save_midi_file
+from dotenv import load_dotenv
 
-app = FastAPI()
+# the services read their settings at import, so .env has to be loaded before any of them
+load_dotenv()
+
+from services.llm_composer import generate_music_json, generate_variations, stream_music_json, regenerate_section, replay_music, needs_replay, llm_flight, song_flight
+from services.midi_exporter import render_midi_bytes, iter_chunks
+from services.llm_cache import llm_cache
+from services.job_queue import job_manager, QueueFullError
+from services.pattern_validator import validation_stats
+from services.pattern_library import pattern_library
+from services.session_store import session_store, SessionConflict
+from services.audio_renderer import PreviewRender, stem_cache
+from services.llm_transport import get_transport
+from services.telemetry import logger, registry, request_id_var, new_request_id, HTTP_SECONDS
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # job workers and the LLM connection pool belong to this loop, so both stop before the loop goes away
+    await job_manager.stop()
+    await get_transport().aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",
@@ -24,6 +48,27 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    token = request_id_var.set(request_id)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_SECONDS.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=status
+        )
+        request_id_var.reset(token)
+
 if not os.path.exists("static"):
     os.makedirs("static")
 
@@ -34,38 +79,245 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 class MusicRequest(BaseModel):
     prompt: str
+    fresh: bool = False
+    format: Literal["standard", "compact"] = "standard"
+    seed: Optional[int] = None
+    swap_late: bool = False
+    mode: Optional[Literal["sections", "single"]] = None
+    session: bool = False
+
+class VariationsRequest(BaseModel):
+    prompt: str
+    count: int = 4
+    fresh: bool = False
+    format: Literal["standard", "compact"] = "standard"
+    seed: Optional[int] = None
+
+class RenderRequest(BaseModel):
+    music: dict
+    seed: Optional[int] = None
+    format: Literal["standard", "compact"] = "standard"
+
+class PatchRequest(BaseModel):
+    ops: List[dict]
+    version: Optional[int] = None
+
+class RegenerateRequest(BaseModel):
+    music: dict
+    section: Union[int, str]
+    instruments: Optional[List[str]] = None
+    prompt: Optional[str] = None
 
 @app.post("/api/generate")
 async def generate(request: MusicRequest):
     try:
-        print(f"Generating music for prompt: {request.prompt}")
-        data = generate_music_json(request.prompt)
+        logger.info(f"Generating music for prompt: {request.prompt}")
+        data = await generate_music_json(request.prompt, use_cache=not request.fresh, output_format=request.format, seed=request.seed, mode=request.mode)
+        if request.session:
+            data = dict(data, session_id=session_store.create(data).id)
         return data
     except Exception as e:
-        print(f"Error generating music: {e}")
+        logger.error(f"Error generating music: {e}")
         return {"error": str(e)}
 
+@app.post("/api/variations")
+async def variations(request: VariationsRequest):
+    try:
+        logger.info(f"Generating {request.count} variations for prompt: {request.prompt}")
+        songs = await generate_variations(request.prompt, request.count, use_cache=not request.fresh, output_format=request.format, seed=request.seed)
+        return {"count": len(songs), "variations": songs}
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        logger.error(f"Error generating variations: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.post("/api/generate/stream")
+async def generate_stream(request: MusicRequest):
+    logger.info(f"Streaming music for prompt: {request.prompt}")
+    
+    async def ndjson():
+        try:
+            async for event in stream_music_json(request.prompt, use_cache=not request.fresh, seed=request.seed, swap_late=request.swap_late, mode=request.mode):
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            logger.error(f"Error generating music: {e}")
+            yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+    
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+@app.post("/api/render")
+async def render(request: RenderRequest):
+    try:
+        return await run_in_threadpool(replay_music, request.music, request.seed, request.format)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        logger.error(f"Error rendering music: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.post("/api/regenerate")
+async def regenerate(request: RegenerateRequest):
+    try:
+        logger.info(f"Regenerating section {request.section} ({request.instruments or 'all instruments'})")
+        return await regenerate_section(request.music, request.section, request.instruments, request.prompt)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        logger.error(f"Error regenerating section: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
 @app.post("/api/export")
-async def export_midi(request: Request, background_tasks: BackgroundTasks):
+async def export_midi(request: Request):
     try:
         music_data = await request.json()
+        if needs_replay(music_data):
+            music_data = await run_in_threadpool(replay_music, music_data)
         
-        file_id = str(uuid.uuid4())
-        filename = f"static/{file_id}.mid"
-        
-        print(f"Exporting MIDI to {filename}...")
-        save_midi_file(music_data, filename)
-        background_tasks.add_task(os.remove, filename)
-        
-        return FileResponse(
-            path=filename,
-            media_type="audio/midi",
-            filename="generated-music.mid"
-        )
+        logger.info("Exporting MIDI...")
+        payload = await run_in_threadpool(render_midi_bytes, music_data)
+        return midi_response(payload)
+    except Exception as e:
+        logger.error(f"Error exporting MIDI: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+def midi_response(payload):
+    return StreamingResponse(
+        iter_chunks(payload),
+        media_type="audio/midi",
+        headers={
+            "Content-Length": str(len(payload)),
+            "Content-Disposition": 'attachment; filename="generated-music.mid"'
+        }
+    )
+
+@app.post("/api/preview")
+async def preview_audio(request: Request, mute: str = ""):
+    try:
+        music_data = await request.json()
+        if needs_replay(music_data):
+            music_data = await run_in_threadpool(replay_music, music_data)
+        render = await run_in_threadpool(PreviewRender, music_data, muted=[t for t in mute.split(",") if t])
     except Exception as e:
-        print(f"Error exporting MIDI: {e}")
-        from fastapi.responses import JSONResponse
+        logger.error(f"Error rendering preview: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
+    return wav_response(render)
+
+def wav_response(render):
+    # blocks are synthesized as the client reads them; the header already knows the final length
+    return StreamingResponse(
+        iter(render),
+        media_type="audio/wav",
+        headers={
+            "Content-Length": str(render.size),
+            "Content-Disposition": 'inline; filename="preview.wav"'
+        }
+    )
+
+@app.post("/api/sessions", status_code=201)
+async def create_session(request: Request):
+    try:
+        music_data = await request.json()
+        if needs_replay(music_data):
+            music_data = await run_in_threadpool(replay_music, music_data)
+        session = await run_in_threadpool(session_store.create, music_data)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        logger.error(f"Error creating session: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    logger.info(f"Created session {session.id}")
+    return session.summary()
+
+@app.get("/api/sessions/{session_id}")
+async def get_session(session_id: str):
+    session = session_store.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired session"})
+    return session.music()
+
+@app.patch("/api/sessions/{session_id}")
+async def patch_session(session_id: str, request: PatchRequest):
+    try:
+        summary = session_store.patch(session_id, request.ops, request.version)
+    except SessionConflict as e:
+        return JSONResponse(status_code=409, content={"error": str(e)})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    if summary is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired session"})
+    return summary
+
+@app.get("/api/sessions/{session_id}/export")
+async def export_session(session_id: str):
+    try:
+        payload = await run_in_threadpool(session_store.export, session_id)
+    except Exception as e:
+        logger.error(f"Error exporting session {session_id}: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    if payload is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired session"})
+    return midi_response(payload)
+
+@app.get("/api/sessions/{session_id}/preview")
+async def preview_session(session_id: str, mute: str = ""):
+    session = session_store.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired session"})
+    try:
+        render = await run_in_threadpool(PreviewRender, session.music(), muted=[t for t in mute.split(",") if t])
+    except Exception as e:
+        logger.error(f"Error rendering preview of session {session_id}: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    return wav_response(render)
+
+@app.delete("/api/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if session_store.delete(session_id) is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired session"})
+    return {"session_id": session_id, "deleted": True}
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(request: MusicRequest):
+    try:
+        job = job_manager.submit(request.prompt, use_cache=not request.fresh, output_format=request.format, seed=request.seed, mode=request.mode)
+    except QueueFullError as e:
+        return JSONResponse(status_code=429, content={"error": str(e)}, headers={"Retry-After": "5"})
+    logger.info(f"Queued job {job.id} for prompt: {request.prompt}")
+    return {"job_id": job.id, "status": job.status}
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired job"})
+    return job.summary()
+
+@app.get("/api/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired job"})
+    if job.status == "done":
+        return job.result
+    if job.status in ("failed", "cancelled"):
+        return JSONResponse(status_code=409, content={"error": job.error or f"Job {job.status}", "status": job.status})
+    return JSONResponse(status_code=202, content=job.summary())
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired job"})
+    return job.summary()
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return dict(llm_cache.stats(), coalesced_llm=llm_flight.stats(), coalesced_songs=song_flight.stats(), validation=dict(validation_stats), library=pattern_library.stats(), sessions=session_store.stats(), transport=get_transport().stats(), audio_stems=stem_cache.stats())
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 async def read_root():
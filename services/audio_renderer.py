@@ -0,0 +1,287 @@
+import os
+import math
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from services.compact_format import expand_compact
+from services.telemetry import span
+
+AUDIO_SAMPLE_RATE = int(os.getenv("AUDIO_SAMPLE_RATE", "44100"))
+AUDIO_BLOCK_FRAMES = int(os.getenv("AUDIO_BLOCK_FRAMES", "16384"))
+AUDIO_STEM_CACHE_MB = float(os.getenv("AUDIO_STEM_CACHE_MB", "64"))
+
+MASTER_GAIN = 0.5
+BASE_FREQ = 440.0
+# note lengths are rounded to this many frames so humanized durations share templates
+LENGTH_STEP = 256
+
+def midi_freq(note):
+    return BASE_FREQ * 2.0 ** ((note - 69) / 12.0)
+
+def envelope(frames, sample_rate, attack, decay, sustain_frames, release):
+    # attack ramp, exponential decay while held, then a linear release to silence
+    t = np.arange(frames, dtype=np.float32) / sample_rate
+    env = np.exp(-t * decay) * np.minimum(1.0, t / attack)
+    tail = frames - sustain_frames
+    if tail > 0:
+        env[sustain_frames:] *= np.linspace(1.0, 0.0, tail, dtype=np.float32)
+    return env, t
+
+# --- voices: each returns one note as float32, velocity 127, before the track gain
+
+def keys_voice(note, held, sample_rate):
+    release = int(0.12 * sample_rate)
+    frames = held + release
+    env, t = envelope(frames, sample_rate, 0.004, 2.2, held, release)
+    freq = midi_freq(note)
+    # two-operator FM: a bright attack that mellows as the modulation index decays
+    index = 1.8 * np.exp(-t * 5.0)
+    wave = np.sin(2 * np.pi * freq * t + index * np.sin(2 * np.pi * 2 * freq * t))
+    return (wave * env * 0.35).astype(np.float32)
+
+def bass_voice(note, held, sample_rate):
+    release = int(0.06 * sample_rate)
+    frames = held + release
+    env, t = envelope(frames, sample_rate, 0.005, 1.2, held, release)
+    freq = midi_freq(note)
+    # sine sub with a touch of second harmonic and saturation so it survives small speakers
+    wave = np.tanh(1.6 * (np.sin(2 * np.pi * freq * t) + 0.3 * np.sin(4 * np.pi * freq * t)))
+    return (wave * env * 0.5).astype(np.float32)
+
+def kick_voice(sample_rate):
+    t = np.arange(int(0.35 * sample_rate), dtype=np.float32) / sample_rate
+    # pitch sweeps from ~150 Hz down to 45 Hz; phase is the integral of the sweep
+    phase = 2 * np.pi * (45.0 * t + 105.0 / 30.0 * (1.0 - np.exp(-30.0 * t)))
+    return (np.sin(phase) * np.exp(-t * 9.0) * 0.9).astype(np.float32)
+
+def snare_voice(sample_rate):
+    t = np.arange(int(0.25 * sample_rate), dtype=np.float32) / sample_rate
+    noise = np.random.default_rng(38).uniform(-1.0, 1.0, len(t)).astype(np.float32)
+    body = np.sin(2 * np.pi * 185.0 * t) * np.exp(-t * 28.0)
+    return ((noise * np.exp(-t * 20.0) * 0.55 + body * 0.45) * 0.7).astype(np.float32)
+
+def hat_voice(sample_rate, length=0.07):
+    frames = int(length * sample_rate)
+    noise = np.random.default_rng(42).uniform(-1.0, 1.0, frames + 1).astype(np.float32)
+    t = np.arange(frames, dtype=np.float32) / sample_rate
+    # first difference of white noise: a cheap high-pass that leaves mostly sizzle
+    return (np.diff(noise) * np.exp(-t * (3.0 / length)) * 0.25).astype(np.float32)
+
+def tom_voice(note, sample_rate):
+    t = np.arange(int(0.3 * sample_rate), dtype=np.float32) / sample_rate
+    return (np.sin(2 * np.pi * midi_freq(note) * t) * np.exp(-t * 12.0) * 0.6).astype(np.float32)
+
+def drum_kind(note):
+    if note <= 36:
+        return "kick"
+    if note <= 40:
+        return "snare"
+    if note in (42, 44):
+        return "hat"
+    if note == 46:
+        return "open_hat"
+    return "tom"
+
+def track_voice(track):
+    if track.get("type") == "percussion":
+        return "drums"
+    return "bass" if "bass" in str(track.get("instrument", "")).lower() else "keys"
+
+class VoiceBank:
+    """Note templates per (voice, pitch, length), rendered once and reused for every hit."""
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.templates = {}
+
+    def note(self, voice, pitch, held):
+        key = (voice, pitch, held) if voice != "drums" else (voice, drum_kind(pitch), pitch if drum_kind(pitch) == "tom" else 0)
+        wave = self.templates.get(key)
+        if wave is None:
+            sr = self.sample_rate
+            if voice == "keys":
+                wave = keys_voice(pitch, held, sr)
+            elif voice == "bass":
+                wave = bass_voice(pitch, held, sr)
+            else:
+                kind = key[1]
+                wave = {
+                    "kick": lambda: kick_voice(sr),
+                    "snare": lambda: snare_voice(sr),
+                    "hat": lambda: hat_voice(sr),
+                    "open_hat": lambda: hat_voice(sr, 0.3),
+                    "tom": lambda: tom_voice(pitch, sr),
+                }[kind]()
+            self.templates[key] = wave
+        return wave
+
+def note_table(notes):
+    # (note, start, duration, velocity) as one array: cheap to hash and to walk
+    if not notes:
+        return np.zeros((0, 4), dtype=np.float64)
+    return np.array([
+        (float(n["note"]), float(n["start"]), float(n["duration"]), float(n.get("velocity", 90)))
+        for n in notes
+    ], dtype=np.float64)
+
+class StemCache:
+    def __init__(self, max_bytes=int(AUDIO_STEM_CACHE_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.stems = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        with self.lock:
+            stem = self.stems.get(key)
+            if stem is None:
+                self.counters["misses"] += 1
+                return None
+            self.stems.move_to_end(key)
+            self.counters["hits"] += 1
+            return stem
+
+    def put(self, key, stem):
+        with self.lock:
+            if key in self.stems or stem.nbytes > self.max_bytes:
+                return
+            self.stems[key] = stem
+            self.size += stem.nbytes
+            while self.size > self.max_bytes:
+                _, old = self.stems.popitem(last=False)
+                self.size -= old.nbytes
+                self.counters["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.stems.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, stems=len(self.stems), megabytes=round(self.size / 1024 / 1024, 2))
+
+stem_cache = StemCache()
+
+class Placement:
+    def __init__(self, start, table, voice, frames_per_beat):
+        self.start = start
+        self.table = table
+        self.voice = voice
+        # identical notes on the same voice and tempo sound the same, wherever and whenever they are placed
+        self.key = (voice, round(frames_per_beat, 6), hashlib.sha1(table.tobytes()).hexdigest())
+        self.stem = None
+
+    def length(self, frames_per_beat, sample_rate):
+        if not len(self.table):
+            return 0
+        end_beats = float(np.max(self.table[:, 1] + self.table[:, 2]))
+        # longest voice tail (open hat / keys release) past the last note-off
+        return int(math.ceil(end_beats * frames_per_beat + 0.4 * sample_rate))
+
+class PreviewRender:
+    """Mono 16-bit WAV of an arrangement, produced block by block.
+
+    Each placed clip is rendered once into a stem (cached across requests by
+    content), and every output block just sums the stems that overlap it.
+    """
+
+    def __init__(self, data, sample_rate=AUDIO_SAMPLE_RATE, block_frames=AUDIO_BLOCK_FRAMES, muted=(), cache=stem_cache):
+        data = expand_compact(data)
+        self.sample_rate = sample_rate
+        self.block_frames = block_frames
+        self.cache = cache
+        self.bank = VoiceBank(sample_rate)
+        self.frames_per_beat = 60.0 / float(data.get("bpm", 100)) * sample_rate
+
+        voices = {t["id"]: track_voice(t) for t in data.get("tracks", []) if t["id"] not in set(muted)}
+        clips = data.get("clips", {})
+        tables = {}
+        self.placements = []
+        for item in data.get("arrangement", []):
+            voice = voices.get(item["track_id"])
+            if voice is None or item["clip_id"] not in clips:
+                continue
+            if item["clip_id"] not in tables:
+                tables[item["clip_id"]] = note_table(clips[item["clip_id"]])
+            start = int(round(item["start_bar"] * 4.0 * self.frames_per_beat))
+            self.placements.append(Placement(start, tables[item["clip_id"]], voice, self.frames_per_beat))
+        self.placements.sort(key=lambda p: p.start)
+
+        self.frames = 0
+        for placement in self.placements:
+            placement.frames = placement.length(self.frames_per_beat, sample_rate)
+            self.frames = max(self.frames, placement.start + placement.frames)
+
+    @property
+    def size(self):
+        return 44 + self.frames * 2
+
+    @property
+    def seconds(self):
+        return self.frames / self.sample_rate
+
+    def header(self):
+        data_bytes = self.frames * 2
+        return (b"RIFF" + struct.pack("<I", 36 + data_bytes) + b"WAVE"
+                + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, self.sample_rate, self.sample_rate * 2, 2, 16)
+                + b"data" + struct.pack("<I", data_bytes))
+
+    def render_stem(self, placement):
+        stem = self.cache.get(placement.key) if self.cache is not None else None
+        if stem is not None:
+            return stem
+
+        stem = np.zeros(placement.frames, dtype=np.float32)
+        for note, start, duration, velocity in placement.table:
+            offset = int(round(start * self.frames_per_beat))
+            held = max(LENGTH_STEP, int(round(duration * self.frames_per_beat / LENGTH_STEP)) * LENGTH_STEP)
+            wave = self.bank.note(placement.voice, int(note), held)
+            end = min(len(stem), offset + len(wave))
+            if end > offset >= 0:
+                stem[offset:end] += wave[:end - offset] * ((velocity / 127.0) ** 1.5)
+        stem.setflags(write=False)
+        if self.cache is not None:
+            self.cache.put(placement.key, stem)
+        return stem
+
+    def blocks(self):
+        """Yield float32 blocks; a stem is rendered when the first block reaches it and dropped after its last."""
+        upcoming = iter(self.placements)
+        queued = next(upcoming, None)
+        active = []
+        for block_start in range(0, self.frames, self.block_frames):
+            block_end = min(self.frames, block_start + self.block_frames)
+            while queued is not None and queued.start < block_end:
+                queued.stem = self.render_stem(queued)
+                active.append(queued)
+                queued = next(upcoming, None)
+
+            block = np.zeros(block_end - block_start, dtype=np.float32)
+            still = []
+            for placement in active:
+                stem_end = placement.start + len(placement.stem)
+                lo = max(block_start, placement.start)
+                hi = min(block_end, stem_end)
+                if hi > lo:
+                    block[lo - block_start:hi - block_start] += placement.stem[lo - placement.start:hi - placement.start]
+                if stem_end > block_end:
+                    still.append(placement)
+                else:
+                    placement.stem = None
+            active = still
+            yield block
+
+    def __iter__(self):
+        with span("preview", seconds=round(self.seconds, 1)) as fields:
+            yield self.header()
+            for block in self.blocks():
+                # soft clip instead of normalizing, which would need the whole song first
+                yield (np.tanh(block * MASTER_GAIN) * 32767.0).astype("<i2").tobytes()
+            fields["stems"] = len(self.placements)
+
+def render_wav_bytes(data, **options):
+    return b"".join(PreviewRender(data, **options))
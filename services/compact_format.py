@@ -0,0 +1,99 @@
+NOTE_DECIMALS = 4
+
+def mulberry32(seed):
+    state = seed & 0xFFFFFFFF
+
+    def next_float():
+        nonlocal state
+        state = (state + 0x6D2B79F5) & 0xFFFFFFFF
+        t = ((state ^ (state >> 15)) * (state | 1)) & 0xFFFFFFFF
+        t = ((t + (((t ^ (t >> 7)) * (t | 61)) & 0xFFFFFFFF)) & 0xFFFFFFFF) ^ t
+        return ((t ^ (t >> 14)) & 0xFFFFFFFF) / 4294967296
+
+    return next_float
+
+def pack_notes(events):
+    return [
+        [e["note"], round(e["start"], NOTE_DECIMALS), round(e["duration"], NOTE_DECIMALS), e["velocity"]]
+        for e in events
+    ]
+
+class PatternTable:
+    def __init__(self):
+        self.patterns = {}
+        self.index = {}
+        self.variants = {}
+
+    def add(self, key, render, track_id, humanize):
+        if key in self.index:
+            return self.index[key]
+
+        notes = pack_notes(render())
+        if not notes:
+            self.index[key] = None
+            return None
+
+        pattern_id = f"p{len(self.patterns)}"
+        self.patterns[pattern_id] = {"track_id": track_id, "notes": notes, "humanize": humanize}
+        self.index[key] = pattern_id
+        return pattern_id
+
+    def variant(self, pattern_id, key, render):
+        """The notes of a variation of `pattern_id` (spiced drums) that differ from the pattern.
+
+        Variations may only re-weight notes or add new ones, never drop any.
+        """
+        if key not in self.variants:
+            base = {(n[0], n[1]): n for n in self.patterns[pattern_id]["notes"]}
+            self.variants[key] = [n for n in pack_notes(render()) if base.get((n[0], n[1])) != n]
+        return self.variants[key]
+
+def instance_notes(pattern, variant=None):
+    if not variant:
+        return pattern["notes"]
+    # variant notes replace the pattern note with the same pitch and start, or are added, in time order
+    changed = {(n[0], n[1]): n for n in variant}
+    notes = [changed.pop((n[0], n[1]), n) for n in pattern["notes"]]
+    return sorted(notes + list(changed.values()), key=lambda n: n[1])
+
+def expand_instance(pattern, bar, seed, variant=None):
+    rand = mulberry32(seed)
+    humanize = pattern.get("humanize") or {}
+    jitter = humanize.get("jitter", 0.0)
+    velocity_range = humanize.get("velocity")
+    offset = bar * 4.0
+
+    events = []
+    draws = {}
+    for note, start, duration, velocity in instance_notes(pattern, variant):
+        # chord tones struck together share one timing/velocity draw
+        if start not in draws:
+            shift = (rand() * 2.0 - 1.0) * jitter
+            vel = velocity
+            if velocity_range:
+                lo, hi = velocity_range
+                vel = lo + int(rand() * (hi - lo + 1))
+            draws[start] = (max(0.0, start + shift), vel)
+        humanized_start, vel = draws[start]
+        events.append({"note": note, "start": humanized_start + offset, "duration": duration, "velocity": vel, "track_id": pattern["track_id"]})
+    return events
+
+def expand_compact(data):
+    if data.get("format") != "compact":
+        return data
+
+    patterns = data.get("patterns", {})
+    clips = {}
+    arrangement = []
+    for item in data.get("arrangement", []):
+        events = []
+        for pattern_id, bar, seed, *variant in item.get("instances", []):
+            pattern = patterns.get(pattern_id)
+            if pattern:
+                events.extend(expand_instance(pattern, bar, seed, variant[0] if variant else None))
+        clips[item["clip_id"]] = events
+        arrangement.append({k: v for k, v in item.items() if k != "instances"})
+
+    # prompt, seed and sections pass through so an expanded song can still be replayed or regenerated
+    extra = {k: v for k, v in data.items() if k not in ("format", "patterns", "arrangement")}
+    return dict(extra, bpm=data.get("bpm", 100), tracks=data.get("tracks", []), clips=clips, arrangement=arrangement)
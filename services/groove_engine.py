@@ -0,0 +1,90 @@
+import os
+import json
+import numpy as np
+
+STEP_BEATS = 0.25
+STEPS_PER_BAR = 16
+
+HUMANIZE_JITTER = 0.005
+
+def mpc_swing(percent):
+    # MPC-style swing: the first 16th of each pair takes `percent` of the pair,
+    # so the off-beat 16th lands (percent - 50)% of an 8th late
+    delay = (percent / 100.0 - 0.5) * (2 * STEP_BEATS)
+    return [0.0, delay] * (STEPS_PER_BAR // 2)
+
+# steps: per-16th offsets (in beats) cycled across the clip
+# offset: constant push/pull, random: extra uniform timing spread
+# note_offsets: extra fixed offset for specific MIDI notes
+GROOVE_TEMPLATES = {}
+
+def register_groove(name, steps=None, offset=0.0, random=0.0, note_offsets=None):
+    GROOVE_TEMPLATES[name] = {
+        "steps": np.asarray(steps if steps else [0.0], dtype=float),
+        "offset": float(offset),
+        "random": float(random),
+        "note_offsets": {int(k): float(v) for k, v in (note_offsets or {}).items()}
+    }
+
+def load_groove_templates(path):
+    with open(path) as f:
+        for name, spec in json.load(f).items():
+            if "mpc_swing" in spec:
+                spec = dict(spec, steps=mpc_swing(spec.pop("mpc_swing")))
+            register_groove(name, **spec)
+
+register_groove("straight")
+register_groove("swing", steps=mpc_swing(58))
+register_groove("heavy_swing", steps=mpc_swing(66))
+register_groove("shuffle", steps=mpc_swing(66))
+register_groove("drunk", steps=[0.0, 0.03], random=0.02, note_offsets={38: 0.03})
+register_groove("laid_back", offset=0.02)
+register_groove("rushed", offset=-0.01)
+for percent in (54, 58, 62, 66, 71):
+    register_groove(f"mpc_{percent}", steps=mpc_swing(percent))
+
+if os.getenv("GROOVE_TEMPLATES_PATH"):
+    load_groove_templates(os.getenv("GROOVE_TEMPLATES_PATH"))
+
+default_rng = np.random.default_rng()
+
+def get_template(groove_type):
+    return GROOVE_TEMPLATES.get(groove_type, GROOVE_TEMPLATES["straight"])
+
+def groove_offsets(starts, groove_type, rng=None, notes=None, humanize=True):
+    template = get_template(groove_type)
+    rng = rng if rng is not None else default_rng
+    starts = np.asarray(starts, dtype=float)
+
+    steps = template["steps"]
+    step_index = np.rint(starts / STEP_BEATS).astype(np.int64) % len(steps)
+    offsets = steps[step_index] + template["offset"]
+
+    if template["note_offsets"] and notes is not None:
+        notes = np.broadcast_to(np.asarray(notes), starts.shape)
+        for note, extra in template["note_offsets"].items():
+            offsets = offsets + np.where(notes == note, extra, 0.0)
+
+    if humanize and len(starts):
+        spread = HUMANIZE_JITTER
+        offsets = offsets + rng.uniform(-spread, spread, starts.shape)
+        if template["random"]:
+            offsets = offsets + rng.uniform(-template["random"], template["random"], starts.shape)
+
+    return offsets
+
+def apply_groove(starts, groove_type, rng=None, notes=None, floors=None, humanize=True):
+    starts = np.asarray(starts, dtype=float)
+    grooved = starts + groove_offsets(starts, groove_type, rng, notes, humanize)
+    floor = 0.0 if floors is None else np.asarray(floors, dtype=float)
+    return np.maximum(grooved, floor)
+
+def humanize_velocities(base, velocity_range=None, rng=None, humanize=True):
+    base = np.asarray(base, dtype=np.int64)
+    if velocity_range is None:
+        return base
+    lo, hi = velocity_range
+    if not humanize:
+        return np.full(base.shape, (lo + hi) // 2, dtype=np.int64)
+    rng = rng if rng is not None else default_rng
+    return rng.integers(lo, hi + 1, size=base.shape)
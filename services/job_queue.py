@@ -0,0 +1,150 @@
+import os
+import time
+import uuid
+import asyncio
+from services.llm_composer import generate_music_json
+from services.telemetry import logger, request_id_var
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "32"))
+JOB_TTL = float(os.getenv("JOB_TTL", "900"))
+
+FINISHED = ("done", "failed", "cancelled")
+
+class QueueFullError(Exception):
+    pass
+
+class Job:
+    def __init__(self, prompt, options):
+        self.id = uuid.uuid4().hex
+        self.request_id = request_id_var.get()
+        self.prompt = prompt
+        self.options = options
+        self.status = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.sections = []
+        self.result = None
+        self.error = None
+        self.task = None
+
+    def on_progress(self, event, **data):
+        if event == "structure":
+            self.sections = [{"name": sec.get("name"), "status": "composing"} for sec in data["sections"]]
+        elif event == "section" and data["index"] < len(self.sections):
+            self.sections[data["index"]]["status"] = "done"
+
+    def summary(self):
+        done = sum(1 for sec in self.sections if sec["status"] == "done")
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "prompt": self.prompt,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "progress": {"sections_total": len(self.sections), "sections_done": done, "sections": self.sections},
+            "error": self.error,
+        }
+
+class JobManager:
+    def __init__(self, workers=JOB_WORKERS, max_queue=JOB_QUEUE_LIMIT, ttl=JOB_TTL, runner=generate_music_json):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self.runner = runner
+        self.jobs = {}
+        self.queue = None
+        self.worker_tasks = []
+
+    def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self.queue is not None and self.worker_tasks and self.worker_tasks[0].get_loop() is loop:
+            return
+        # unbounded: the limit counts queued jobs only, so cancelled ones left in the queue don't hold a slot
+        self.queue = asyncio.Queue()
+        self.worker_tasks = [asyncio.ensure_future(self.worker()) for _ in range(max(1, self.workers))]
+
+    async def stop(self):
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+        self.queue = None
+
+    def submit(self, prompt, **options):
+        self.ensure_started()
+        self.sweep()
+        if self.pending() >= self.max_queue:
+            raise QueueFullError(f"Job queue is full ({self.max_queue} pending)")
+        job = Job(prompt, options)
+        self.queue.put_nowait(job)
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        self.sweep()
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED:
+            return job
+        job.status = "cancelled"
+        job.finished = time.time()
+        if job.task is not None:
+            job.task.cancel()
+        return job
+
+    def pending(self):
+        return sum(1 for job in self.jobs.values() if job.status == "queued")
+
+    def sweep(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items() if job.finished and now - job.finished > self.ttl]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def stats(self):
+        counts = {}
+        for job in self.jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"workers": self.workers, "queue_limit": self.max_queue, "queued": self.pending(), "jobs": counts}
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if job.status != "queued":
+                    continue
+                job.status = "running"
+                job.started = time.time()
+                # workers outlive requests; run each job under the id of the request that queued it
+                request_id_var.set(job.request_id)
+                job.task = asyncio.ensure_future(self.runner(job.prompt, progress=job.on_progress, **job.options))
+                result = await job.task
+                # a cancel that lands after the runner returned, but before this resumes, stands: the client was told so
+                if job.status == "running":
+                    job.result = result
+                    job.status = "done"
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    # the worker itself is stopping (shutdown), not just this job: take the job down and stop
+                    if job.task is not None: job.task.cancel()
+                    if job.status not in FINISHED:
+                        job.status = "cancelled"
+                        job.error = "Server stopped before the job finished"
+                    raise
+                job.status = "cancelled"
+            except Exception as e:
+                logger.error(f"Job {job.id} failed: {e}")
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                if job.status in FINISHED and job.finished is None:
+                    job.finished = time.time()
+                job.task = None
+                self.queue.task_done()
+
+job_manager = JobManager()
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.db")
+CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "256"))
+CACHE_DISK_ENTRIES = int(os.getenv("LLM_CACHE_DISK_ENTRIES", "10000"))
+# expired rows are swept (and the row count re-synced) at most this often, not on every write
+SWEEP_INTERVAL = 60.0
+
+def make_key(model, messages, params):
+    payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class LLMCache:
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, memory_entries=CACHE_MEMORY_ENTRIES, disk_entries=CACHE_DISK_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.memory = OrderedDict()
+        # the memory tier is used from the event loop, the disk tier from worker threads:
+        # separate locks so a slow commit never blocks a memory hit
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.db = None
+        self.disk_count = 0
+        self.swept = 0.0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0, "expired": 0}
+
+    def _conn(self):
+        if self.db is None and self.path:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+            self.db.commit()
+            self.disk_count = self.db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        return self.db
+
+    def _remember(self, key, value, created):
+        self.memory[key] = (value, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def get_memory(self, key):
+        now = time.time()
+        with self.lock:
+            hit = self.memory.get(key)
+            if hit is None:
+                return None
+            value, created = hit
+            if now - created <= self.ttl:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return json.loads(value)
+            del self.memory[key]
+            self.counters["expired"] += 1
+            return None
+
+    def get_disk(self, key):
+        now = time.time()
+        with self.db_lock:
+            db = self._conn()
+            if db is not None:
+                row = db.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, created = row
+                    if now - created <= self.ttl:
+                        db.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (now, key))
+                        db.commit()
+                        with self.lock:
+                            self._remember(key, value, created)
+                            self.counters["disk_hits"] += 1
+                        return json.loads(value)
+                    self.disk_count -= db.execute("DELETE FROM llm_cache WHERE key = ?", (key,)).rowcount
+                    db.commit()
+                    with self.lock:
+                        self.counters["expired"] += 1
+
+        with self.lock:
+            self.counters["misses"] += 1
+        return None
+
+    def get(self, key):
+        hit = self.get_memory(key)
+        return hit if hit is not None else self.get_disk(key)
+
+    async def get_async(self, key):
+        # memory hits stay on the loop; only the SQLite lookup goes to a thread
+        hit = self.get_memory(key)
+        return hit if hit is not None else await asyncio.to_thread(self.get_disk, key)
+
+    def _write(self, key, value, now):
+        with self.db_lock:
+            db = self._conn()
+            if db is None:
+                return
+            exists = db.execute("SELECT 1 FROM llm_cache WHERE key = ?", (key,)).fetchone() is not None
+            db.execute("INSERT OR REPLACE INTO llm_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)", (key, value, now, now))
+            self.disk_count += not exists
+            if now - self.swept >= SWEEP_INTERVAL:
+                self.swept = now
+                expired = db.execute("DELETE FROM llm_cache WHERE created < ?", (now - self.ttl,)).rowcount
+                # other processes may share the file, so the running count is re-synced here
+                self.disk_count = db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+                with self.lock:
+                    self.counters["expired"] += expired
+            overflow = self.disk_count - self.disk_entries
+            if overflow > 0:
+                evicted = db.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed ASC LIMIT ?)", (overflow,)).rowcount
+                self.disk_count -= evicted
+                with self.lock:
+                    self.counters["evictions"] += evicted
+            db.commit()
+
+    def _store(self, key, data):
+        now = time.time()
+        value = json.dumps(data)
+        with self.lock:
+            self._remember(key, value, now)
+            self.counters["writes"] += 1
+        return value, now
+
+    def set(self, key, data):
+        self._write(key, *self._store(key, data))
+
+    async def set_async(self, key, data):
+        value, now = self._store(key, data)
+        await asyncio.to_thread(self._write, key, value, now)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        with self.db_lock:
+            db = self._conn()
+            if db is not None:
+                db.execute("DELETE FROM llm_cache")
+                db.commit()
+                self.disk_count = 0
+
+    def stats(self):
+        with self.db_lock:
+            self._conn()
+        with self.lock:
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            lookups = hits + self.counters["misses"]
+            return dict(
+                self.counters,
+                hits=hits,
+                hit_rate=(hits / lookups) if lookups else 0.0,
+                memory_entries=len(self.memory),
+                disk_entries=self.disk_count,
+                enabled=CACHE_ENABLED
+            )
+
+llm_cache = LLMCache()
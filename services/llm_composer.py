@@ -1,20 +1,48 @@
 import os
 import json
-import random
-import re
-from openai import OpenAI
-from dotenv import load_dotenv
+import secrets
+import numpy as np
+import asyncio
 from services.music_engine import (
-    parse_drum_grid, parse_harmonic_grid, parse_chord_comping
+    parse_drum_grid, parse_harmonic_grid, parse_chord_comping,
+    compile_stream, make_token, humanize_spec,
+    drum_columns, harmonic_columns, comping_columns, render_columns,
+    BASS_VELOCITY, KEYS_VELOCITY
 )
+from services.llm_cache import llm_cache, make_key, CACHE_ENABLED
+from services.singleflight import SingleFlight
+from services.compact_format import PatternTable, expand_compact
+from services.groove_engine import default_rng
+from services.pattern_validator import validate_patterns, validation_stats, REQUIRED_KEYS
+from services.pattern_fallback import procedural_patterns, procedural_structure
+from services.pattern_library import pattern_library, LIBRARY_MODE, LIBRARY_REUSE
+from services.llm_transport import get_transport, classify
+from services.telemetry import logger, span, LLM_SECONDS, LLM_TOKENS, LLM_ERRORS, FALLBACKS
 
-load_dotenv()
-api_key = os.getenv("OPENROUTER_API_KEY")
-base_url = os.getenv("LLM_BASE_URL")
+# settings only (the entry points load .env); the client itself (and the openai import) is set up lazily by the transport
 model_name = os.getenv("LLM_MODEL")
 
-client = OpenAI(base_url=base_url, api_key=api_key)
 MODEL_NAME = model_name
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+
+# seconds before the procedural fallback stands in for a slow LLM answer (0 disables)
+STRUCTURE_DEADLINE = float(os.getenv("STRUCTURE_DEADLINE", "20"))
+SECTION_DEADLINE = float(os.getenv("SECTION_DEADLINE", "30"))
+LATE_SWAP_TIMEOUT = float(os.getenv("LATE_SWAP_TIMEOUT", "60"))
+SONG_DEADLINE = float(os.getenv("SONG_DEADLINE", "45"))
+
+# "sections": one structure call plus one call per section; "single": one call for the whole song
+COMPOSE_MODES = ("sections", "single")
+COMPOSE_MODE = os.getenv("COMPOSE_MODE", "sections")
+JSON_SYSTEM = "You are a JSON-only response bot."
+
+# variations share one structure call; each section asks for all its variants in one request
+# via the `n` parameter (LLM_MULTI_CHOICE=0 sends parallel single calls instead)
+MAX_VARIATIONS = int(os.getenv("MAX_VARIATIONS", "8"))
+LLM_MULTI_CHOICE = os.getenv("LLM_MULTI_CHOICE", "1") != "0"
+
+llm_flight = SingleFlight()
+song_flight = SingleFlight(progress=True)
 
 STRUCTURE_PROMPT = """
 You are a Senior Music Director.
@@ -84,161 +112,884 @@ Return JSON ONLY:
 }}
 """
 
-def get_json(prompt, model=MODEL_NAME):
+PATCH_PROMPT = """
+You are a World-Class Rhythm Composer.
+Task: Rewrite ONLY some instruments of section "{section}". The rest of the arrangement stays as it is.
+
+Context:
+- User Request / Genre: {vibe}
+- BPM: {bpm}
+- Energy: {energy}
+- Chords: {chords}
+- Groove (keep it): {groove}
+
+**Duration Stream Notation**:
+Format: <Event><Duration>
+- Events: 'x' (Hit/Play), 'X' (Accent), 'g' (Ghost), '.' (Rest), '1'/'3'/'5'/'7' (Scale degrees - FOR BASS ONLY), '-' (Sustain).
+- Durations: '1n', '2n', '4n', '8n', '16n', '8t' (Eighth Triplet, 3 fit in 1 beat), '16t'.
+- Sum of durations in each array MUST EXACTLY equal 4.0 beats (1 Bar).
+- Piano/Keys use 'x'/'X' only. Bass uses scale degrees. Drums follow the genre.
+
+Compose something clearly different from a typical first attempt.
+
+Return JSON ONLY with exactly these keys:
+{{
+  "analysis": "One or two sentences on the new idea.",
+{keys}
+}}
+"""
+
+REPAIR_PROMPT = """
+You are a World-Class Rhythm Composer.
+Task: Some duration streams for section "{section}" were invalid. Rewrite ONLY those.
+
+Context:
+- User Request / Genre: {vibe}
+- BPM: {bpm}
+- Energy: {energy}
+- Chords: {chords}
+
+Problems found:
+{problems}
+
+**Duration Stream Notation**:
+Format: <Event><Duration>
+- Events: 'x' (Hit/Play), 'X' (Accent), 'g' (Ghost), '.' (Rest), '1'/'3'/'5'/'7' (Scale degrees - FOR BASS ONLY), '-' (Sustain).
+- Durations: '1n', '2n', '4n', '8n', '16n', '8t' (Eighth Triplet, 3 fit in 1 beat), '16t'.
+- Sum of durations in each array MUST EXACTLY equal 4.0 beats (1 Bar).
+- Piano/Keys use 'x'/'X' only. Bass uses scale degrees. Drums follow the genre.
+
+Return JSON ONLY with exactly these keys:
+{{
+{keys}
+}}
+"""
+
+# static instructions for single-call mode, sent as the system message so that every
+# request shares the same prefix and provider-side prompt caching can reuse it
+SONG_PROMPT = """
+You are a JSON-only response bot acting as a Senior Music Director and World-Class Rhythm Composer.
+Your Goal: Design a whole song for the user's request in ONE response: its structure and the MIDI duration streams of every section.
+
+Instructions:
+1. **Analyze the Genre**: Determine the typical structure.
+2. **Chain of Loops**: Create a progression of short sections (2-4 bars).
+3. **Harmony**: Choose chords that fit the genre's color.
+4. **Rhythm**: Compose every section's streams to fit its energy, texture and chords. Sections should evolve, not repeat each other.
+
+**Duration Stream Notation**:
+You MUST output arrays of strings representing musical events and their exact durations.
+Format: <Event><Duration>
+- Events: 'x' (Hit/Play), 'X' (Accent), 'g' (Ghost), '.' (Rest), '1'/'3'/'5'/'7' (Scale degrees - FOR BASS ONLY), '-' (Sustain).
+- Durations: '1n', '2n', '4n', '8n', '16n', '8t' (Eighth Triplet, 3 fit in 1 beat), '16t'.
+- Sum of durations in each array MUST EXACTLY equal 4.0 beats (1 Bar).
+
+**CRITICAL INSTRUCTIONS FOR INSTRUMENTS**:
+1. **Piano/Keys**: You MUST use 'x' or 'X' to trigger chords (e.g., "x8n", "x8t"). DO NOT use numbers for piano. Design the comping rhythm (syncopation, triplets, stabs, laid-back chords) from the user's vibe; no boring whole notes.
+2. **Bass**: Use '1', '3', '5', etc. for scale degrees (e.g., "1_8n", ".16n", "5_16n").
+3. **Drums**: Design the groove based on the genre (e.g., four-on-the-floor, boom-bap, trap rolls).
+
+Replace all "<generate_array_here>" placeholders with your own original duration stream arrays.
+
+Return JSON ONLY:
+{
+  "bpm": 120,
+  "key": "A Minor",
+  "sections": [
+    {
+      "name": "Intro", "length": 4, "energy": "Low", "texture": "Sparse", "chords": ["Am7"],
+      "patterns": {
+        "analysis": "One or two sentences on the rhythm design of this section.",
+        "groove": "straight or swing",
+        "kick_main":  ["<generate_array_here>"],
+        "kick_fill":  ["<generate_array_here>"],
+        "snare_main": ["<generate_array_here>"],
+        "snare_fill": ["<generate_array_here>"],
+        "hihat_main": ["<generate_array_here>"],
+        "hihat_fill": ["<generate_array_here>"],
+        "bass_main":  ["<generate_array_here>"],
+        "bass_fill":  ["<generate_array_here>"],
+        "keys_main":  ["<generate_array_here>"],
+        "keys_fill":  ["<generate_array_here>"]
+      }
+    }
+  ]
+}
+"""
+
+# the only per-request part of a single-call prompt, kept after the static prefix
+SONG_REQUEST = """
+User Request: "{vibe}"
+Key: {key}
+"""
+
+def pattern_key_lines(keys):
+    return ",\n".join(f'  "{key}": ["<generate_array_here>"]' for key in keys)
+
+async def get_json(prompt, model=MODEL_NAME, use_cache=True, kind="pattern", system=JSON_SYSTEM):
+    messages = [
+        {"role": "system", "content": system}, 
+        {"role": "user", "content": prompt}
+    ]
+    params = {"temperature": 0.9, "response_format": {"type": "json_object"}}
+    
+    with span("llm", LLM_SECONDS, kind=kind, model=model, cache="bypass") as fields:
+        if not use_cache:
+            return await request_json(model, messages, params, fields)
+        
+        cache_key = make_key(model, messages, params)
+        if CACHE_ENABLED:
+            cached = await llm_cache.get_async(cache_key)
+            if cached is not None:
+                fields["cache"] = "hit"
+                return cached
+        
+        fields["cache"] = "coalesced"
+        async def fetch():
+            fields["cache"] = "miss"
+            data = await request_json(model, messages, params, fields)
+            if CACHE_ENABLED and data:
+                await llm_cache.set_async(cache_key, data)
+            return data
+        
+        return await llm_flight.do(cache_key, fetch)
+
+async def get_json_variants(prompt, n, model=MODEL_NAME, use_cache=True, kind="pattern", system=JSON_SYSTEM):
+    """n independent answers to one prompt, asked for in a single request with `n` choices.
+
+    Providers that ignore `n` answer once; the missing variants are then
+    requested in parallel. Answers that failed come back as {}.
+    """
     messages = [
-        {"role": "system", "content": "You are a JSON-only response bot."}, 
+        {"role": "system", "content": system},
         {"role": "user", "content": prompt}
     ]
+    params = {"temperature": 0.9, "response_format": {"type": "json_object"}}
+    if LLM_MULTI_CHOICE and n > 1:
+        params["n"] = n
+    
+    cache_key = make_key(model, messages, dict(params, variants=n))
+    if use_cache and CACHE_ENABLED:
+        cached = await llm_cache.get_async(cache_key)
+        if isinstance(cached, list) and len(cached) == n:
+            with span("llm", LLM_SECONDS, kind=kind, model=model, cache="hit", variants=n):
+                return cached
+    
+    with span("llm", LLM_SECONDS, kind=kind, model=model, cache="miss" if use_cache else "bypass", variants=n) as fields:
+        answers = await request_choices(model, messages, params, fields)
+    if not answers:
+        # the request itself failed; n more of the same would most likely fail too
+        return [{} for _ in range(n)]
+    
+    single = {key: value for key, value in params.items() if key != "n"}
+    
+    async def top_up():
+        with span("llm", LLM_SECONDS, kind=kind, model=model, cache="bypass") as fields:
+            return await request_json(model, messages, single, fields)
+    
+    answers = answers[:n] + list(await asyncio.gather(*(top_up() for _ in range(n - len(answers)))))
+    if use_cache and CACHE_ENABLED and all(answers):
+        await llm_cache.set_async(cache_key, answers)
+    return answers
+
+async def request_choices(model, messages, params, fields=None):
+    """Every choice of one completion, parsed ({} where unparseable); [] if the call failed."""
+    fields = fields if fields is not None else {}
+    labels = {"kind": fields.get("kind", ""), "model": model}
     try:
-        resp = client.chat.completions.create(model=model, messages=messages, temperature=0.9, response_format={"type": "json_object"})
-        content = resp.choices[0].message.content
-        content = content.replace("```json", "").replace("```", "").strip()
-        return json.loads(content)
+        resp = await get_transport().create(labels["kind"], model=model, messages=messages, **params)
     except Exception as e:
-        print(f"LLM Error: {e}")
-        return {}
+        cause = classify(e)[0]
+        logger.error(f"LLM Error ({cause}): {e}")
+        LLM_ERRORS.inc(error=cause, **labels)
+        fields["error"] = cause
+        return []
+    
+    usage = getattr(resp, "usage", None)
+    if usage is not None:
+        fields["prompt_tokens"] = usage.prompt_tokens
+        fields["completion_tokens"] = usage.completion_tokens
+        LLM_TOKENS.inc(usage.prompt_tokens or 0, type="prompt", **labels)
+        LLM_TOKENS.inc(usage.completion_tokens or 0, type="completion", **labels)
+    
+    answers = []
+    for choice in getattr(resp, "choices", None) or [None]:
+        try:
+            content = choice.message.content
+            content = content.replace("```json", "").replace("```", "").strip()
+            answers.append(json.loads(content))
+        except Exception as e:
+            logger.error(f"LLM Error: unparseable response: {e}")
+            LLM_ERRORS.inc(error="parse", **labels)
+            fields["error"] = "parse"
+            answers.append({})
+    return answers
+
+async def request_json(model, messages, params, fields=None):
+    answers = await request_choices(model, messages, params, fields)
+    return answers[0] if answers else {}
 
-def apply_random_spice(stream, probability=0.1):
-    if not isinstance(stream, list):
+def apply_random_spice(stream, probability=0.1, rng=None):
+    if not isinstance(stream, (list, tuple)):
         return stream
+    
+    tokens = compile_stream(stream)
+    rng = rng if rng is not None else default_rng
+    draws = rng.random((len(tokens), 2)).tolist()
         
     new_stream = []
-    for item in stream:
-        match = re.match(r'^([A-Za-z0-9_\-\.]+?)(1n|2n|4n|8n|16n|32n|4t|8t|16t)$', str(item).strip())
-        if not match:
-            new_stream.append(item)
-            continue
-            
-        event_char = match.group(1)
-        dur_str = match.group(2)
-        
-        new_event = event_char
-        if event_char == '.' and random.random() < (probability * 0.3):
-            new_event = 'g'
-        elif event_char == 'x' and random.random() < probability:
-            new_event = 'X' if random.random() > 0.5 else 'x'
+    for token, (roll, flip) in zip(tokens, draws):
+        event_char = token[0]
+        
+        if event_char == '.' and roll < (probability * 0.3):
+            token = make_token('g', token[3])
+        elif event_char == 'x' and roll < probability:
+            token = make_token('X' if flip > 0.5 else 'x', token[3])
             
-        new_stream.append(f"{new_event}{dur_str}")
+        new_stream.append(token)
         
-    return new_stream
+    return tuple(new_stream)
 
-def generate_section_clips(section_data, vibe, bpm, track_ids):
-    sec_name = section_data.get("name", "Section")
-    chords = section_data.get("chords", [])
-    length = section_data.get("length", 2)
-    energy = section_data.get("energy", "Medium")
-    texture = section_data.get("texture", "Steady")
-    
-    prompt = PATTERN_PROMPT.format(
-        section=sec_name, 
+def new_seed():
+    return secrets.randbits(32)
+
+def section_prompt(section_data, vibe, bpm):
+    return PATTERN_PROMPT.format(
+        section=section_data.get("name", "Section"), 
         vibe=vibe, 
         bpm=bpm, 
-        energy=energy, 
-        texture=texture, 
-        chords=str(chords)
+        energy=section_data.get("energy", "Medium"), 
+        texture=section_data.get("texture", "Steady"), 
+        chords=str(section_data.get("chords", []))
     )
-    patterns = get_json(prompt)
+
+async def compose_section_patterns(section_data, vibe, bpm, use_cache=True, library=None):
+    sec_name = section_data.get("name", "Section")
+    library = library or LIBRARY_MODE
     
-    if not patterns: patterns = {}
+    # fresh requests always go to the LLM; reuse_ratio keeps some traffic flowing there to grow the library
+    if library == "reuse" and use_cache and default_rng.random() < LIBRARY_REUSE:
+        with span("library", section=sec_name):
+            patterns = await asyncio.to_thread(pattern_library.find, section_data, vibe, bpm, rng=default_rng)
+        if patterns is not None:
+            logger.info(f"  > Library: reused pattern {patterns['library_id']} (similarity {patterns['similarity']})")
+            return patterns
+    
+    with span("section", section=sec_name):
+        patterns = await get_json(section_prompt(section_data, vibe, bpm), use_cache=use_cache)
+        patterns = await complete_patterns(section_data, vibe, bpm, patterns, REQUIRED_KEYS, use_cache)
+    
+    await record_patterns(section_data, vibe, bpm, patterns, library)
     
     analysis = patterns.get("analysis", "No analysis provided.")
-    groove_type = patterns.get("groove", "straight").lower()
+    groove_type = str(patterns.get("groove", "straight")).lower()
+    
+    logger.info(f"  > Thought: {analysis}")
+    logger.info(f"  > Groove: {groove_type} | BPM: {bpm}")
     
-    print(f"  > Thought: {analysis}")
-    print(f"  > Groove: {groove_type} | BPM: {bpm}")
+    return patterns
+
+async def compose_section_variants(section_data, vibe, bpm, count, use_cache=True, rngs=None):
+    # always the LLM, never the library: the point is to hear different takes on the same section
+    rngs = rngs or [None] * count
+    with span("section", section=section_data.get("name", "Section")):
+        answers = await get_json_variants(section_prompt(section_data, vibe, bpm), count, use_cache=use_cache)
+        variants = await asyncio.gather(*(
+            complete_patterns(section_data, vibe, bpm, answer, REQUIRED_KEYS, use_cache, rng) for answer, rng in zip(answers, rngs)
+        ))
+    
+    for patterns in variants:
+        await record_patterns(section_data, vibe, bpm, patterns)
+    return list(variants)
+
+async def record_patterns(section_data, vibe, bpm, patterns, library=None):
+    # only validated LLM answers are worth keeping; fallbacks and library hits carry a source
+    if (library or LIBRARY_MODE) != "off" and not patterns.get("source"):
+        await asyncio.to_thread(pattern_library.add, section_data, vibe, bpm, patterns)
 
-    clips = {"kick": [], "snare": [], "hat": [], "bass": [], "piano": []}
+async def complete_patterns(section_data, vibe, bpm, patterns, required, use_cache=True, rng=None):
+    if not patterns:
+        # the call itself failed; asking again for every key would just be a slower retry
+        FALLBACKS.inc(stage="section", reason="error")
+        logger.warning("  > No usable LLM response, using the procedural fallback")
+        return procedural_patterns(section_data, vibe, rng)
+    
+    # repair locally where it is safe; only streams that can't be fixed cost another (small) call
+    patterns, issues, failing = validate_patterns(patterns, required)
+    for key, notes in issues.items():
+        logger.info(f"  > {key}: {'; '.join(notes)}")
+    if not failing:
+        return patterns
+    
+    validation_stats["follow_ups"] += 1
+    prompt = REPAIR_PROMPT.format(
+        section=section_data.get("name", "Section"),
+        vibe=vibe,
+        bpm=bpm,
+        energy=section_data.get("energy", "Medium"),
+        chords=str(section_data.get("chords", [])),
+        problems="\n".join(f"- {key}: {'; '.join(issues[key])}" for key in failing),
+        keys=pattern_key_lines(failing)
+    )
+    fixes = await get_json(prompt, use_cache=use_cache, kind="repair")
+    fixes, issues, still_failing = validate_patterns({key: fixes[key] for key in failing if key in fixes}, failing)
+    if still_failing:
+        logger.warning(f"  > Still invalid after follow-up, using procedural streams: {', '.join(still_failing)}")
+        FALLBACKS.inc(stage="stream", reason="invalid")
+        fallback = procedural_patterns(section_data, vibe, rng)
+        fixes.update((key, fallback[key]) for key in still_failing)
+        # part LLM, part procedural: usable here, but not a validated answer for the library
+        fixes["source"] = "repaired"
+    patterns.update(fixes)
+    return patterns
+
+async def generate_section_clips(section_data, vibe, bpm, track_ids, use_cache=True, seed=None, index=0, library=None):
+    with span("section_clips", section=section_data.get("name", "Section")):
+        patterns = await compose_section_patterns(section_data, vibe, bpm, use_cache, library)
+        return render_section_clips(section_data, patterns, track_ids, section_rngs(seed, index))
+
+# (pattern key prefix, clip name, spice probability on non-fill bars)
+SECTION_INSTRUMENTS = [
+    ("kick", "kick", 0.05),
+    ("snare", "snare", 0.05),
+    ("hihat", "hat", 0.1),
+    ("bass", "bass", None),
+    ("keys", "piano", None),
+]
+
+DRUM_NOTES = {"kick": 36, "snare": 38, "hat": 42}
+PATTERN_PREFIXES = {clip_name: instr for instr, clip_name, _ in SECTION_INSTRUMENTS}
+DEFAULT_HIHAT = ["x8n", "x8n", "x8n", "x8n", "x8n", "x8n", "x8n", "x8n"]
+
+# one independent stream per (section, instrument): render order and
+# regenerating a single instrument never shift the draws of the others
+def section_rngs(seed, index):
+    if seed is None:
+        return {clip_name: default_rng for _, clip_name, _ in SECTION_INSTRUMENTS}
+    return {clip_name: np.random.default_rng([seed, index, k]) for k, (_, clip_name, _) in enumerate(SECTION_INSTRUMENTS)}
+
+def section_bar_plan(section_data, patterns, rngs):
+    chords = section_data.get("chords", [])
+    length = section_data.get("length", 2)
+    grids = {key: compile_stream(value) for key, value in patterns.items() if isinstance(value, list)}
     
     for bar in range(length):
-        offset = bar * 4.0
         is_fill_bar = (bar == length - 1)
         suffix = "_fill" if is_fill_bar else "_main"
+        current_chord = chords[bar % len(chords)] if chords else None
         
-        def get_grid(instr):
-            grid = patterns.get(f"{instr}{suffix}")
-            if not grid: grid = patterns.get(f"{instr}_main")
-            if not grid: grid = patterns.get(instr) 
-            return grid
-
-        k_grid = get_grid("kick")
-        if k_grid:
-            if not is_fill_bar: k_grid = apply_random_spice(k_grid, 0.05)
-            k = parse_drum_grid(k_grid, track_ids["kick"], 36, groove_type)
-            for e in k: e["start"] += offset; clips["kick"].append(e)
-
-        s_grid = get_grid("snare")
-        if s_grid:
-            if not is_fill_bar: s_grid = apply_random_spice(s_grid, 0.05)
-            s = parse_drum_grid(s_grid, track_ids["snare"], 38, groove_type)
-            for e in s: e["start"] += offset; clips["snare"].append(e)
-            
-        h_grid = get_grid("hihat")
-        if not h_grid: h_grid = ["x8n", "x8n", "x8n", "x8n", "x8n", "x8n", "x8n", "x8n"]
-        if not is_fill_bar: h_grid = apply_random_spice(h_grid, 0.1)
-        h = parse_drum_grid(h_grid, track_ids["hat"], 42, groove_type)
-        for e in h: e["start"] += offset; clips["hat"].append(e)
+        for instr, clip_name, spice in SECTION_INSTRUMENTS:
+            grid = grids.get(f"{instr}{suffix}")
+            if not grid: grid = grids.get(f"{instr}_main")
+            if not grid: grid = grids.get(instr)
+            if not grid and instr == "hihat": grid = compile_stream(DEFAULT_HIHAT)
+            if not grid: continue
             
-        current_chord = chords[bar % len(chords)]
-        
-        b_grid = get_grid("bass")
-        if b_grid:
-            b = parse_harmonic_grid(b_grid, current_chord, "bass", track_ids["bass"], groove_type)
-            for e in b: e["start"] += offset; clips["bass"].append(e)
-            
-        p_grid = get_grid("keys")
-        if p_grid:
-            p = parse_chord_comping(p_grid, current_chord, track_ids["piano"], groove_type)
-            for e in p: e["start"] += offset; clips["piano"].append(e)
+            base = grid
+            if spice and not is_fill_bar: grid = apply_random_spice(grid, spice, rngs[clip_name])
+            chord = current_chord if clip_name not in DRUM_NOTES else None
+            yield bar, clip_name, base, grid, chord
+
+def render_instrument(clip_name, grid, chord, groove_type, track_ids, humanize=True):
+    track_id = track_ids[clip_name]
+    if clip_name in DRUM_NOTES:
+        return parse_drum_grid(grid, track_id, DRUM_NOTES[clip_name], groove_type, humanize)
+    if clip_name == "bass":
+        return parse_harmonic_grid(grid, chord, "bass", track_id, groove_type, humanize)
+    return parse_chord_comping(grid, chord, track_id, groove_type, humanize)
+
+def render_section_clips(section_data, patterns, track_ids, rngs=None):
+    with span("render", section=section_data.get("name", "Section")):
+        return _render_section_clips(section_data, patterns, track_ids, rngs or section_rngs(None, 0))
+
+def _render_section_clips(section_data, patterns, track_ids, rngs):
+    groove_type = str(patterns.get("groove", "straight")).lower()
+    bars = {"kick": [], "snare": [], "hat": [], "bass": [], "piano": []}
+    
+    for bar, clip_name, _, grid, chord in section_bar_plan(section_data, patterns, rngs):
+        bars[clip_name].append((bar, grid, chord))
+    
+    clips = {}
+    for clip_name, clip_bars in bars.items():
+        track_id = track_ids[clip_name]
+        rng = rngs[clip_name]
+        if clip_name in DRUM_NOTES:
+            midi_note = DRUM_NOTES[clip_name]
+            columns = drum_columns(clip_bars, midi_note)
+            clips[clip_name] = render_columns(columns, track_id, groove_type, None, rng, groove_note=midi_note)
+        elif clip_name == "bass":
+            clips[clip_name] = render_columns(harmonic_columns(clip_bars, "bass"), track_id, groove_type, BASS_VELOCITY, rng)
+        else:
+            clips[clip_name] = render_columns(comping_columns(clip_bars), track_id, groove_type, KEYS_VELOCITY, rng)
             
     return clips
 
-def generate_music_json(user_prompt: str):
-    print(f"request: {user_prompt}")
+def render_section_compact(section_data, patterns, track_ids, table, rngs=None):
+    with span("render", section=section_data.get("name", "Section"), format="compact"):
+        return _render_section_compact(section_data, patterns, track_ids, table, rngs or section_rngs(None, 0))
+
+def _render_section_compact(section_data, patterns, track_ids, table, rngs):
+    groove_type = str(patterns.get("groove", "straight")).lower()
+    instances = {"kick": [], "snare": [], "hat": [], "bass": [], "piano": []}
     
-    bp_data = get_json(STRUCTURE_PROMPT.format(vibe=user_prompt, key="Random"))
-    bpm = bp_data.get("bpm", 90)
+    for bar, clip_name, base, grid, chord in section_bar_plan(section_data, patterns, rngs):
+        render = lambda g: render_instrument(clip_name, g, chord, groove_type, track_ids, humanize=False)
+        humanize = humanize_spec(clip_name, groove_type)
+        # bars are shared on the unspiced grid; the few hits spice accents or adds ride along per instance
+        key = (clip_name, base, chord, groove_type)
+        pattern_id = table.add(key, lambda: render(base), track_ids[clip_name], humanize)
+        variant = None
+        if grid != base:
+            if pattern_id is None:
+                # a bar of rests that spice filled with ghost notes has nothing to vary from
+                pattern_id = table.add(key + (grid,), lambda: render(grid), track_ids[clip_name], humanize)
+            else:
+                variant = table.variant(pattern_id, key + (grid,), lambda: render(grid))
+        if pattern_id is not None:
+            instance = [pattern_id, bar, int(rngs[clip_name].integers(0, 2**32))]
+            instances[clip_name].append(instance + [variant] if variant else instance)
+            
+    return instances
+
+TRACKS = [
+    {"id": "t_piano", "instrument": "Electric Piano", "type": "instrument"},
+    {"id": "t_bass", "instrument": "Finger Bass", "type": "instrument"},
+    {"id": "t_kick", "instrument": "Kick", "type": "percussion"},
+    {"id": "t_snare", "instrument": "Snare", "type": "percussion"},
+    {"id": "t_hat", "instrument": "HiHat", "type": "percussion"},
+]
+
+TRACK_IDS = {
+    "piano": "t_piano", "bass": "t_bass", 
+    "kick": "t_kick", "snare": "t_snare", "hat": "t_hat"
+}
+
+def section_clip_id(index, sec, instr_name):
+    return f"s{index}_{sec.get('name')}_{instr_name}".replace(" ", "_")
+
+def build_section_entries(index, sec, start_bar, section_clips, track_ids=TRACK_IDS):
+    clips = {}
+    arrangement = []
+    for instr_name, events in section_clips.items():
+        if not events: continue
+        
+        unique_id = section_clip_id(index, sec, instr_name)
+        
+        clips[unique_id] = events
+        arrangement.append({
+            "section": sec.get("name"),
+            "start_bar": start_bar,
+            "track_id": track_ids[instr_name],
+            "clip_id": unique_id
+        })
+    return clips, arrangement
+
+late_tasks = set()
+
+async def within_deadline(coro, deadline, fallback, stage):
+    """Await `coro` for at most `deadline` seconds, else return `fallback()`.
+
+    Returns (result, late_task); late_task is the still-running LLM work when
+    the fallback was used, so callers can swap it in or cancel it.
+    """
+    task = asyncio.ensure_future(coro)
+    if deadline <= 0:
+        return await task, None
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), deadline), None
+    except asyncio.TimeoutError:
+        logger.warning(f"  > {stage} missed its {deadline:g}s deadline, using the procedural fallback")
+        FALLBACKS.inc(stage=stage, reason="deadline")
+        late_tasks.add(task)
+        task.add_done_callback(late_tasks.discard)
+        return fallback(), task
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+def release_late(task, use_cache):
+    # a late answer is still worth finishing when it will land in the LLM cache
+    if task is not None and not (use_cache and CACHE_ENABLED):
+        task.cancel()
+
+def build_structure(bp_data, user_prompt):
+    fallback = None
     sections = bp_data.get("sections", [])
-    
     if not sections:
-        sections = [{"name": "Jam", "length": 4, "energy": "Medium", "chords": ["Cm7", "F9"]}]
-        
-    final_json = {
+        fallback = procedural_structure(user_prompt)
+        sections = fallback["sections"]
+    bpm = bp_data.get("bpm") or (fallback or procedural_structure(user_prompt))["bpm"]
+    
+    start_bars = []
+    curr_bar = 0
+    for sec in sections:
+        start_bars.append(curr_bar)
+        curr_bar += sec.get("length", 2)
+    
+    return {
         "bpm": bpm,
-        "tracks": [
-            {"id": "t_piano", "instrument": "Electric Piano", "type": "instrument"},
-            {"id": "t_bass", "instrument": "Finger Bass", "type": "instrument"},
-            {"id": "t_kick", "instrument": "Kick", "type": "percussion"},
-            {"id": "t_snare", "instrument": "Snare", "type": "percussion"},
-            {"id": "t_hat", "instrument": "HiHat", "type": "percussion"},
-        ],
-        "clips": {},
-        "arrangement": []
+        "sections": [dict(sec, start_bar=start) for sec, start in zip(sections, start_bars)],
+        "total_bars": curr_bar
     }
+
+async def compose_structure(user_prompt, use_cache=True):
+    with span("structure"):
+        bp_data = await get_json(STRUCTURE_PROMPT.format(vibe=user_prompt, key="Random"), use_cache=use_cache, kind="structure")
+    return build_structure(bp_data, user_prompt)
+
+async def structure_within_deadline(user_prompt, use_cache):
+    structure, late = await within_deadline(
+        compose_structure(user_prompt, use_cache),
+        STRUCTURE_DEADLINE,
+        lambda: build_structure(procedural_structure(user_prompt), user_prompt),
+        "structure"
+    )
+    release_late(late, use_cache)
+    return structure
+
+async def section_within_deadline(i, sec, user_prompt, bpm, use_cache, limiter):
+    async def compose():
+        async with limiter:
+            logger.info(f"Composing Section {i+1}: {sec.get('name')}...")
+            return await compose_section_patterns(sec, user_prompt, bpm, use_cache)
+    
+    # the deadline includes the wait for a concurrency slot, so it bounds the whole section
+    return await within_deadline(compose(), SECTION_DEADLINE, lambda: procedural_patterns(sec, user_prompt), "section")
+
+def section_event(i, sec, patterns, seed, **extra):
+    section_clips = render_section_clips(sec, patterns, TRACK_IDS, section_rngs(seed, i))
+    clips, arrangement = build_section_entries(i, sec, sec["start_bar"], section_clips)
+    return dict({
+        "type": "section",
+        "index": i,
+        "section": sec.get("name"),
+        "start_bar": sec["start_bar"],
+        "groove": str(patterns.get("groove", "straight")).lower(),
+        "patterns": patterns,
+        "clips": clips,
+        "arrangement": arrangement
+    }, **extra)
+
+async def stream_music_json(user_prompt: str, concurrency=LLM_CONCURRENCY, use_cache=True, seed=None, swap_late=False, mode=None):
+    logger.info(f"request: {user_prompt}")
+    seed = new_seed() if seed is None else seed
+    mode = mode or COMPOSE_MODE
+    
+    if mode == "single":
+        # everything arrives in one answer, so there is nothing to interleave
+        song = await compose_song(user_prompt, concurrency, use_cache, mode=mode)
+        structure = {key: value for key, value in song.items() if key not in ("prompt", "patterns")}
+        yield dict(structure, type="structure", tracks=TRACKS, seed=seed)
+        for i, (sec, patterns) in enumerate(zip(song["sections"], song["patterns"])):
+            yield section_event(i, sec, patterns, seed)
+        yield {"type": "done"}
+        return
+    
+    structure = await structure_within_deadline(user_prompt, use_cache)
+    bpm = structure["bpm"]
+    sections = structure["sections"]
+    
+    yield dict(structure, type="structure", tracks=TRACKS, seed=seed)
+    
+    limiter = asyncio.Semaphore(max(1, concurrency))
+    
+    async def compose(i, sec):
+        patterns, late = await section_within_deadline(i, sec, user_prompt, bpm, use_cache, limiter)
+        return i, patterns, late
+    
+    async def land(i, late):
+        return i, await late
+    
+    tasks = [asyncio.ensure_future(compose(i, sec)) for i, sec in enumerate(sections)]
+    late_sections = []
+    swapping = []
+    try:
+        for done in asyncio.as_completed(tasks):
+            i, patterns, late = await done
+            yield section_event(i, sections[i], patterns, seed)
+            if late is None:
+                continue
+            if swap_late:
+                swapping.append(late)
+                late_sections.append(land(i, late))
+            else:
+                release_late(late, use_cache)
+        
+        # swap the real patterns in for sections that fell back to the procedural engine
+        if late_sections:
+            try:
+                for done in asyncio.as_completed(late_sections, timeout=LATE_SWAP_TIMEOUT):
+                    i, patterns = await done
+                    yield section_event(i, sections[i], patterns, seed, replaces=True)
+            except asyncio.TimeoutError:
+                logger.warning("  > Gave up waiting for late sections")
+    finally:
+        for t in tasks:
+            t.cancel()
+        for late in swapping:
+            release_late(late, use_cache)
     
-    track_ids = {
-        "piano": "t_piano", "bass": "t_bass", 
-        "kick": "t_kick", "snare": "t_snare", "hat": "t_hat"
+    yield {"type": "done"}
+
+async def compose_song(user_prompt, concurrency=LLM_CONCURRENCY, use_cache=True, progress=None, mode=None):
+    mode = mode or COMPOSE_MODE
+    if mode not in COMPOSE_MODES:
+        raise ValueError(f"Unknown compose mode: {mode}")
+    if mode == "single":
+        return await compose_song_single(user_prompt, concurrency, use_cache, progress)
+    
+    structure = await structure_within_deadline(user_prompt, use_cache)
+    sections = structure["sections"]
+    if progress: progress("structure", sections=sections)
+    
+    limiter = asyncio.Semaphore(max(1, concurrency))
+    
+    async def compose(i, sec):
+        patterns, late = await section_within_deadline(i, sec, user_prompt, structure["bpm"], use_cache, limiter)
+        release_late(late, use_cache)
+        if progress: progress("section", index=i)
+        return patterns
+    
+    patterns = await asyncio.gather(*(compose(i, sec) for i, sec in enumerate(sections)))
+    return dict(structure, prompt=user_prompt, patterns=list(patterns))
+
+def variant_rngs(seed, index, count):
+    # take 0 keeps the prompt's own fallback, like a plain generation; the others get one rng each
+    return [None] + [np.random.default_rng([seed, index, k]) for k in range(1, count)]
+
+async def compose_variations(user_prompt, count, concurrency=LLM_CONCURRENCY, use_cache=True, progress=None, seed=None):
+    """One structure, `count` pattern sets per section: returns `count` songs sharing the layout."""
+    if seed is None:
+        seed = new_seed()
+    structure = await structure_within_deadline(user_prompt, use_cache)
+    sections = structure["sections"]
+    if progress: progress("structure", sections=sections)
+    
+    limiter = asyncio.Semaphore(max(1, concurrency))
+    
+    async def compose(i, sec):
+        async def variants():
+            async with limiter:
+                logger.info(f"Composing Section {i+1}: {sec.get('name')} x{count}...")
+                return await compose_section_variants(sec, user_prompt, structure["bpm"], count, use_cache, variant_rngs(seed, i, count))
+        
+        def fallback():
+            return [procedural_patterns(sec, user_prompt, rng) for rng in variant_rngs(seed, i, count)]
+        
+        result, late = await within_deadline(variants(), SECTION_DEADLINE, fallback, "section")
+        release_late(late, use_cache)
+        if progress: progress("section", index=i)
+        return result
+    
+    per_section = await asyncio.gather(*(compose(i, sec) for i, sec in enumerate(sections)))
+    return [dict(structure, prompt=user_prompt, patterns=[variants[v] for variants in per_section]) for v in range(count)]
+
+def procedural_song(user_prompt):
+    structure = procedural_structure(user_prompt)
+    return dict(structure, sections=[dict(sec, patterns=procedural_patterns(sec, user_prompt)) for sec in structure["sections"]])
+
+async def compose_song_single(user_prompt, concurrency=LLM_CONCURRENCY, use_cache=True, progress=None):
+    async def compose_all():
+        with span("structure", mode="single"):
+            prompt = SONG_REQUEST.format(vibe=user_prompt, key="Random")
+            return await get_json(prompt, use_cache=use_cache, kind="song", system=SONG_PROMPT)
+    
+    data, late = await within_deadline(compose_all(), SONG_DEADLINE, lambda: procedural_song(user_prompt), "song")
+    release_late(late, use_cache)
+    structure = build_structure(data, user_prompt)
+    bpm = structure["bpm"]
+    sections = structure["sections"]
+    answers = [sec.pop("patterns", None) for sec in sections]
+    if progress: progress("structure", sections=sections)
+    
+    limiter = asyncio.Semaphore(max(1, concurrency))
+    
+    async def compose(i, sec, patterns):
+        if isinstance(patterns, dict) and patterns:
+            patterns = await complete_patterns(sec, user_prompt, bpm, patterns, REQUIRED_KEYS, use_cache)
+            await record_patterns(sec, user_prompt, bpm, patterns)
+            logger.info(f"  > {sec.get('name')}: {patterns.get('analysis', 'No analysis provided.')}")
+        else:
+            # sections the answer left without streams (or a failed call) get their own pattern call
+            patterns, section_late = await section_within_deadline(i, sec, user_prompt, bpm, use_cache, limiter)
+            release_late(section_late, use_cache)
+        if progress: progress("section", index=i)
+        return patterns
+    
+    patterns = await asyncio.gather(*(compose(i, sec, answer) for i, (sec, answer) in enumerate(zip(sections, answers))))
+    return dict(structure, prompt=user_prompt, patterns=list(patterns))
+
+def song_sections(song):
+    return [
+        dict(sec, groove=str(patterns.get("groove", "straight")).lower(), patterns=patterns)
+        for sec, patterns in zip(song["sections"], song["patterns"])
+    ]
+
+def song_from_music(music):
+    # rebuilds the render input from a previous response's sections (which carry their patterns)
+    sections = [dict(sec) for sec in music.get("sections", [])]
+    start_bar = 0
+    for sec in sections:
+        sec.setdefault("start_bar", start_bar)
+        start_bar = sec["start_bar"] + sec.get("length", 2)
+    return {
+        "bpm": music.get("bpm", 90),
+        "sections": [{k: v for k, v in sec.items() if k not in ("patterns", "groove")} for sec in sections],
+        "patterns": [sec.get("patterns") or {"groove": sec.get("groove", "straight")} for sec in sections],
+        "prompt": music.get("prompt", ""),
     }
+
+def render_song(song, seed, track_ids=TRACK_IDS):
+    final_json = {"bpm": song["bpm"], "tracks": TRACKS, "clips": {}, "arrangement": [], "prompt": song["prompt"], "seed": seed, "sections": song_sections(song)}
     
-    curr_bar = 0
+    for i, (sec, patterns) in enumerate(zip(song["sections"], song["patterns"])):
+        section_clips = render_section_clips(sec, patterns, track_ids, section_rngs(seed, i))
+        clips, arrangement = build_section_entries(i, sec, sec["start_bar"], section_clips, track_ids)
+        final_json["clips"].update(clips)
+        final_json["arrangement"].extend(arrangement)
+        
+    return final_json
+
+def render_song_compact(song, seed, track_ids=TRACK_IDS):
+    table = PatternTable()
+    final_json = {"format": "compact", "bpm": song["bpm"], "tracks": TRACKS, "patterns": table.patterns, "arrangement": [], "prompt": song["prompt"], "seed": seed, "sections": song_sections(song)}
     
-    for i, sec in enumerate(sections):
-        print(f"Composing Section {i+1}: {sec.get('name')}...")
-        section_clips = generate_section_clips(sec, user_prompt, bpm, track_ids)
+    for i, (sec, patterns) in enumerate(zip(song["sections"], song["patterns"])):
+        section_instances = render_section_compact(sec, patterns, track_ids, table, section_rngs(seed, i))
+        instances, arrangement = build_section_entries(i, sec, sec["start_bar"], section_instances, track_ids)
+        for entry in arrangement:
+            entry["instances"] = instances[entry["clip_id"]]
+        final_json["arrangement"].extend(arrangement)
         
-        for instr_name, events in section_clips.items():
-            if not events: continue
-            
-            unique_id = f"s{i}_{sec.get('name')}_{instr_name}".replace(" ", "_")
-            
-            final_json["clips"][unique_id] = events
-            final_json["arrangement"].append({
-                "section": sec.get("name"),
-                "start_bar": curr_bar,
-                "track_id": track_ids[instr_name],
-                "clip_id": unique_id
-            })
-            
-        curr_bar += sec.get("length", 2)
+    return final_json
+
+def render_music(song, seed, output_format="standard"):
+    if output_format == "compact":
+        return render_song_compact(song, seed)
+    return render_song(song, seed)
+
+def replay_music(music, seed=None, output_format="standard"):
+    seed = music.get("seed") if seed is None else seed
+    if seed is None:
+        raise ValueError("A seed is required to replay a song")
+    if not any(sec.get("patterns") for sec in music.get("sections", [])):
+        raise ValueError("Sections carry no patterns to replay")
+    return render_music(song_from_music(music), seed, output_format)
+
+def needs_replay(music):
+    return "clips" not in music and music.get("format") != "compact" and "seed" in music
+
+async def generate_music_json(user_prompt: str, concurrency=LLM_CONCURRENCY, use_cache=True, output_format="standard", progress=None, seed=None, mode=None):
+    logger.info(f"request: {user_prompt}")
+    seed = new_seed() if seed is None else seed
+    mode = mode or COMPOSE_MODE
+    
+    with span("song", format=output_format, mode=mode):
+        # every request sharing a flight hears its progress, from the start even if it joined late
+        if use_cache:
+            song = await song_flight.do((user_prompt, mode), lambda publish: compose_song(user_prompt, concurrency, use_cache, publish, mode), progress)
+        else:
+            song = await compose_song(user_prompt, concurrency, use_cache, progress, mode)
+        
+        return render_music(song, seed, output_format)
+
+
+def variation_seeds(seed, count):
+    # consecutive seeds: variation 0 replays exactly like a plain generation with `seed`
+    if seed is None:
+        return [new_seed() for _ in range(count)]
+    return [(seed + v) % 2 ** 32 for v in range(count)]
+
+async def generate_variations(user_prompt: str, count=4, concurrency=LLM_CONCURRENCY, use_cache=True, output_format="standard", seed=None):
+    if not 1 <= count <= MAX_VARIATIONS:
+        raise ValueError(f"count must be between 1 and {MAX_VARIATIONS}")
+    logger.info(f"request ({count} variations): {user_prompt}")
+    
+    seeds = variation_seeds(seed, count)
+    with span("song", format=output_format, mode="variations", variations=count):
+        if use_cache:
+            songs = await song_flight.do((user_prompt, "variations", count, seed), lambda publish: compose_variations(user_prompt, count, concurrency, use_cache, publish, seed=seeds[0]))
+        else:
+            songs = await compose_variations(user_prompt, count, concurrency, use_cache, seed=seeds[0])
         
-    return final_json
\ No newline at end of file
+        # all variants in one go once every section has its takes; they share tracks and layout
+        with span("render_variations", variations=count):
+            return [render_music(song, s, output_format) for song, s in zip(songs, seeds)]
+
+def find_section(sections, section):
+    if isinstance(section, int):
+        return section if 0 <= section < len(sections) else None
+    for i, sec in enumerate(sections):
+        if sec.get("name") == section:
+            return i
+    return None
+
+async def compose_instrument_patterns(section_data, vibe, bpm, instruments, groove):
+    keys = []
+    for clip_name in instruments:
+        instr = PATTERN_PREFIXES[clip_name]
+        keys.extend([f"{instr}_main", f"{instr}_fill"])
+    
+    prompt = PATCH_PROMPT.format(
+        section=section_data.get("name", "Section"),
+        vibe=vibe,
+        bpm=bpm,
+        energy=section_data.get("energy", "Medium"),
+        chords=str(section_data.get("chords", [])),
+        groove=groove,
+        keys=pattern_key_lines(keys)
+    )
+    patterns = await get_json(prompt, use_cache=False, kind="patch")
+    required = [f"{PATTERN_PREFIXES[name]}_main" for name in instruments]
+    patterns = await complete_patterns(section_data, vibe, bpm, patterns, required, use_cache=False)
+    
+    logger.info(f"  > Patch ({', '.join(instruments)}): {patterns.get('analysis', 'No analysis provided.')}")
+    return dict(patterns, groove=groove)
+
+async def regenerate_section(music, section, instruments=None, prompt=None):
+    music = expand_compact(music)
+    sections = [dict(sec) for sec in music.get("sections", [])]
+    index = find_section(sections, section)
+    if index is None:
+        raise ValueError(f"Unknown section: {section}")
+    
+    unknown = [name for name in instruments or [] if name not in PATTERN_PREFIXES]
+    if unknown:
+        raise ValueError(f"Unknown instruments: {', '.join(unknown)}")
+    
+    sec = sections[index]
+    sec.setdefault("start_bar", sum(s.get("length", 2) for s in sections[:index]))
+    vibe = prompt or music.get("prompt", "")
+    bpm = music.get("bpm", 90)
+    
+    if instruments:
+        # the instruments left alone must replay from stored streams, or the section can't be reproduced
+        stored = sec.get("patterns") or {}
+        missing = [
+            name for name, instr in PATTERN_PREFIXES.items()
+            if name not in instruments and not (stored.get(f"{instr}_main") or stored.get(instr))
+        ]
+        if missing:
+            raise ValueError(f"Section {sec.get('name', index)} has no stored patterns for {', '.join(missing)}; regenerate the whole section instead")
+        patterns = await compose_instrument_patterns(sec, vibe, bpm, instruments, sec.get("groove", "straight"))
+        # keep the stored patterns replayable: only the regenerated instruments' grids are replaced
+        names = tuple(PATTERN_PREFIXES[name] for name in instruments)
+        updates = {key: value for key, value in patterns.items() if key in names or key.startswith(tuple(f"{n}_" for n in names))}
+        sec["patterns"] = dict(sec.get("patterns") or {}, groove=sec.get("groove", "straight"), **updates)
+    else:
+        instruments = list(PATTERN_PREFIXES)
+        patterns = await compose_section_patterns(sec, vibe, bpm, use_cache=False)
+        sec["groove"] = str(patterns.get("groove", "straight")).lower()
+        sec["patterns"] = patterns
+    
+    section_clips = render_section_clips(sec, sec["patterns"], TRACK_IDS, section_rngs(music.get("seed"), index))
+    section_clips = {name: events for name, events in section_clips.items() if name in instruments}
+    new_clips, new_entries = build_section_entries(index, sec, sec["start_bar"], section_clips)
+    
+    replaced = {section_clip_id(index, sec, name) for name in instruments}
+    clips = {clip_id: events for clip_id, events in music.get("clips", {}).items() if clip_id not in replaced}
+    clips.update(new_clips)
+    arrangement = [item for item in music.get("arrangement", []) if item.get("clip_id") not in replaced]
+    arrangement.extend(new_entries)
+    
+    return dict(music, clips=clips, arrangement=arrangement, sections=sections, regenerated=sorted(new_clips))
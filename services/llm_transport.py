@@ -0,0 +1,222 @@
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from email.utils import parsedate_to_datetime
+from services.telemetry import logger, LLM_RETRIES, LLM_HEDGES
+
+# retryable causes; anything else (bad request, auth, unknown model) fails on the first attempt
+RETRYABLE = ("timeout", "connection", "rate_limit", "server")
+LATENCY_WINDOW = 200
+
+def classify(error):
+    """Return (cause, retryable, retry_after seconds or None) for an exception from the client."""
+    status = getattr(error, "status_code", None)
+    name = type(error).__name__
+    if status is None:
+        if "Timeout" in name or isinstance(error, asyncio.TimeoutError):
+            return "timeout", True, None
+        if "Connection" in name:
+            return "connection", True, None
+        return "error", False, None
+    retry_after = parse_retry_after(getattr(error, "response", None))
+    if status == 429:
+        return "rate_limit", True, retry_after
+    if status in (408, 409) or status >= 500:
+        return "server", True, retry_after
+    return "status", False, None
+
+def parse_retry_after(response):
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RetryBudget:
+    """Every request earns `ratio` of a retry, up to `reserve`; retries and hedges spend one each."""
+
+    def __init__(self, ratio, reserve):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+
+    def deposit(self):
+        self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def spend(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class LLMTransport:
+    def __init__(self):
+        self.timeout = float(os.getenv("LLM_TIMEOUT", "60"))
+        self.connect_timeout = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+        self.max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+        self.keepalive_connections = int(os.getenv("LLM_KEEPALIVE_CONNECTIONS", "16"))
+        self.max_attempts = max(1, int(os.getenv("LLM_MAX_ATTEMPTS", "3")))
+        self.backoff = float(os.getenv("LLM_BACKOFF", "0.5"))
+        self.backoff_max = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+        self.hedge = os.getenv("LLM_HEDGE", "0") != "0"
+        self.hedge_quantile = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+        self.hedge_min_samples = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+        self.budget = RetryBudget(float(os.getenv("LLM_RETRY_BUDGET", "0.2")), float(os.getenv("LLM_RETRY_RESERVE", "10")))
+        # set by get_client, or directly (tests, benchmarks) to any AsyncOpenAI-shaped client
+        self.client = None
+        self.client_loop = None
+        self.latencies = {}
+        self.counters = {"requests": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "budget_exhausted": 0, "failures": 0}
+
+    def get_client(self):
+        # connections belong to the loop that opened them, so a new loop (asyncio.run per batch) gets a new pool
+        loop = asyncio.get_running_loop()
+        if self.client is None or (self.client_loop is not None and self.client_loop is not loop):
+            self.retire()
+            import httpx
+            from openai import AsyncOpenAI
+
+            timeout = httpx.Timeout(self.timeout, connect=self.connect_timeout)
+            http_client = httpx.AsyncClient(
+                timeout=timeout,
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.keepalive_connections)
+            )
+            self.client = AsyncOpenAI(
+                base_url=os.getenv("LLM_BASE_URL"),
+                api_key=os.getenv("OPENROUTER_API_KEY"),
+                http_client=http_client,
+                timeout=timeout,
+                max_retries=0
+            )
+            self.client_loop = loop
+        return self.client
+
+    def retire(self):
+        """Drop the current client, closing it on the loop that owns its connections if that loop still runs."""
+        client, loop = self.client, self.client_loop
+        self.client = self.client_loop = None
+        if client is None or loop is None:
+            return
+        if loop.is_running() and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(client.close(), loop)
+        else:
+            # a finished asyncio.run can't close its sockets any more; entry points call aclose() before that
+            logger.warning("Dropping an LLM client whose event loop has already finished")
+
+    async def aclose(self):
+        # only clients built here; one set from outside (tests, benchmarks) is its owner's to close
+        client, loop = self.client, self.client_loop
+        if client is None or loop is None:
+            return
+        if loop is not asyncio.get_running_loop():
+            self.retire()
+            return
+        self.client = self.client_loop = None
+        await client.close()
+
+    def hedge_delay(self, key):
+        samples = self.latencies.get(key)
+        if not self.hedge or samples is None or len(samples) < self.hedge_min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[int(self.hedge_quantile * (len(ordered) - 1))]
+
+    async def timed(self, key, kwargs):
+        started = time.perf_counter()
+        resp = await self.get_client().chat.completions.create(**kwargs)
+        self.latencies.setdefault(key, deque(maxlen=LATENCY_WINDOW)).append(time.perf_counter() - started)
+        return resp
+
+    async def attempt(self, key, kwargs):
+        first = asyncio.ensure_future(self.timed(key, kwargs))
+        delay = self.hedge_delay(key)
+        if delay is None:
+            return await first
+
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+            if not self.budget.spend():
+                self.counters["budget_exhausted"] += 1
+                return await first
+
+            # past the usual p95: a duplicate request often lands before the straggler
+            self.counters["hedges"] += 1
+            LLM_HEDGES.inc(kind=key[1], model=key[0], outcome="sent")
+            hedge = asyncio.ensure_future(self.timed(key, kwargs))
+            pending.add(hedge)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.counters["hedge_wins"] += 1
+                            LLM_HEDGES.inc(kind=key[1], model=key[0], outcome="won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def create(self, kind, **kwargs):
+        """chat.completions.create with retries, backoff and optional hedging.
+
+        Raises the last error once attempts, the retry budget or a too-long
+        Retry-After run out; `classify` tells callers what went wrong.
+        """
+        key = (kwargs.get("model"), kind)
+        self.counters["requests"] += 1
+        self.budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                return await self.attempt(key, kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                cause, retryable, retry_after = classify(e)
+                delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** (attempt - 1)))
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                give_up = not retryable or attempt >= self.max_attempts or delay > self.backoff_max
+                if not give_up and not self.budget.spend():
+                    self.counters["budget_exhausted"] += 1
+                    give_up = True
+                if give_up:
+                    self.counters["failures"] += 1
+                    raise
+
+                attempt += 1
+                self.counters["retries"] += 1
+                LLM_RETRIES.inc(kind=kind, model=key[0], cause=cause)
+                logger.warning(f"LLM {kind} call failed ({cause}: {e}), retry {attempt}/{self.max_attempts} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        p95 = {f"{model}/{kind}": round(sorted(samples)[int(0.95 * (len(samples) - 1))], 3)
+               for (model, kind), samples in self.latencies.items() if samples}
+        return dict(self.counters, retry_tokens=round(self.budget.tokens, 2), hedging=self.hedge, p95_seconds=p95)
+
+transport = None
+
+def get_transport():
+    # built on first use: importing the composer (and starting the app) never waits on client setup;
+    # settings come from the environment, which the entry points fill from .env first
+    global transport
+    if transport is None:
+        transport = LLMTransport()
+    return transport
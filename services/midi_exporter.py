@@ -1,84 +1,144 @@
+import io
+import struct
+from operator import itemgetter
 from mido import Message, MidiFile, MidiTrack, MetaMessage, bpm2tempo
+from services.compact_format import expand_compact
+from services.telemetry import span
 
-def save_midi_file(data, filename="static/temp.mid"):
-    mid = MidiFile()
-    bpm = data.get("bpm", 100)
-    
-    track_map = {}
-    main_track = MidiTrack()
-    mid.tracks.append(main_track)
-    main_track.append(MetaMessage('set_tempo', tempo=bpm2tempo(bpm)))
-    
-    channel_pool = [0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12, 13, 14, 15]
-    chan_idx = 0
+CHUNK_SIZE = 64 * 1024
+TICKS_PER_BEAT = 480
+HEADER_SIZE = 14
 
-    for t in data.get("tracks", []):
-        track = MidiTrack()
-        mid.tracks.append(track)
-        track.append(MetaMessage('track_name', name=t["instrument"]))
-        
+CHANNEL_POOL = [0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12, 13, 14, 15]
+
+def tempo_track(bpm):
+    track = MidiTrack()
+    track.append(MetaMessage('set_tempo', tempo=bpm2tempo(bpm)))
+    return track
+
+def track_channels(tracks):
+    """Yield (track, channel, program) in file order; program is None for percussion."""
+    chan_idx = 0
+    for t in tracks:
         name = t["instrument"].lower()
         
         if t["type"] == "percussion":
-            curr_channel = 9
-            program = 0
-        else:
-            curr_channel = channel_pool[chan_idx % len(channel_pool)]
-            chan_idx += 1
+            yield t, 9, None
+            continue
+        
+        curr_channel = CHANNEL_POOL[chan_idx % len(CHANNEL_POOL)]
+        chan_idx += 1
+        
+        if "bass" in name: 
+            if "slap" in name: program = 36
+            elif "synth" in name: program = 38
+            else: program = 33
+        
+        elif "guitar" in name:
+            if "clean" in name: program = 27
+            elif "overdrive" in name: program = 29
+            else: program = 25
+            
+        elif "piano" in name or "keys" in name:
+            program = 4 
             
-            if "bass" in name: 
-                if "slap" in name: program = 36
-                elif "synth" in name: program = 38
-                else: program = 33
+        elif "sax" in name:
+            program = 65
             
-            elif "guitar" in name:
-                if "clean" in name: program = 27
-                elif "overdrive" in name: program = 29
-                else: program = 25
-                
-            elif "piano" in name or "keys" in name:
-                program = 4 
-                
-            elif "sax" in name:
-                program = 65
-                
-            elif "synth" in name:
-                program = 81
-                
-            else: 
-                program = 0
+        elif "synth" in name:
+            program = 81
+            
+        else: 
+            program = 0
+        
+        yield t, curr_channel, program
+
+def instrument_track(t, channel, program):
+    track = MidiTrack()
+    track.append(MetaMessage('track_name', name=t["instrument"]))
+    if program is not None:
+        track.append(Message('program_change', program=program, time=0, channel=channel))
+    return track
+
+def build_midi(data):
+    data = expand_compact(data)
+    mid = MidiFile()
+    mid.tracks.append(tempo_track(data.get("bpm", 100)))
+    
+    track_map = {}
+    for t, channel, program in track_channels(data.get("tracks", [])):
+        track = instrument_track(t, channel, program)
+        mid.tracks.append(track)
+        track_map[t["id"]] = {"track": track, "channel": channel}
 
-            track.append(Message('program_change', program=program, time=0, channel=curr_channel))
+    buckets = schedule_events(data, track_map.keys(), mid.ticks_per_beat)
+    
+    for track_id, info in track_map.items():
+        write_track_events(info["track"], buckets[track_id], info["channel"])
             
-        track_map[t["id"]] = {"track": track, "channel": curr_channel}
+    return mid
 
-    all_events = []
-    ticks_per_beat = mid.ticks_per_beat
+# events are (sort_key, note, velocity) with sort_key = tick * 2 + is_note_on,
+# so a single sort orders by tick and puts note_off before note_on on ties
+def schedule_clip(notes, start_bar, ticks_per_beat, events=None):
+    events = [] if events is None else events
+    section_start_beat = start_bar * 4.0
+    append = events.append
     
-    for item in data.get("arrangement", []):
-        info = track_map.get(item["track_id"])
-        if not info: continue
+    for note in notes:
+        abs_start = int((section_start_beat + float(note["start"])) * ticks_per_beat)
+        abs_dur = max(1, int(float(note["duration"]) * ticks_per_beat))
+        vel = int(note.get("velocity", 90))
+        note_val = max(0, min(127, int(note["note"])))
         
-        notes = data["clips"].get(item["clip_id"], [])
-        section_start_beat = item["start_bar"] * 4.0
-        
-        for note in notes:
-            abs_start = int((section_start_beat + float(note["start"])) * ticks_per_beat)
-            abs_dur = int(float(note["duration"]) * ticks_per_beat)
-            vel = int(note.get("velocity", 90))
-            note_val = max(0, min(127, int(note["note"])))
-            
-            all_events.append({"time": abs_start, "type": "note_on", "note": note_val, "vel": vel, "track": info["track"], "ch": info["channel"]})
-            all_events.append({"time": abs_start + abs_dur, "type": "note_off", "note": note_val, "vel": 0, "track": info["track"], "ch": info["channel"]})
-            
-    for info in track_map.values():
-        tr = info["track"]
-        ch_events = sorted([e for e in all_events if e["track"] == tr], key=lambda x: x["time"])
-        last_time = 0
-        for e in ch_events:
-            delta = max(0, e["time"] - last_time)
-            tr.append(Message(e["type"], note=e["note"], velocity=e["vel"], time=delta, channel=e["ch"]))
-            last_time = e["time"]
-            
-    mid.save(filename)
+        append((abs_start * 2 + 1, note_val, vel))
+        append(((abs_start + abs_dur) * 2, note_val, 0))
+    return events
+
+def schedule_events(data, track_ids, ticks_per_beat):
+    buckets = {track_id: [] for track_id in track_ids}
+    clips = data.get("clips", {})
+    
+    for item in data.get("arrangement", []):
+        bucket = buckets.get(item["track_id"])
+        if bucket is None: continue
+        schedule_clip(clips.get(item["clip_id"], []), item["start_bar"], ticks_per_beat, bucket)
+    
+    for bucket in buckets.values():
+        bucket.sort(key=itemgetter(0))
+    return buckets
+
+def write_track_events(track, events, channel):
+    append = track.append
+    last_time = 0
+    for sort_key, note_val, vel in events:
+        tick = sort_key >> 1
+        msg_type = "note_on" if sort_key & 1 else "note_off"
+        append(Message(msg_type, note=note_val, velocity=vel, time=max(0, tick - last_time), channel=channel))
+        last_time = tick
+
+def encode_track(track, ticks_per_beat=TICKS_PER_BEAT):
+    # one MTrk chunk, exactly as MidiFile.save writes it
+    buffer = io.BytesIO()
+    MidiFile(ticks_per_beat=ticks_per_beat, tracks=[track]).save(file=buffer)
+    return buffer.getvalue()[HEADER_SIZE:]
+
+def encode_header(track_count, ticks_per_beat=TICKS_PER_BEAT):
+    return b"MThd" + struct.pack(">Lhhh", 6, 1, track_count, ticks_per_beat)
+
+def render_midi_bytes(data):
+    with span("export") as fields:
+        buffer = io.BytesIO()
+        build_midi(data).save(file=buffer)
+        fields["bytes"] = buffer.tell()
+        return buffer.getvalue()
+
+def iter_chunks(payload, chunk_size=CHUNK_SIZE):
+    view = memoryview(payload)
+    for start in range(0, len(view), chunk_size):
+        yield bytes(view[start:start + chunk_size])
+
+def save_midi_file(data, filename="static/temp.mid"):
+    with span("export", file=filename):
+        build_midi(data).save(filename)
     return filename
\ No newline at end of file
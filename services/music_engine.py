@@ -1,5 +1,9 @@
-import random
 import re
+import numpy as np
+from functools import lru_cache
+from services.groove_engine import (
+    HUMANIZE_JITTER, get_template, groove_offsets, apply_groove, humanize_velocities
+)
 
 INTERVALS = {
     "maj": [0, 4, 7],
@@ -17,9 +21,45 @@ INTERVALS = {
     "maj9": [0, 4, 7, 11, 14],
     "min9": [0, 3, 7, 10, 14],
     "11": [0, 7, 10, 14, 17],
-    "13": [0, 4, 7, 10, 14, 21]
+    "13": [0, 4, 7, 10, 14, 21],
+    "6": [0, 4, 7, 9],
+    "min6": [0, 3, 7, 9],
+    "add9": [0, 4, 7, 14],
+    "madd9": [0, 3, 7, 14],
+    "7sus4": [0, 5, 7, 10],
+    "minmaj7": [0, 3, 7, 11],
+    "min11": [0, 3, 7, 10, 14, 17]
 }
 
+QUALITY_ALIASES = {
+    "": "maj", "5": "maj", "M": "maj", "maj": "maj", "Maj": "maj", "major": "maj",
+    "m": "min", "min": "min", "minor": "min", "-": "min",
+    "dim": "dim", "o": "dim", "°": "dim",
+    "aug": "aug", "+": "aug",
+    "sus2": "sus2", "sus4": "sus4", "sus": "sus4",
+    "7": "7", "dom7": "7",
+    "maj7": "maj7", "Maj7": "maj7", "M7": "maj7", "ma7": "maj7", "Δ": "maj7", "Δ7": "maj7",
+    "m7": "min7", "min7": "min7", "-7": "min7",
+    "m7b5": "m7b5", "min7b5": "m7b5", "-7b5": "m7b5", "ø": "m7b5", "ø7": "m7b5",
+    "dim7": "dim7", "o7": "dim7", "°7": "dim7",
+    "9": "9", "maj9": "maj9", "Maj9": "maj9", "M9": "maj9", "m9": "min9", "min9": "min9",
+    "11": "11", "m11": "min11", "min11": "min11",
+    "13": "13",
+    "6": "6", "m6": "min6", "min6": "min6",
+    "add9": "add9", "add2": "add9", "madd9": "madd9", "madd2": "madd9",
+    "7sus4": "7sus4", "7sus": "7sus4",
+    "mmaj7": "minmaj7", "mM7": "minmaj7", "minmaj7": "minmaj7", "mMaj7": "minmaj7", "-maj7": "minmaj7",
+    "m(maj7)": "minmaj7", "m(M7)": "minmaj7", "min(maj7)": "minmaj7", "-(maj7)": "minmaj7"
+}
+
+# longest alias first, so "m7b5" wins over "m7" for decorated suffixes like "m7b5(11)"
+QUALITY_PREFIXES = sorted((alias for alias in QUALITY_ALIASES if alias), key=len, reverse=True)
+
+DEGREE_INDEX = {'1': 0, '3': 1, '5': 2, '7': 3, '9': 4}
+
+CHORD_PATTERN = re.compile(r"^([A-G][#b]?)([^/]*)(?:/([A-G][#b]?))?")
+CHORD_CACHE_SIZE = 1024
+
 NOTE_MAP = {'C':0, 'C#':1, 'Db':1, 'D':2, 'D#':3, 'Eb':3, 'E':4, 'F':5, 
             'F#':6, 'Gb':6, 'G':7, 'G#':8, 'Ab':8, 'A':9, 'A#':10, 'Bb':10, 'B':11}
 
@@ -35,182 +75,237 @@ DURATIONS = {
     '16t': 0.5 / 3.0
 }
 
-def parse_complex_chord(chord_name, default_octave=4):
-    chord_name = chord_name.strip()
+TOKEN_PATTERN = re.compile(r'^([A-Za-z0-9_\-\.]+?)(1n|2n|4n|8n|16n|32n|4t|8t|16t)$')
+TOKEN_CACHE_SIZE = 4096
+STREAM_CACHE_SIZE = 4096
+
+BAR_BEATS = 4.0
+
+# (event, duration_beats, velocity, duration_str); unknown tokens advance a 16th
+UNKNOWN_TOKEN = (None, 0.25, 0, None)
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _tokenize(text):
+    match = TOKEN_PATTERN.match(text.strip())
+    if not match:
+        return UNKNOWN_TOKEN
+    
+    event_char = match.group(1)
+    dur_str = match.group(2)
     
-    root_match = re.match(r"^([A-G][#b]?)", chord_name)
-    if not root_match:
-        return [60, 64, 67]
+    velocity = 100
+    if event_char == 'X': velocity = 127
+    elif event_char == 'g': velocity = 50
+    
+    return (event_char, DURATIONS[dur_str], velocity, dur_str)
+
+def tokenize(item):
+    return _tokenize(item if isinstance(item, str) else str(item))
+
+def make_token(event_char, dur_str):
+    return _tokenize(event_char + dur_str)
+
+def compile_stream(stream):
+    if isinstance(stream, tuple):
+        return stream
+    if not isinstance(stream, list):
+        return ()
+    return tuple(tokenize(item) for item in stream)
+
+@lru_cache(maxsize=STREAM_CACHE_SIZE)
+def _stream_notes(tokens):
+    notes = []
+    current_time_beats = 0.0
+    for event_char, duration_beats, velocity, _ in tokens:
+        # a stream is one bar; anything past the barline would land in the next bar
+        if current_time_beats >= BAR_BEATS:
+            break
+        if event_char is not None and event_char not in ('.', 'rest'):
+            notes.append((current_time_beats, min(duration_beats, BAR_BEATS - current_time_beats), event_char, velocity))
+        current_time_beats += duration_beats
+    return tuple(notes)
+
+def stream_notes(stream):
+    return _stream_notes(compile_stream(stream))
+
+def chord_quality(suffix):
+    quality = QUALITY_ALIASES.get(suffix)
+    if quality:
+        return quality
+    for alias in QUALITY_PREFIXES:
+        if suffix.startswith(alias):
+            return QUALITY_ALIASES[alias]
+    return "maj"
+
+@lru_cache(maxsize=CHORD_CACHE_SIZE)
+def parse_chord_symbol(chord_name):
+    match = CHORD_PATTERN.match(chord_name.strip())
+    if not match:
+        return None
     
-    root_str = root_match.group(1)
-    root_val = NOTE_MAP.get(root_str, 0)
+    root_val = NOTE_MAP.get(match.group(1), 0)
+    quality = chord_quality(match.group(2).strip())
+    bass_val = NOTE_MAP.get(match.group(3)) if match.group(3) else None
+    if bass_val == root_val:
+        bass_val = None
     
+    return root_val, quality, bass_val
+
+def chord_root_midi(root_val, default_octave):
     current_octave = default_octave
     if root_val >= 5:
         current_octave -= 1
-        
-    root_midi = root_val + (current_octave + 1) * 12
-    suffix = chord_name[len(root_str):]
-    
-    if suffix == "" or suffix == "5": quality = "maj"
-    elif suffix == "m": quality = "min"
-    elif suffix == "+": quality = "aug"
-    elif "maj9" in suffix: quality = "maj9"
-    elif "min9" in suffix or "m9" in suffix: quality = "min9"
-    elif "maj7" in suffix: quality = "maj7"
-    elif "min7" in suffix or "m7" in suffix: quality = "min7"
-    elif "7" in suffix: quality = "7"
-    elif "9" in suffix: quality = "9"
-    elif "13" in suffix: quality = "13"
-    elif "dim" in suffix: quality = "dim"
-    elif "sus4" in suffix: quality = "sus4"
-    else: quality = "maj"
+    return root_val + (current_octave + 1) * 12
+
+# degree order (1, 3, 5, 7, 9...) with the lowest voice first; a slash bass replaces the low root
+@lru_cache(maxsize=CHORD_CACHE_SIZE)
+def chord_tones(chord_name, default_octave=4):
+    parsed = parse_chord_symbol(chord_name) if isinstance(chord_name, str) else None
+    if parsed is None:
+        return (60, 64, 67)
+    root_val, quality, bass_val = parsed
     
-    intervals = INTERVALS.get(quality, INTERVALS["maj"])
-    notes = [root_midi + i for i in intervals]
+    root_midi = chord_root_midi(root_val, default_octave)
+    upper = tuple(root_midi + i for i in INTERVALS[quality][1:])
     
-    final_notes = []
+    if bass_val is None:
+        return (root_midi - 12,) + upper
+    return (root_midi - 12 + (bass_val - root_val) % 12,) + upper
+
+@lru_cache(maxsize=CHORD_CACHE_SIZE)
+def chord_voicing(chord_name, default_octave=4):
+    tones = chord_tones(chord_name, default_octave)
+    parsed = parse_chord_symbol(chord_name) if isinstance(chord_name, str) else None
+    if parsed is None or parsed[2] is None:
+        return tuple(sorted(tones))
     
-    for i, note in enumerate(notes):
-        if i == 0:
-            final_notes.append(note - 12)
-        elif note > root_midi + 12:
-            final_notes.append(note) 
-        else:
-            final_notes.append(note)
-            
-    return sorted(final_notes)
+    # inversion / slash chord: keep the root in the upper voicing, don't double the bass
+    root_val, _, bass_val = parsed
+    upper = (chord_root_midi(root_val, default_octave),) + tones[1:]
+    return (tones[0],) + tuple(sorted(n for n in upper if (n - bass_val) % 12 != 0))
+
+def parse_complex_chord(chord_name, default_octave=4):
+    return list(chord_voicing(chord_name, default_octave))
+
+@lru_cache(maxsize=256)
+def degree_index(event_char):
+    for ch in event_char:
+        if ch.isdigit():
+            return DEGREE_INDEX.get(ch, 0)
+    return 0
 
 def create_note_event(pitch, start, dur, velocity, track_id):
     return {"note": int(pitch), "start": start, "duration": dur, "velocity": int(velocity), "track_id": track_id}
 
-def get_groove_offset(start_time, groove_type):
-    offset = 0.0
-    jitter = random.uniform(-0.005, 0.005)
-    
-    step_index = int(round(start_time / 0.25))
-    
-    if groove_type == "swing":
-        if step_index % 2 != 0: offset += 0.04
-    elif groove_type == "heavy_swing" or groove_type == "shuffle":
-        if step_index % 2 != 0: offset += 0.08
-    elif groove_type == "drunk":
-        offset += random.uniform(-0.02, 0.02)
-        if step_index % 2 != 0: offset += 0.03
-    elif groove_type == "laid_back":
-        offset += 0.02 
-    elif groove_type == "rushed":
-        offset -= 0.01
-
-    return offset + jitter
+BASS_VELOCITY = (85, 105)
+KEYS_VELOCITY = (80, 95)
+DRUM_VELOCITY = {'X': 120, 'x': 100, 'g': 50}
+
+def humanize_spec(instrument, groove_type):
+    velocity = None
+    if instrument == "bass": velocity = list(BASS_VELOCITY)
+    elif instrument == "piano": velocity = list(KEYS_VELOCITY)
+    jitter = HUMANIZE_JITTER + get_template(groove_type)["random"]
+    return {"jitter": jitter, "velocity": velocity}
+
+def get_groove_offset(start_time, groove_type, humanize=True):
+    return float(groove_offsets([start_time], groove_type, humanize=humanize)[0])
 
 def parse_duration_stream(stream):
-    notes = []
-    current_time_beats = 0.0
-    
-    if not isinstance(stream, list):
-        return notes
-        
-    for item in stream:
-        match = re.match(r'^([A-Za-z0-9_\-\.]+?)(1n|2n|4n|8n|16n|32n|4t|8t|16t)$', str(item).strip())
-        
-        if not match:
-            current_time_beats += 0.25
-            continue
-            
-        event_char = match.group(1)
-        dur_str = match.group(2)
-        duration_beats = DURATIONS[dur_str]
-        
-        if event_char not in ['.', 'rest']:
-            velocity = 100
-            if event_char == 'X': velocity = 127
-            elif event_char == 'g': velocity = 50
-            
-            notes.append({
-                "start_time": current_time_beats,
-                "duration": duration_beats,
-                "event": event_char,
-                "velocity": velocity
-            })
-            
-        current_time_beats += duration_beats
-        
-    return notes
+    return [
+        {"start_time": start, "duration": dur, "event": event_char, "velocity": velocity}
+        for start, dur, event_char, velocity in stream_notes(stream)
+    ]
 
-def parse_drum_grid(stream, track_id, midi_note, groove_type="straight"):
-    events = []
-    parsed_notes = parse_duration_stream(stream)
-    
-    for n in parsed_notes:
-        vel = 90
-        if n["event"] == 'X': vel = 120
-        elif n["event"] == 'x': vel = 100
-        elif n["event"] == 'g': vel = 50
-        
-        timing_offset = get_groove_offset(n["start_time"], groove_type)
-        if groove_type == "drunk" and midi_note == 38:
-            timing_offset += 0.03
-            
-        start_time = n["start_time"] + timing_offset
-        if start_time < 0: start_time = 0
-            
-        events.append(create_note_event(midi_note, start_time, n["duration"] * 0.95, vel, track_id))
-        
-    return events
-
-def parse_harmonic_grid(stream, chord_name, instrument_type, track_id, groove_type="straight"):
-    events = []
-    chord_notes = parse_complex_chord(chord_name, default_octave=3)
-    parsed_notes = parse_duration_stream(stream)
+class ClipColumns:
+    # hit-level columns (one row per trigger) plus a note -> hit index, so chord
+    # tones struck together share one timing and velocity draw
+    def __init__(self):
+        self.hit_start = []
+        self.hit_floor = []
+        self.hit_dur = []
+        self.hit_vel = []
+        self.note_hit = []
+        self.note_pitch = []
+
+    def add_hit(self, floor, start, dur, vel, pitches):
+        hit = len(self.hit_start)
+        self.hit_start.append(floor + start)
+        self.hit_floor.append(floor)
+        self.hit_dur.append(dur)
+        self.hit_vel.append(vel)
+        for pitch in pitches:
+            self.note_hit.append(hit)
+            self.note_pitch.append(pitch)
+
+def drum_columns(bars, midi_note, columns=None):
+    columns = columns or ClipColumns()
+    pitches = (midi_note,)
+    for bar, stream, _ in bars:
+        floor = bar * 4.0
+        for note_start, note_dur, event_char, _ in stream_notes(stream):
+            columns.add_hit(floor, note_start, note_dur, DRUM_VELOCITY.get(event_char, 90), pitches)
+    return columns
+
+def harmonic_columns(bars, instrument_type="bass", columns=None):
+    columns = columns or ClipColumns()
+    for bar, stream, chord_name in bars:
+        floor = bar * 4.0
+        chord_notes = chord_tones(chord_name, default_octave=3)
+        for note_start, note_dur, event_char, _ in stream_notes(stream):
+            if event_char == '-':
+                continue
+                
+            target_idx = degree_index(event_char)
+            if target_idx < len(chord_notes):
+                final_pitch = chord_notes[target_idx]
+            else:
+                final_pitch = chord_notes[0]
+                
+            if instrument_type == "bass":
+                final_pitch -= 12
+                if final_pitch < 36: final_pitch += 12
+                
+            columns.add_hit(floor, note_start, note_dur, 0, (final_pitch,))
+    return columns
+
+def comping_columns(bars, columns=None):
+    columns = columns or ClipColumns()
+    for bar, stream, chord_name in bars:
+        floor = bar * 4.0
+        chord_notes = chord_voicing(chord_name, default_octave=4)
+        for note_start, note_dur, event_char, _ in stream_notes(stream):
+            if event_char in ('x', 'X'):
+                columns.add_hit(floor, note_start, note_dur, 0, chord_notes)
+    return columns
+
+def render_columns(columns, track_id, groove_type="straight", velocity_range=None, rng=None, humanize=True, groove_note=None):
+    if not columns.note_hit:
+        return []
     
-    for n in parsed_notes:
-        if n["event"] == '-':
-            continue
-            
-        target_idx = 0
-        num_match = re.search(r'\d', n["event"])
-        if num_match:
-            val = num_match.group()
-            if val == '1': target_idx = 0
-            elif val == '3': target_idx = 1
-            elif val == '5': target_idx = 2
-            elif val == '7': target_idx = 3
-            elif val == '9': target_idx = 4
-            
-        if target_idx < len(chord_notes):
-            current_note = chord_notes[target_idx]
-        else:
-            current_note = chord_notes[0]
-            
-        final_pitch = current_note
-        if instrument_type == "bass":
-            final_pitch -= 12
-            if final_pitch < 36: final_pitch += 12
-            
-        start_offset = get_groove_offset(n["start_time"], groove_type)
-        final_start = n["start_time"] + start_offset
-        if final_start < 0: final_start = 0
-            
-        current_vel = random.randint(85, 105)
-        
-        events.append(create_note_event(final_pitch, final_start, n["duration"] * 0.95, current_vel, track_id))
-        
-    return events
-
-def parse_chord_comping(stream, chord_name, track_id, groove_type="straight"):
-    events = []
-    chord_notes = parse_complex_chord(chord_name, default_octave=4)
-    parsed_notes = parse_duration_stream(stream)
+    starts = apply_groove(columns.hit_start, groove_type, rng, groove_note, columns.hit_floor, humanize)
+    velocities = humanize_velocities(columns.hit_vel, velocity_range, rng, humanize)
+    durations = np.asarray(columns.hit_dur) * 0.95
     
-    for n in parsed_notes:
-        if n["event"].lower() == 'x':
-            offset = get_groove_offset(n["start_time"], groove_type)
-            final_start = n["start_time"] + offset
-            if final_start < 0: final_start = 0
-            vel = random.randint(80, 95)
-            
-            for note in chord_notes:
-                events.append(create_note_event(note, final_start, n["duration"] * 0.95, vel, track_id))
-                
-    return events
\ No newline at end of file
+    note_hit = np.asarray(columns.note_hit)
+    return [
+        {"note": pitch, "start": start, "duration": dur, "velocity": vel, "track_id": track_id}
+        for pitch, start, dur, vel in zip(
+            columns.note_pitch,
+            starts[note_hit].tolist(),
+            durations[note_hit].tolist(),
+            velocities[note_hit].tolist()
+        )
+    ]
+
+def parse_drum_grid(stream, track_id, midi_note, groove_type="straight", humanize=True, rng=None):
+    columns = drum_columns([(0, stream, None)], midi_note)
+    return render_columns(columns, track_id, groove_type, None, rng, humanize, midi_note)
+
+def parse_harmonic_grid(stream, chord_name, instrument_type, track_id, groove_type="straight", humanize=True, rng=None):
+    columns = harmonic_columns([(0, stream, chord_name)], instrument_type)
+    return render_columns(columns, track_id, groove_type, BASS_VELOCITY, rng, humanize)
+
+def parse_chord_comping(stream, chord_name, track_id, groove_type="straight", humanize=True, rng=None):
+    columns = comping_columns([(0, stream, chord_name)])
+    return render_columns(columns, track_id, groove_type, KEYS_VELOCITY, rng, humanize)
@@ -0,0 +1,186 @@
+import random
+import zlib
+from services.pattern_validator import spell, UNITS
+
+STEP_UNITS = UNITS["16n"]
+
+# 16-step grids per style: drums use x/X/g, bass uses scale degrees, keys use x/X.
+# checked in order, so "trap" is matched before the "rap" of boom bap
+STYLES = {
+    "four_floor": {
+        "keywords": ("house", "techno", "disco", "edm", "dance", "trance", "garage"),
+        "groove": "straight", "bpm": 124,
+        "kick":  "x...x...x...x...",
+        "snare": "....x.......x...",
+        "hihat": "..x...x...x...x.",
+        "bass":  "..1...1...1...5.",
+        "keys":  "...x..x....x..x.",
+        "chords": ["Am7", "Fmaj7", "Cmaj7", "G"],
+    },
+    "trap": {
+        "keywords": ("trap", "drill", "808"),
+        "groove": "straight", "bpm": 140,
+        "kick":  "x......x..x....x",
+        "snare": "........x.......",
+        "hihat": "xxxxxxxxxxxxxxxx",
+        "bass":  "1......1..1.....",
+        "keys":  "x.......x.......",
+        "chords": ["Cm", "Ab", "Fm", "G"],
+    },
+    "boom_bap": {
+        "keywords": ("hip hop", "hip-hop", "hiphop", "boom bap", "lofi", "lo-fi", "chill", "rap"),
+        "groove": "swing", "bpm": 86,
+        "kick":  "x......x..x.....",
+        "snare": "....x.......x...",
+        "hihat": "x.x.x.x.x.x.x.x.",
+        "bass":  "1......1..5.....",
+        "keys":  "x......x....x...",
+        "chords": ["Dm9", "G13", "Cmaj9", "A7"],
+    },
+    "jazz": {
+        "keywords": ("jazz", "bebop", "swing", "neo soul", "neo-soul", "soul", "bossa"),
+        "groove": "heavy_swing", "bpm": 120,
+        "kick":  "x.......x.......",
+        "snare": "..g...g...g...gx",
+        "hihat": "x...x.x.x...x.x.",
+        "bass":  "1...3...5...7...",
+        "keys":  "..x.....x..x....",
+        "chords": ["Dm7", "G7", "Cmaj7", "A7"],
+    },
+    "reggae": {
+        "keywords": ("reggae", "dub", "ska", "dancehall"),
+        "groove": "swing", "bpm": 75,
+        "kick":  "........x.......",
+        "snare": "........x.......",
+        "hihat": "..x...x...x...x.",
+        "bass":  "1...1.5.....3...",
+        "keys":  "..x...x...x...x.",
+        "chords": ["Am", "D", "G", "Em"],
+    },
+    "funk": {
+        "keywords": ("funk", "r&b", "rnb"),
+        "groove": "swing", "bpm": 100,
+        "kick":  "x..x..x...x..x..",
+        "snare": "....x..g.g..x..g",
+        "hihat": "xxxxxxxxxxxxxxxx",
+        "bass":  "1..1..5.1..3.7..",
+        "keys":  "..x.x..x..x.x...",
+        "chords": ["E9", "A9", "E9", "B7"],
+    },
+    "backbeat": {
+        "keywords": ("rock", "pop", "indie", "punk", "country"),
+        "groove": "straight", "bpm": 110,
+        "kick":  "x.......x.x.....",
+        "snare": "....x.......x...",
+        "hihat": "x.x.x.x.x.x.x.x.",
+        "bass":  "1.1.1.1.5.5.5.5.",
+        "keys":  "x...x...x...x...",
+        "chords": ["C", "G", "Am", "F"],
+    },
+}
+DEFAULT_STYLE = "backbeat"
+
+STRUCTURE = [
+    ("Intro", 4, "Low", "Sparse"),
+    ("Verse", 4, "Medium", "Steady"),
+    ("Chorus", 4, "High", "Busy"),
+    ("Outro", 2, "Low", "Sparse"),
+]
+
+def pick_style(vibe):
+    text = str(vibe).lower()
+    for name, style in STYLES.items():
+        if any(keyword in text for keyword in style["keywords"]):
+            return name
+    return DEFAULT_STYLE
+
+def energy_level(energy):
+    text = str(energy).lower()
+    if "low" in text or "sparse" in text or "calm" in text:
+        return "low"
+    if "high" in text or "busy" in text or "peak" in text:
+        return "high"
+    return "medium"
+
+def shape(grid, instr, level):
+    steps = list(grid)
+    if level == "low":
+        if instr == "hihat":
+            steps = [ch if i % 2 == 0 else '.' for i, ch in enumerate(steps)]
+        steps = ['.' if ch == 'g' else ch for ch in steps]
+    elif level == "high":
+        if instr == "hihat":
+            steps = [ch if ch != '.' else 'g' for ch in steps]
+        elif instr == "snare":
+            steps = ['X' if i in (4, 12) and ch == 'x' else ch for i, ch in enumerate(steps)]
+    return "".join(steps)
+
+def vary(grid, instr, rng):
+    steps = list(grid)
+    if instr == "kick" and rng.random() < 0.5:
+        spot = rng.choice((6, 10, 14, 15))
+        if steps[spot] == '.' and steps[spot - 1] == '.': steps[spot] = 'x'
+    elif instr == "snare" and rng.random() < 0.5:
+        spot = rng.choice((7, 9, 15))
+        if steps[spot] == '.': steps[spot] = 'g'
+    elif instr == "keys" and rng.random() < 0.3:
+        hits = [i for i, ch in enumerate(steps) if ch != '.']
+        if hits: steps[hits[0]] = 'X'
+    return "".join(steps)
+
+FILLS = {
+    "kick":  "x...",
+    "snare": "gxxX",
+    "hihat": "X.X.",
+    "bass":  "5.3.",
+    "keys":  "X...",
+}
+
+def fill(grid, instr):
+    return grid[:12] + FILLS[instr]
+
+def grid_to_stream(grid, instr):
+    onsets = [(i, ch) for i, ch in enumerate(grid) if ch != '.']
+    if not onsets:
+        return spell('.', len(grid) * STEP_UNITS)
+
+    stream = spell('.', onsets[0][0] * STEP_UNITS) if onsets[0][0] else []
+    for (start, ch), (end, _) in zip(onsets, onsets[1:] + [(len(grid), None)]):
+        event = f"{ch}_" if instr == "bass" else ch
+        stream.extend(spell(event, (end - start) * STEP_UNITS))
+    return stream
+
+def procedural_patterns(section_data, vibe, rng=None):
+    """Rule-based stand-in for a pattern response, in the same duration-stream notation.
+
+    `rng` picks the variations; variant takes pass their own so they don't all come out the same.
+    """
+    style_name = pick_style(vibe)
+    style = STYLES[style_name]
+    level = energy_level(section_data.get("energy", "Medium"))
+    if rng is None:
+        # same prompt + section always yields the same patterns, so fallbacks stay cacheable and replayable
+        rng = random.Random(zlib.crc32(f"{vibe}|{section_data.get('name', '')}".encode()))
+
+    patterns = {
+        "analysis": f"Procedural {style_name} pattern at {level} energy.",
+        "groove": style["groove"],
+        "source": "procedural",
+    }
+    for instr in FILLS:
+        grid = vary(shape(style[instr], instr, level), instr, rng)
+        patterns[f"{instr}_main"] = grid_to_stream(grid, instr)
+        patterns[f"{instr}_fill"] = grid_to_stream(fill(grid, instr), instr)
+    return patterns
+
+def procedural_structure(vibe):
+    style = STYLES[pick_style(vibe)]
+    chords = style["chords"]
+    return {
+        "bpm": style["bpm"],
+        "sections": [
+            {"name": name, "length": length, "energy": energy, "texture": texture, "chords": chords[:length]}
+            for name, length, energy, texture in STRUCTURE
+        ],
+        "source": "procedural",
+    }
@@ -0,0 +1,190 @@
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from services.music_engine import parse_chord_symbol
+
+LIBRARY_MODE = os.getenv("PATTERN_LIBRARY", "record")
+LIBRARY_PATH = os.getenv("PATTERN_LIBRARY_PATH", "pattern_library.db")
+LIBRARY_THRESHOLD = float(os.getenv("PATTERN_LIBRARY_THRESHOLD", "0.6"))
+LIBRARY_REUSE = float(os.getenv("PATTERN_LIBRARY_REUSE", "0.8"))
+LIBRARY_TOP_K = int(os.getenv("PATTERN_LIBRARY_TOP_K", "3"))
+LIBRARY_ENTRIES = int(os.getenv("PATTERN_LIBRARY_ENTRIES", "20000"))
+
+MODES = ("off", "record", "reuse")
+
+# hashed feature space: small enough to keep the whole index as one dense matrix
+DIMENSIONS = 512
+WORD_PATTERN = re.compile(r"[a-z0-9&]+")
+
+# (prefix, weight): whole words and word pairs carry the vibe, character trigrams
+# catch spelling variants ("lofi" / "lo-fi"), the rest describe the section.
+# Only what a lookup knows before the LLM answers is indexed (no groove), so
+# stored entries and queries share one feature space.
+FEATURE_WEIGHTS = {"w": 1.0, "b": 1.0, "c": 0.3, "e": 1.0, "t": 0.5, "q": 0.7, "bpm": 0.7}
+
+def feature_tokens(vibe, bpm, energy, texture, chords):
+    words = WORD_PATTERN.findall(str(vibe).lower())
+    text = " ".join(words)
+    tokens = [f"w:{word}" for word in words]
+    tokens += [f"b:{a}_{b}" for a, b in zip(words, words[1:])]
+    tokens += [f"c:{text[i:i + 3]}" for i in range(len(text) - 2)]
+    tokens.append(f"e:{str(energy).lower()}")
+    tokens.append(f"t:{str(texture).lower()}")
+    for chord in chords or []:
+        parsed = parse_chord_symbol(str(chord))
+        if parsed:
+            tokens.append(f"q:{parsed[1]}")
+    try:
+        tokens.append(f"bpm:{int(float(bpm)) // 10}")
+    except (TypeError, ValueError):
+        pass
+    return tokens
+
+def vectorize(tokens):
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    for token in tokens:
+        # rows stored before a feature was dropped (groove) may still carry its tokens
+        weight = FEATURE_WEIGHTS.get(token.split(":", 1)[0])
+        if weight:
+            vector[zlib.crc32(token.encode()) % DIMENSIONS] += weight
+    return vector
+
+def section_features(section_data, vibe, bpm):
+    return feature_tokens(
+        vibe, bpm,
+        section_data.get("energy", "Medium"),
+        section_data.get("texture", "Steady"),
+        section_data.get("chords", [])
+    )
+
+class PatternLibrary:
+    def __init__(self, path=LIBRARY_PATH, max_entries=LIBRARY_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = None
+        self.ids = []
+        self.rows = []
+        self.matrix = None
+        self.norms = None
+        self.idf = None
+        self.loaded = False
+        self.counters = {"lookups": 0, "hits": 0, "misses": 0, "stored": 0, "duplicates": 0}
+
+    def _conn(self):
+        if self.db is None and self.path:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS pattern_library ("
+                "id INTEGER PRIMARY KEY, digest TEXT UNIQUE NOT NULL, features TEXT NOT NULL, "
+                "patterns TEXT NOT NULL, created REAL NOT NULL, uses INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.db.commit()
+        return self.db
+
+    def _load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        db = self._conn()
+        if db is None:
+            return
+        for row_id, features in db.execute("SELECT id, features FROM pattern_library ORDER BY id"):
+            self.ids.append(row_id)
+            self.rows.append(vectorize(json.loads(features)))
+
+    def _index(self):
+        # rebuilt lazily after inserts; idf and row norms are fixed until the next rebuild
+        if self.matrix is None and self.rows:
+            self.matrix = np.vstack(self.rows)
+            df = np.count_nonzero(self.matrix, axis=0)
+            self.idf = (np.log((1 + len(self.rows)) / (1 + df)) + 1).astype(np.float32)
+            self.norms = np.sqrt((self.matrix * self.matrix) @ (self.idf * self.idf))
+        return self.matrix
+
+    def add(self, section_data, vibe, bpm, patterns):
+        features = section_features(section_data, vibe, bpm)
+        value = json.dumps(patterns, sort_keys=True)
+        # the same bars may be indexed under several contexts; exact repeats (LLM cache hits) are not
+        digest = hashlib.sha256((value + json.dumps(features)).encode("utf-8")).hexdigest()
+        with self.lock:
+            self._load()
+            db = self._conn()
+            if db is None:
+                return None
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO pattern_library (digest, features, patterns, created) VALUES (?, ?, ?, ?)",
+                (digest, json.dumps(features), value, time.time())
+            )
+            if not cursor.rowcount:
+                self.counters["duplicates"] += 1
+                return None
+
+            self.ids.append(cursor.lastrowid)
+            self.rows.append(vectorize(features))
+            self.matrix = None
+            self.counters["stored"] += 1
+
+            overflow = len(self.ids) - self.max_entries
+            if overflow > 0:
+                # least used first, oldest among equals
+                evicted = [r for r, in db.execute(
+                    "SELECT id FROM pattern_library ORDER BY uses ASC, id ASC LIMIT ?", (overflow,))]
+                db.executemany("DELETE FROM pattern_library WHERE id = ?", [(r,) for r in evicted])
+                evicted = set(evicted)
+                keep = [i for i, row_id in enumerate(self.ids) if row_id not in evicted]
+                self.ids = [self.ids[i] for i in keep]
+                self.rows = [self.rows[i] for i in keep]
+            db.commit()
+            return cursor.lastrowid
+
+    def search(self, section_data, vibe, bpm, top_k=LIBRARY_TOP_K):
+        """Return [(similarity, id)] for the closest stored sections, best first."""
+        query = vectorize(section_features(section_data, vibe, bpm))
+        with self.lock:
+            self._load()
+            matrix = self._index()
+            if matrix is None:
+                return []
+            weighted = query * self.idf * self.idf
+            query_norm = np.sqrt(query @ weighted)
+            if not query_norm:
+                return []
+            scores = (matrix @ weighted) / np.maximum(self.norms * query_norm, 1e-9)
+            best = np.argpartition(scores, -top_k)[-top_k:] if len(scores) > top_k else np.arange(len(scores))
+            best = best[np.argsort(scores[best])[::-1]]
+            return [(float(scores[i]), self.ids[i]) for i in best]
+
+    def find(self, section_data, vibe, bpm, threshold=LIBRARY_THRESHOLD, rng=None):
+        self.counters["lookups"] += 1
+        candidates = [(score, row_id) for score, row_id in self.search(section_data, vibe, bpm) if score >= threshold]
+        if not candidates:
+            self.counters["misses"] += 1
+            return None
+
+        # pick among the close matches so repeated prompts don't always get the same bars
+        score, row_id = candidates[int(rng.integers(len(candidates)))] if rng is not None else candidates[0]
+        with self.lock:
+            db = self._conn()
+            row = db.execute("SELECT patterns FROM pattern_library WHERE id = ?", (row_id,)).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            db.execute("UPDATE pattern_library SET uses = uses + 1 WHERE id = ?", (row_id,))
+            db.commit()
+        self.counters["hits"] += 1
+        return dict(json.loads(row[0]), source="library", library_id=row_id, similarity=round(score, 3))
+
+    def stats(self):
+        with self.lock:
+            self._load()
+            return dict(self.counters, entries=len(self.ids), mode=LIBRARY_MODE,
+                        threshold=LIBRARY_THRESHOLD, reuse_ratio=LIBRARY_REUSE)
+
+pattern_library = PatternLibrary()
@@ -0,0 +1,171 @@
+import re
+from services.music_engine import TOKEN_PATTERN, DURATIONS, BAR_BEATS
+
+# durations in 1/24 beat units, the finest grid shared by straight and triplet values
+GRID_UNITS = 24
+UNITS = {dur: int(round(beats * GRID_UNITS)) for dur, beats in DURATIONS.items()}
+BAR_UNITS = int(BAR_BEATS * GRID_UNITS)
+SNAP_UNITS = UNITS["16n"]
+
+ROLES = {"kick": "drums", "snare": "drums", "hihat": "drums", "bass": "bass", "keys": "keys"}
+REQUIRED_KEYS = ("kick_main", "snare_main", "hihat_main", "bass_main", "keys_main")
+
+# forgiving re-read of tokens the strict tokenizer rejects: "x8", "X 8N", "8n", "rest4n"
+LOOSE_TOKEN = re.compile(r'^([A-Za-z0-9_\-\.]*?)\s*(1|2|4|8|16|32)\s*([nNtT]?)$')
+
+validation_stats = {"streams": 0, "repaired": 0, "failed": 0, "follow_ups": 0}
+
+def _decompositions():
+    # fewest tokens for every length up to a bar, straight values preferred on ties
+    order = ["1n", "2n", "4n", "8n", "16n", "32n", "4t", "8t", "16t"]
+    best = [None] * (BAR_UNITS + 1)
+    best[0] = ()
+    for n in range(1, BAR_UNITS + 1):
+        for dur in order:
+            rest = n - UNITS[dur]
+            if rest >= 0 and best[rest] is not None:
+                if best[n] is None or len(best[rest]) + 1 < len(best[n]):
+                    best[n] = (dur,) + best[rest]
+    return best
+
+DECOMPOSITIONS = _decompositions()
+
+def stream_role(key):
+    return ROLES.get(key.split("_")[0]) if isinstance(key, str) else None
+
+def read_token(item):
+    text = str(item).strip()
+    match = TOKEN_PATTERN.match(text)
+    if match:
+        return match.group(1), match.group(2), False
+
+    match = LOOSE_TOKEN.match(text.replace(" ", ""))
+    if not match:
+        return None, None, False
+    event, value, kind = match.groups()
+    dur = value + (kind.lower() or "n")
+    if dur not in DURATIONS:
+        return None, None, False
+    return event or ".", dur, True
+
+def legal_event(event, role):
+    if event in ('.', 'rest', 'r'):
+        return '.'
+    has_degree = any(ch.isdigit() for ch in event)
+    if role == "drums":
+        if event == '-': return '.'
+        return event if event in ('x', 'X', 'g') else 'x'
+    if role == "keys":
+        if event in ('x', 'X', '-'): return event
+        return 'x' if has_degree else '.'
+    if role == "bass":
+        return event if has_degree or event == '-' else '1_'
+    return event
+
+def spell(event, units):
+    # one token carrying the event, then rests for whatever a single value can't cover
+    durs = DECOMPOSITIONS[units]
+    if not durs:
+        return []
+    return [event + durs[0]] + ['.' + dur for dur in durs[1:]]
+
+def snap(events):
+    # last resort: quantize every onset to the 16th grid and re-spell the gaps
+    snapped = []
+    for start, event in events:
+        grid_start = min(BAR_UNITS, int(round(start / SNAP_UNITS)) * SNAP_UNITS)
+        if snapped and snapped[-1][0] == grid_start:
+            continue
+        snapped.append((grid_start, event))
+
+    stream = []
+    if snapped and snapped[0][0] > 0:
+        stream.extend(spell('.', snapped[0][0]))
+    for (start, event), (end, _) in zip(snapped, snapped[1:] + [(BAR_UNITS, None)]):
+        if end > start:
+            stream.extend(spell(event, end - start))
+    return stream
+
+def repair_stream(stream, role):
+    """Return (stream, issues); stream is None when no safe local repair exists."""
+    issues = []
+    if isinstance(stream, str):
+        stream = stream.replace(",", " ").split()
+        issues.append("split a string into tokens")
+    if not isinstance(stream, list) or not stream:
+        return None, ["missing or empty"]
+
+    events = []
+    position = 0
+    for item in stream:
+        event, dur, loose = read_token(item)
+        if event is None:
+            return None, [f"unreadable token {item!r}"]
+        if loose:
+            issues.append(f"normalized {item!r}")
+
+        fixed = legal_event(event, role)
+        if fixed != event:
+            issues.append(f"{event!r} is not valid on {role}")
+        events.append((position, fixed, dur))
+        position += UNITS[dur]
+
+    if position == BAR_UNITS and not issues:
+        return stream, issues
+
+    onsets = [(start, event) for start, event, _ in events if start < BAR_UNITS]
+    repaired = []
+    if position > BAR_UNITS:
+        issues.append(f"bar is {position / GRID_UNITS:g} beats, truncated to 4")
+        for start, event, dur in events:
+            if start >= BAR_UNITS:
+                break
+            piece = spell(event, min(UNITS[dur], BAR_UNITS - start))
+            if not piece:
+                return snap(onsets), issues + ["snapped to the 16th grid"]
+            repaired.extend(piece)
+        return repaired, issues
+
+    repaired = [event + dur for _, event, dur in events]
+    if position < BAR_UNITS:
+        issues.append(f"bar is {position / GRID_UNITS:g} beats, padded to 4")
+        padding = spell('.', BAR_UNITS - position)
+        if not padding:
+            return snap(onsets), issues + ["snapped to the 16th grid"]
+        repaired.extend(padding)
+    return repaired, issues
+
+def validate_patterns(patterns, required=REQUIRED_KEYS):
+    """Repair every duration stream in place where it is safe.
+
+    Returns (patterns, issues, failing): issues maps keys to what was fixed
+    or dropped, failing lists the required keys that need a new stream from
+    the LLM.
+    """
+    patterns = dict(patterns or {})
+    issues = {}
+    failing = []
+
+    for key in set(patterns) | set(required):
+        role = stream_role(key)
+        if role is None:
+            continue
+        if key not in patterns and key not in required:
+            continue
+
+        validation_stats["streams"] += 1
+        stream, notes = repair_stream(patterns.get(key), role)
+        notes = list(dict.fromkeys(notes))
+        if stream is None:
+            # optional streams (fills) just fall back to their main pattern
+            patterns.pop(key, None)
+            issues[key] = notes
+            if key in required:
+                validation_stats["failed"] += 1
+                failing.append(key)
+        elif notes:
+            validation_stats["repaired"] += 1
+            patterns[key] = stream
+            issues[key] = notes
+
+    return patterns, issues, sorted(failing)
@@ -0,0 +1,298 @@
+import os
+import time
+import uuid
+import threading
+from operator import itemgetter
+from collections import OrderedDict
+from services.compact_format import expand_compact
+from services.midi_exporter import (
+    tempo_track, track_channels, instrument_track, schedule_clip, write_track_events,
+    encode_track, encode_header, TICKS_PER_BEAT
+)
+from services.telemetry import span
+
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+SESSION_LIMIT = int(os.getenv("SESSION_LIMIT", "256"))
+
+NOTE_FIELDS = ("note", "start", "duration", "velocity")
+
+class SessionConflict(Exception):
+    pass
+
+def check_note(note, where):
+    if not isinstance(note, dict):
+        raise ValueError(f"{where}: a note must be an object")
+    for field in NOTE_FIELDS:
+        if field in note and (isinstance(note[field], bool) or not isinstance(note[field], (int, float))):
+            raise ValueError(f"{where}: {field} must be a number")
+    if not 0 <= note.get("note", 0) <= 127:
+        raise ValueError(f"{where}: note must be within 0-127")
+    if not 0 <= note.get("velocity", 0) <= 127:
+        raise ValueError(f"{where}: velocity must be within 0-127")
+    if note.get("start", 0) < 0:
+        raise ValueError(f"{where}: start must not be negative")
+    if note.get("duration", 1) <= 0:
+        raise ValueError(f"{where}: duration must be positive")
+
+def check_new_note(note, where):
+    # a note that is created, not changed, must be complete: export reads every field
+    check_note(note, where)
+    missing = [field for field in NOTE_FIELDS if field not in note]
+    if missing:
+        raise ValueError(f"{where}: note is missing {', '.join(missing)}")
+
+def index_notes(notes):
+    # clips are kept as {note_id: note}; ids come from the client or their original position
+    indexed = {}
+    for i, note in enumerate(notes or []):
+        note_id = str(note.get("id", i))
+        if note_id in indexed:
+            note_id = f"{note_id}#{i}"
+        indexed[note_id] = dict(note, id=note_id)
+    return indexed
+
+class Session:
+    def __init__(self, music):
+        music = expand_compact(music)
+        self.id = uuid.uuid4().hex
+        self.created = time.time()
+        self.touched = self.created
+        self.version = 0
+        self.lock = threading.Lock()
+        self.bpm = music.get("bpm", 100)
+        self.tracks = list(music.get("tracks", []))
+        self.arrangement = [dict(item) for item in music.get("arrangement", [])]
+        self.clips = {clip_id: index_notes(notes) for clip_id, notes in music.get("clips", {}).items()}
+        # everything except the notes is passed through untouched (prompt, seed, sections, ...)
+        self.extra = {key: value for key, value in music.items() if key not in ("bpm", "tracks", "arrangement", "clips", "format", "patterns")}
+        self.clip_versions = dict.fromkeys(self.clips, 0)
+        # (clip_id, start_bar) -> (clip version, scheduled events); track_id -> (key, MTrk chunk)
+        self.clip_events = {}
+        self.track_chunks = {}
+        self.tempo_chunk = None
+
+    def summary(self):
+        return {
+            "session_id": self.id,
+            "version": self.version,
+            "clips": len(self.clips),
+            "notes": sum(len(notes) for notes in self.clips.values()),
+            "expires": self.touched + SESSION_TTL,
+        }
+
+    def music(self):
+        with self.lock:
+            return dict(
+                self.extra,
+                bpm=self.bpm,
+                tracks=self.tracks,
+                clips={clip_id: list(notes.values()) for clip_id, notes in self.clips.items()},
+                arrangement=self.arrangement,
+                session_id=self.id,
+                version=self.version
+            )
+
+    def apply(self, ops, version=None):
+        """Apply a list of note-level operations atomically and bump the version.
+
+        Ops: {"op": "add", "clip", "note"}, {"op": "update", "clip", "id", "changes"},
+        {"op": "remove", "clip", "id"}, {"op": "clip", "clip", "track_id", "start_bar", "notes"},
+        {"op": "remove_clip", "clip"} and {"op": "bpm", "value"}.
+        """
+        if not isinstance(ops, list):
+            raise ValueError("ops must be a list")
+        with self.lock:
+            if version is not None and version != self.version:
+                raise SessionConflict(f"Session is at version {self.version}, patch was made against {version}")
+
+            # edits go to copies of the touched clips, so a bad op leaves the session unchanged
+            clips = {}
+            removed = set()
+            arrangement = None
+            bpm = self.bpm
+            track_ids = {track.get("id") for track in self.tracks}
+
+            def clip(clip_id, where):
+                if clip_id in removed or (clip_id not in clips and clip_id not in self.clips):
+                    raise ValueError(f"{where}: unknown clip {clip_id!r}")
+                if clip_id not in clips:
+                    clips[clip_id] = dict(self.clips[clip_id])
+                return clips[clip_id]
+
+            for i, op in enumerate(ops):
+                where = f"op {i}"
+                kind = op.get("op") if isinstance(op, dict) else None
+                if kind == "add":
+                    notes = clip(op.get("clip"), where)
+                    note = op.get("note")
+                    check_new_note(note, where)
+                    note_id = str(note.get("id", uuid.uuid4().hex[:8]))
+                    if note_id in notes:
+                        raise ValueError(f"{where}: note {note_id!r} already exists")
+                    notes[note_id] = dict(note, id=note_id)
+                elif kind == "update":
+                    notes = clip(op.get("clip"), where)
+                    note_id = str(op.get("id"))
+                    if note_id not in notes:
+                        raise ValueError(f"{where}: unknown note {note_id!r}")
+                    changes = {key: value for key, value in (op.get("changes") or {}).items() if key != "id"}
+                    check_note(changes, where)
+                    notes[note_id] = dict(notes[note_id], **changes)
+                elif kind == "remove":
+                    notes = clip(op.get("clip"), where)
+                    if notes.pop(str(op.get("id")), None) is None:
+                        raise ValueError(f"{where}: unknown note {op.get('id')!r}")
+                elif kind == "clip":
+                    clip_id = op.get("clip")
+                    if not isinstance(clip_id, str) or not op.get("track_id"):
+                        raise ValueError(f"{where}: clip and track_id are required")
+                    if op["track_id"] not in track_ids:
+                        raise ValueError(f"{where}: unknown track {op['track_id']!r}")
+                    for j, note in enumerate(op.get("notes") or []):
+                        check_new_note(note, f"{where} note {j}")
+                    clips[clip_id] = index_notes(op.get("notes"))
+                    removed.discard(clip_id)
+                    arrangement = [item for item in (self.arrangement if arrangement is None else arrangement) if item.get("clip_id") != clip_id]
+                    arrangement.append({
+                        "section": op.get("section", "Full"),
+                        "start_bar": op.get("start_bar", 0),
+                        "track_id": op["track_id"],
+                        "clip_id": clip_id
+                    })
+                elif kind == "remove_clip":
+                    clip(op.get("clip"), where)
+                    clips.pop(op["clip"])
+                    removed.add(op["clip"])
+                    arrangement = [item for item in (self.arrangement if arrangement is None else arrangement) if item.get("clip_id") != op["clip"]]
+                elif kind == "bpm":
+                    value = op.get("value")
+                    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                        raise ValueError(f"{where}: bpm must be a positive number")
+                    bpm = value
+                else:
+                    raise ValueError(f"{where}: unknown op {kind!r}")
+
+            self.version += 1
+            for clip_id in removed:
+                self.clips.pop(clip_id, None)
+                self.clip_versions.pop(clip_id, None)
+            for clip_id, notes in clips.items():
+                self.clips[clip_id] = notes
+                self.clip_versions[clip_id] = self.version
+            if arrangement is not None:
+                self.arrangement = arrangement
+            self.bpm = bpm
+            return self.summary()
+
+    def midi_bytes(self):
+        """Render the session to MIDI, re-encoding only tracks whose clips changed."""
+        with self.lock, span("export", session=self.id) as fields:
+            cached = 0
+            if self.tempo_chunk is None or self.tempo_chunk[0] != self.bpm:
+                self.tempo_chunk = (self.bpm, encode_track(tempo_track(self.bpm)))
+            chunks = [self.tempo_chunk[1]]
+
+            items = {}
+            for item in self.arrangement:
+                items.setdefault(item["track_id"], []).append(item)
+
+            for t, channel, program in track_channels(self.tracks):
+                placed = [
+                    (item["clip_id"], item["start_bar"], self.clip_versions.get(item["clip_id"]))
+                    for item in items.get(t["id"], []) if item["clip_id"] in self.clips
+                ]
+                key = (t["instrument"], channel, program, tuple(placed))
+                hit = self.track_chunks.get(t["id"])
+                if hit is not None and hit[0] == key:
+                    cached += 1
+                    chunks.append(hit[1])
+                    continue
+
+                events = []
+                for clip_id, start_bar, version in placed:
+                    entry = self.clip_events.get((clip_id, start_bar))
+                    if entry is None or entry[0] != version:
+                        entry = (version, schedule_clip(self.clips[clip_id].values(), start_bar, TICKS_PER_BEAT))
+                        self.clip_events[(clip_id, start_bar)] = entry
+                    events.extend(entry[1])
+                events.sort(key=itemgetter(0))
+
+                track = instrument_track(t, channel, program)
+                write_track_events(track, events, channel)
+                chunk = encode_track(track)
+                self.track_chunks[t["id"]] = (key, chunk)
+                chunks.append(chunk)
+
+            # drop schedules of clips that were edited or removed since
+            for clip_key, (version, _) in list(self.clip_events.items()):
+                if self.clip_versions.get(clip_key[0]) != version:
+                    del self.clip_events[clip_key]
+
+            fields["cached_tracks"] = cached
+            fields["encoded_tracks"] = len(chunks) - 1 - cached
+            payload = encode_header(len(chunks)) + b"".join(chunks)
+            fields["bytes"] = len(payload)
+            return payload
+
+class SessionStore:
+    def __init__(self, ttl=SESSION_TTL, max_sessions=SESSION_LIMIT):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"created": 0, "patches": 0, "exports": 0, "expired": 0, "evicted": 0}
+
+    def create(self, music):
+        session = Session(music)
+        with self.lock:
+            self._sweep()
+            self.sessions[session.id] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.counters["evicted"] += 1
+            self.counters["created"] += 1
+        return session
+
+    def get(self, session_id):
+        with self.lock:
+            self._sweep()
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.touched = time.time()
+                self.sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None)
+
+    def patch(self, session_id, ops, version=None):
+        session = self.get(session_id)
+        if session is None:
+            return None
+        summary = session.apply(ops, version)
+        self.counters["patches"] += 1
+        return summary
+
+    def export(self, session_id):
+        session = self.get(session_id)
+        if session is None:
+            return None
+        self.counters["exports"] += 1
+        return session.midi_bytes()
+
+    def _sweep(self):
+        # sessions are kept in least-recently-touched order, so expired ones sit at the front
+        now = time.time()
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if now - session.touched <= self.ttl:
+                break
+            self.sessions.popitem(last=False)
+            self.counters["expired"] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, sessions=len(self.sessions), ttl=self.ttl)
+
+session_store = SessionStore()
@@ -0,0 +1,60 @@
+import asyncio
+
+class Broadcast:
+    """Progress events of one shared call, replayed to every waiter, including those that join late."""
+
+    def __init__(self):
+        self.events = []
+        self.listeners = []
+
+    def __call__(self, event, **data):
+        self.events.append((event, data))
+        for listener in list(self.listeners):
+            listener(event, **data)
+
+    def listen(self, listener):
+        for event, data in self.events:
+            listener(event, **data)
+        self.listeners.append(listener)
+
+class SingleFlight:
+    def __init__(self, progress=False):
+        # with progress, fn is called with a Broadcast and every waiter's progress callback hears it
+        self.progress = progress
+        self.calls = {}
+        self.broadcasts = {}
+        self.counters = {"leaders": 0, "shared": 0}
+
+    async def do(self, key, fn, progress=None):
+        task = self.calls.get(key)
+        if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+            self.counters["shared"] += 1
+            return await self._wait(task, self.broadcasts.get(key), progress)
+
+        broadcast = Broadcast() if self.progress else None
+        task = asyncio.ensure_future(fn(broadcast) if self.progress else fn())
+        self.calls[key] = task
+        if broadcast is not None:
+            self.broadcasts[key] = broadcast
+        self.counters["leaders"] += 1
+
+        def forget(_):
+            if self.calls.get(key) is task:
+                del self.calls[key]
+                self.broadcasts.pop(key, None)
+
+        task.add_done_callback(forget)
+        return await self._wait(task, broadcast, progress)
+
+    async def _wait(self, task, broadcast, progress):
+        if broadcast is None or progress is None:
+            return await asyncio.shield(task)
+        broadcast.listen(progress)
+        try:
+            return await asyncio.shield(task)
+        finally:
+            # a waiter that gave up (cancelled job) stops hearing the flight
+            broadcast.listeners.remove(progress)
+
+    def stats(self):
+        return dict(self.counters, in_flight=len(self.calls))
@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(request_id)s] %(message)s"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class StdoutHandler(logging.StreamHandler):
+    # resolve sys.stdout on every record so redirect_stdout (benchmarks) still captures logs
+    def emit(self, record):
+        self.stream = sys.stdout
+        super().emit(record)
+
+logger = logging.getLogger("beatflow")
+if not logger.handlers:
+    handler = StdoutHandler()
+    handler.addFilter(RequestIdFilter())
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield f"{self.name}{format_labels(list(zip(self.labels, key)))} {value:g}"
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def render(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in values:
+            pairs = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield f"{self.name}_bucket{format_labels(pairs + [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{format_labels(pairs)} {total:g}"
+            yield f"{self.name}_count{format_labels(pairs)} {cumulative}"
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+LLM_SECONDS = registry.register(Histogram(
+    "beatflow_llm_request_seconds", "Wall time of get_json calls, including cache lookups.", ("kind", "model", "cache")))
+LLM_TOKENS = registry.register(Counter(
+    "beatflow_llm_tokens_total", "Tokens reported by the LLM provider.", ("kind", "model", "type")))
+LLM_ERRORS = registry.register(Counter(
+    "beatflow_llm_errors_total", "Failed LLM calls by cause (timeout, connection, rate_limit, server, status, error or parse).", ("kind", "model", "error")))
+LLM_RETRIES = registry.register(Counter(
+    "beatflow_llm_retries_total", "LLM calls retried by the transport, by cause.", ("kind", "model", "cause")))
+LLM_HEDGES = registry.register(Counter(
+    "beatflow_llm_hedges_total", "Hedged duplicate LLM requests sent, and how many of them won.", ("kind", "model", "outcome")))
+STAGE_SECONDS = registry.register(Histogram(
+    "beatflow_stage_seconds", "Wall time of pipeline stages (structure, section, render, export, ...).", ("stage",)))
+FALLBACKS = registry.register(Counter(
+    "beatflow_fallback_total", "Procedural patterns or structures used instead of the LLM.", ("stage", "reason")))
+HTTP_SECONDS = registry.register(Histogram(
+    "beatflow_http_request_seconds", "HTTP request latency until the response starts.", ("method", "route", "status")))
+
+@contextmanager
+def span(name, histogram=STAGE_SECONDS, **fields):
+    """Time a block, record it in `histogram` and log one structured line.
+
+    The yielded dict can be filled in by the block; fields matching the
+    histogram's label names become labels, everything else is only logged.
+    """
+    started = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, stage=name, **fields)
+        details = " ".join(f"{key}={value}" for key, value in fields.items())
+        logger.info(f"span={name} ms={elapsed * 1000:.1f} {details}".rstrip())
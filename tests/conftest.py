@@ -0,0 +1,9 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# like the benchmarks: no cache or library files written by test runs, quiet logs
+os.environ.setdefault("LLM_CACHE", "0")
+os.environ.setdefault("PATTERN_LIBRARY", "off")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
@@ -0,0 +1,41 @@
+import json
+from services.compact_format import PatternTable, instance_notes, expand_compact
+from services.pattern_fallback import procedural_patterns, procedural_structure
+from services.llm_composer import build_structure, render_music
+
+PROMPT = "lofi hip hop"
+
+def procedural_song():
+    structure = build_structure(procedural_structure(PROMPT), PROMPT)
+    patterns = [procedural_patterns(sec, PROMPT) for sec in structure["sections"]]
+    return dict(structure, prompt=PROMPT, patterns=patterns)
+
+def test_variant_notes_replace_or_add_in_time_order():
+    pattern = {"notes": [[42, 0.0, 0.5, 100], [42, 1.0, 0.5, 100]]}
+    variant = [[42, 1.0, 0.5, 120], [42, 0.5, 0.25, 50]]
+    assert instance_notes(pattern, variant) == [[42, 0.0, 0.5, 100], [42, 0.5, 0.25, 50], [42, 1.0, 0.5, 120]]
+    assert instance_notes(pattern) is pattern["notes"]
+
+def test_variant_keeps_only_changed_notes():
+    table = PatternTable()
+    base = [{"note": 42, "start": 0.0, "duration": 0.5, "velocity": 100}]
+    pattern_id = table.add("hat", lambda: base, "t_hat", None)
+    spiced = base + [{"note": 42, "start": 0.5, "duration": 0.25, "velocity": 50}]
+    assert table.variant(pattern_id, ("hat", "spiced"), lambda: spiced) == [[42, 0.5, 0.25, 50]]
+
+def test_spiced_drum_bars_share_one_pattern():
+    song = procedural_song()
+    music = render_music(song, 7, "compact")
+    hats = [item for item in music["arrangement"] if item["track_id"] == "t_hat"]
+    used = {instance[0] for item in hats for instance in item["instances"]}
+    # one pattern per distinct hat grid and groove, however differently each bar was spiced
+    grids = {(json.dumps(p[key]), p["groove"]) for p in song["patterns"] for key in ("hihat_main", "hihat_fill")}
+    assert len(used) == len(grids)
+    assert any(len(instance) == 4 for item in hats for instance in item["instances"])
+
+def test_compact_expands_to_the_same_notes_for_the_same_seed():
+    song = procedural_song()
+    first = expand_compact(render_music(song, 11, "compact"))
+    second = expand_compact(render_music(song, 11, "compact"))
+    assert first["clips"] == second["clips"]
+    assert set(first["clips"]) == set(render_music(song, 11)["clips"])
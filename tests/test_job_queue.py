@@ -0,0 +1,161 @@
+import copy
+import asyncio
+import pytest
+from services import llm_composer
+from services.llm_composer import build_structure
+from services.job_queue import JobManager, QueueFullError
+from services.pattern_fallback import procedural_patterns, procedural_structure
+
+SECTIONS = [{"name": "Intro"}, {"name": "Verse"}]
+
+def runner(seconds=0.0):
+    async def run(prompt, progress=None, **options):
+        progress("structure", sections=SECTIONS)
+        for i in range(len(SECTIONS)):
+            await asyncio.sleep(seconds)
+            progress("section", index=i)
+        return {"prompt": prompt, **options}
+    return run
+
+async def until(condition, timeout=1.0):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.001)
+    await asyncio.wait_for(poll(), timeout)
+
+def test_stop_cancels_running_jobs():
+    async def run():
+        manager = JobManager(workers=1, runner=runner(10))
+        job = manager.submit("lofi")
+        await until(lambda: job.status == "running")
+        await asyncio.wait_for(manager.stop(), 1)
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == "cancelled"
+    assert job.error and job.finished
+
+def test_cancelled_job_leaves_the_worker_running():
+    async def run():
+        manager = JobManager(workers=1, runner=runner(10))
+        first = manager.submit("lofi")
+        await until(lambda: first.status == "running")
+        manager.cancel(first.id)
+        await until(lambda: first.task is None)
+        manager.runner = runner()
+        second = manager.submit("house")
+        await until(lambda: second.status == "done")
+        await manager.stop()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.status == "cancelled" and first.result is None
+    assert second.result == {"prompt": "house"}
+
+def test_job_runs_with_progress():
+    async def run():
+        manager = JobManager(workers=1, runner=runner(0.01))
+        job = manager.submit("lofi", seed=3)
+        assert manager.get(job.id).summary()["status"] == "queued"
+        await until(lambda: job.summary()["progress"]["sections_done"] == 1)
+        progress = copy.deepcopy(job.summary()["progress"])
+        await until(lambda: job.status == "done")
+        await manager.stop()
+        return job, progress
+
+    job, progress = asyncio.run(run())
+    assert progress["sections_total"] == 2
+    assert [sec["status"] for sec in progress["sections"]] == ["done", "composing"]
+    assert job.result == {"prompt": "lofi", "seed": 3}
+    assert job.summary()["progress"]["sections_done"] == 2
+
+def test_full_queue_rejects_jobs_until_one_is_cancelled():
+    async def run():
+        manager = JobManager(workers=1, max_queue=2, runner=runner(10))
+        running = manager.submit("a")
+        await until(lambda: running.status == "running")
+        queued = [manager.submit("b"), manager.submit("c")]
+        with pytest.raises(QueueFullError):
+            manager.submit("d")
+        assert manager.stats()["queued"] == 2
+
+        # cancelled jobs give their slot back at once, not when a worker gets to them
+        for job in queued:
+            assert manager.cancel(job.id).status == "cancelled"
+        assert manager.stats()["queued"] == 0
+        later = [manager.submit("e"), manager.submit("f")]
+        await manager.stop()
+        return queued, later
+
+    queued, later = asyncio.run(run())
+    assert all(job.status == "cancelled" and job.task is None for job in queued)
+    assert all(job.status in ("queued", "cancelled") for job in later)
+
+def test_cancel_after_the_runner_returned_stands():
+    async def run():
+        manager = JobManager(workers=1)
+        replies = []
+
+        async def finish_then_cancel(prompt, progress=None, **options):
+            # runs once the runner has returned, before the worker resumes
+            asyncio.get_running_loop().call_soon(lambda: replies.append(manager.cancel(job.id).summary()["status"]))
+            return "song"
+
+        manager.runner = finish_then_cancel
+        job = manager.submit("lofi")
+        await until(lambda: replies and job.task is None)
+        await manager.stop()
+        return job, replies
+
+    job, replies = asyncio.run(run())
+    assert replies == ["cancelled"]
+    assert job.status == "cancelled"
+    assert job.result is None
+
+def test_finished_jobs_expire_after_the_ttl():
+    async def run():
+        manager = JobManager(workers=1, ttl=60, runner=runner())
+        job = manager.submit("lofi")
+        await until(lambda: job.status == "done")
+        assert manager.get(job.id) is job
+        job.finished -= 61
+        await manager.stop()
+        return manager, job
+
+    manager, job = asyncio.run(run())
+    assert manager.get(job.id) is None
+    assert manager.cancel(job.id) is None
+
+def test_jobs_sharing_a_song_all_report_progress(monkeypatch):
+    async def compose_song(prompt, concurrency, use_cache, progress, mode):
+        structure = build_structure(procedural_structure(prompt), prompt)
+        progress("structure", sections=structure["sections"])
+        patterns = []
+        for i, sec in enumerate(structure["sections"]):
+            await asyncio.sleep(0.01)
+            patterns.append(procedural_patterns(sec, prompt))
+            progress("section", index=i)
+        return dict(structure, prompt=prompt, patterns=patterns)
+
+    monkeypatch.setattr(llm_composer, "compose_song", compose_song)
+
+    async def run():
+        manager = JobManager(workers=2)
+        leader = manager.submit("lofi", seed=1)
+        await until(lambda: leader.summary()["progress"]["sections_done"] == 1)
+        # joins the leader's song after its structure and first section were reported
+        follower = manager.submit("lofi", seed=2)
+        await until(lambda: follower.status == "running")
+        seen = copy.deepcopy(follower.summary()["progress"])
+        await until(lambda: follower.status == "done" and leader.status == "done")
+        await manager.stop()
+        return leader, follower, seen
+
+    shared = llm_composer.song_flight.counters["shared"]
+    leader, follower, seen = asyncio.run(run())
+    assert llm_composer.song_flight.counters["shared"] == shared + 1
+    assert seen["sections_total"] == leader.summary()["progress"]["sections_total"] > 1
+    assert seen["sections_done"] >= 1
+    assert follower.summary()["progress"] == leader.summary()["progress"]
+    assert all(sec["status"] == "done" for sec in follower.sections)
+    assert follower.result["seed"] == 2
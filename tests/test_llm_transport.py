@@ -0,0 +1,170 @@
+import time
+import asyncio
+from types import SimpleNamespace
+from email.utils import format_datetime
+from datetime import datetime, timezone, timedelta
+import pytest
+from services.llm_transport import LLMTransport, RetryBudget, classify, parse_retry_after
+
+class StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+class APITimeoutError(Exception):
+    pass
+
+class APIConnectionError(Exception):
+    pass
+
+class FakeClient:
+    """Plays back one outcome per call: an exception to raise, or (seconds, reply) to return after a wait."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.cancelled = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        seconds, reply = outcome
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return reply
+
+def transport(client, **settings):
+    t = LLMTransport()
+    t.client = client
+    t.backoff = 0.001
+    t.backoff_max = 1.0
+    t.max_attempts = 3
+    t.hedge = False
+    t.budget = RetryBudget(0.2, 10)
+    for name, value in settings.items():
+        setattr(t, name, value)
+    return t
+
+def create(t):
+    return asyncio.run(t.create("patterns", model="m", messages=[]))
+
+def test_classify():
+    assert classify(StatusError(429, {"retry-after": "3"})) == ("rate_limit", True, 3.0)
+    assert classify(StatusError(503)) == ("server", True, None)
+    assert classify(StatusError(408)) == ("server", True, None)
+    assert classify(StatusError(400)) == ("status", False, None)
+    assert classify(StatusError(401)) == ("status", False, None)
+    assert classify(APITimeoutError()) == ("timeout", True, None)
+    assert classify(asyncio.TimeoutError()) == ("timeout", True, None)
+    assert classify(APIConnectionError()) == ("connection", True, None)
+    assert classify(KeyError("choices")) == ("error", False, None)
+
+def test_parse_retry_after():
+    def headers(**values):
+        return SimpleNamespace(headers=values)
+
+    assert parse_retry_after(headers(**{"retry-after": "2"})) == 2.0
+    assert parse_retry_after(headers(**{"retry-after": "-5"})) == 0.0
+    assert parse_retry_after(headers(**{"retry-after-ms": "250", "retry-after": "9"})) == 0.25
+    assert parse_retry_after(headers(**{"retry-after": "soon"})) is None
+    assert parse_retry_after(headers()) is None
+    assert parse_retry_after(None) is None
+
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < parse_retry_after(headers(**{"retry-after": later})) <= 30
+
+def test_retry_budget():
+    budget = RetryBudget(0.5, 2)
+    assert budget.spend() and budget.spend()
+    assert not budget.spend()
+    budget.deposit()
+    assert not budget.spend()
+    budget.deposit()
+    assert budget.spend()
+    for _ in range(10):
+        budget.deposit()
+    assert budget.tokens == 2
+
+def test_retries_transient_errors():
+    client = FakeClient(StatusError(503), APITimeoutError(), (0, "ok"))
+    t = transport(client)
+    assert create(t) == "ok"
+    assert client.calls == 3
+    assert t.counters["retries"] == 2
+
+def test_client_errors_are_not_retried():
+    client = FakeClient(StatusError(400), (0, "ok"))
+    t = transport(client)
+    with pytest.raises(StatusError):
+        create(t)
+    assert client.calls == 1
+    assert t.counters["failures"] == 1
+
+def test_gives_up_after_max_attempts():
+    client = FakeClient(StatusError(503))
+    t = transport(client)
+    with pytest.raises(StatusError):
+        create(t)
+    assert client.calls == 3
+
+def test_retry_after_is_a_floor_on_the_backoff():
+    client = FakeClient(StatusError(429, {"retry-after-ms": "200"}), (0, "ok"))
+    t = transport(client)
+    started = time.perf_counter()
+    assert create(t) == "ok"
+    assert time.perf_counter() - started >= 0.2
+
+def test_retry_after_past_the_backoff_cap_fails_fast():
+    client = FakeClient(StatusError(429, {"retry-after": "120"}), (0, "ok"))
+    t = transport(client)
+    started = time.perf_counter()
+    with pytest.raises(StatusError):
+        create(t)
+    assert client.calls == 1
+    assert time.perf_counter() - started < 1.0
+
+def test_exhausted_budget_stops_retries():
+    client = FakeClient(StatusError(503))
+    t = transport(client, max_attempts=5, budget=RetryBudget(0, 1))
+    with pytest.raises(StatusError):
+        create(t)
+    assert client.calls == 2
+    assert t.counters["budget_exhausted"] == 1
+
+def test_hedge_wins_and_cancels_the_straggler():
+    client = FakeClient((5, "slow"), (0, "fast"))
+    t = transport(client, hedge=True, hedge_min_samples=1)
+    t.latencies[("m", "patterns")] = [0.01]
+
+    async def run():
+        reply = await t.create("patterns", model="m", messages=[])
+        # the cancelled straggler unwinds on the next turn of the loop, not when asyncio.run tears down
+        await asyncio.sleep(0)
+        return reply, client.cancelled
+
+    started = time.perf_counter()
+    assert asyncio.run(run()) == ("fast", 1)
+    assert time.perf_counter() - started < 1.0
+    assert t.counters["hedges"] == 1 and t.counters["hedge_wins"] == 1
+
+def test_no_hedge_without_budget():
+    client = FakeClient((0.05, "first"), (0, "hedge"))
+    t = transport(client, hedge=True, hedge_min_samples=1, budget=RetryBudget(0, 0))
+    t.latencies[("m", "patterns")] = [0.01]
+    assert create(t) == "first"
+    assert client.calls == 1
+    assert t.counters["hedges"] == 0 and t.counters["budget_exhausted"] == 1
+
+def test_no_hedge_before_enough_samples():
+    client = FakeClient((0.05, "first"), (0, "hedge"))
+    t = transport(client, hedge=True, hedge_min_samples=20)
+    t.latencies[("m", "patterns")] = [0.01]
+    assert create(t) == "first"
+    assert client.calls == 1
@@ -0,0 +1,22 @@
+import pytest
+from services.music_engine import parse_chord_symbol
+
+@pytest.mark.parametrize("chord, parsed", [
+    ("C", (0, "maj", None)),
+    ("Am7", (9, "min7", None)),
+    ("F#m7b5", (6, "m7b5", None)),
+    ("Bbmaj9", (10, "maj9", None)),
+    ("Dm7/G", (2, "min7", 7)),
+    ("Cm", (0, "min", None)),
+    ("Cmmaj7", (0, "minmaj7", None)),
+    ("CmM7", (0, "minmaj7", None)),
+    ("CmMaj7", (0, "minmaj7", None)),
+    ("Cm(maj7)", (0, "minmaj7", None)),
+    ("Cm(M7)", (0, "minmaj7", None)),
+    ("Cmin(maj7)", (0, "minmaj7", None)),
+    ("C-(maj7)", (0, "minmaj7", None)),
+    ("C-maj7", (0, "minmaj7", None)),
+    ("Cm(maj7)/G", (0, "minmaj7", 7)),
+])
+def test_parse_chord_symbol(chord, parsed):
+    assert parse_chord_symbol(chord) == parsed
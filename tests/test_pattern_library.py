@@ -0,0 +1,105 @@
+import json
+import asyncio
+import pytest
+from services import llm_composer
+from services.llm_composer import complete_patterns, compose_section_patterns, record_patterns, REQUIRED_KEYS
+from services.pattern_library import PatternLibrary, section_features
+from services.pattern_fallback import procedural_patterns
+
+SECTION = {"name": "Verse", "length": 4, "energy": "Medium", "texture": "Steady", "chords": ["Dm9", "G13", "Cmaj9", "A7"]}
+VIBE = "lofi hip hop"
+
+def llm_answer():
+    return {key: value for key, value in procedural_patterns(SECTION, VIBE).items() if key != "source"}
+
+@pytest.fixture
+def recorded(monkeypatch):
+    added = []
+    monkeypatch.setattr(llm_composer.pattern_library, "add", lambda section, vibe, bpm, patterns: added.append(patterns))
+    return added
+
+def complete(monkeypatch, answer, repair):
+    async def get_json(prompt, **kwargs):
+        return repair
+
+    monkeypatch.setattr(llm_composer, "get_json", get_json)
+    return asyncio.run(complete_patterns(SECTION, VIBE, 86, answer, REQUIRED_KEYS, use_cache=False))
+
+def test_only_validated_answers_are_recorded(monkeypatch, recorded):
+    answer = llm_answer()
+    clean = complete(monkeypatch, dict(answer), {})
+    fixed = complete(monkeypatch, dict(answer, bass_main=["??"]), {"bass_main": answer["bass_main"]})
+    # the follow-up failed too: bass comes from the procedural fallback
+    mixed = complete(monkeypatch, dict(answer, bass_main=["??"]), {})
+
+    assert "source" not in clean and "source" not in fixed
+    assert mixed["source"] == "repaired"
+    for patterns in (clean, fixed, mixed):
+        asyncio.run(record_patterns(SECTION, VIBE, 86, patterns, library="record"))
+    assert recorded == [clean, fixed]
+
+def test_add_and_find(tmp_path):
+    library = PatternLibrary(path=str(tmp_path / "library.db"))
+    answer = dict(llm_answer(), groove="swing")
+    row_id = library.add(SECTION, VIBE, 86, answer)
+    assert library.add(SECTION, VIBE, 86, answer) is None
+    assert library.counters["stored"] == 1 and library.counters["duplicates"] == 1
+
+    # the stored groove isn't a feature the query could match, so the same context scores 1
+    [(score, found)] = library.search(SECTION, VIBE, 86)
+    assert found == row_id and score == pytest.approx(1.0)
+    hit = library.find(SECTION, VIBE, 86)
+    assert hit["source"] == "library" and hit["library_id"] == row_id and hit["similarity"] == 1.0
+    assert hit["kick_main"] == answer["kick_main"]
+
+    # a new instance reads the same file
+    reopened = PatternLibrary(path=str(tmp_path / "library.db"))
+    assert reopened.find(SECTION, VIBE, 86)["library_id"] == row_id
+    assert reopened.db.execute("SELECT uses FROM pattern_library").fetchone() == (2,)
+
+def test_threshold(tmp_path):
+    library = PatternLibrary(path=str(tmp_path / "library.db"))
+    library.add(SECTION, VIBE, 86, llm_answer())
+    other = dict(SECTION, energy="High", texture="Sparse", chords=["C", "G", "Am", "F"])
+    [(score, _)] = library.search(other, "dark techno", 128)
+    assert score < 0.6
+    assert library.find(other, "dark techno", 128, threshold=0.6) is None
+    assert library.find(other, "dark techno", 128, threshold=score) is not None
+    assert library.find(SECTION, "chill lofi hip hop", 86, threshold=0.6) is not None
+    assert library.counters["misses"] == 1 and library.counters["hits"] == 2
+
+def test_rows_with_a_stored_groove_feature_still_match(tmp_path):
+    library = PatternLibrary(path=str(tmp_path / "library.db"))
+    features = section_features(SECTION, VIBE, 86) + ["g:swing"]
+    library._conn().execute(
+        "INSERT INTO pattern_library (digest, features, patterns, created) VALUES ('old', ?, '{}', 0)", (json.dumps(features),)
+    )
+    library.db.commit()
+    [(score, _)] = library.search(SECTION, VIBE, 86)
+    assert score == pytest.approx(1.0)
+
+def test_least_used_entries_are_evicted(tmp_path):
+    library = PatternLibrary(path=str(tmp_path / "library.db"), max_entries=2)
+    ids = [library.add(dict(SECTION, energy=energy), VIBE, 86, llm_answer()) for energy in ("Low", "Medium")]
+    library.find(dict(SECTION, energy="Low"), VIBE, 86)
+    library.add(dict(SECTION, energy="High"), VIBE, 86, llm_answer())
+    assert ids[0] in library.ids and ids[1] not in library.ids
+    assert library.stats()["entries"] == 2
+
+def test_reuse_mode_serves_recorded_sections(tmp_path, monkeypatch):
+    calls = []
+
+    async def get_json(prompt, **kwargs):
+        calls.append(prompt)
+        return llm_answer()
+
+    monkeypatch.setattr(llm_composer, "get_json", get_json)
+    monkeypatch.setattr(llm_composer, "pattern_library", PatternLibrary(path=str(tmp_path / "library.db")))
+    monkeypatch.setattr(llm_composer, "LIBRARY_REUSE", 1.0)
+
+    first = asyncio.run(compose_section_patterns(SECTION, VIBE, 86, library="reuse"))
+    second = asyncio.run(compose_section_patterns(SECTION, VIBE, 86, library="reuse"))
+    fresh = asyncio.run(compose_section_patterns(SECTION, VIBE, 86, use_cache=False, library="reuse"))
+    assert "source" not in first and "source" not in fresh
+    assert second["source"] == "library"
+    assert len(calls) == 2
@@ -0,0 +1,55 @@
+from services.pattern_validator import repair_stream, validate_patterns, REQUIRED_KEYS
+
+VALID = {
+    "kick_main": ["x4n", ".4n", "x4n", ".4n"],
+    "snare_main": [".4n", "x4n", ".4n", "x4n"],
+    "hihat_main": ["x8n"] * 8,
+    "bass_main": ["1_2n", "5_2n"],
+    "keys_main": ["x1n"],
+}
+
+def test_valid_stream_is_left_unchanged():
+    stream = ["x4n", ".8n", "x8n", "x2n"]
+    repaired, issues = repair_stream(stream, "drums")
+    assert repaired is stream
+    assert issues == []
+
+    patterns, issues, failing = validate_patterns(VALID)
+    assert patterns == VALID
+    assert issues == {} and failing == []
+
+def test_over_long_bar_is_truncated():
+    repaired, issues = repair_stream(["x2n", "x4n", "x2n", "x4n"], "drums")
+    # the note that crosses the bar line is cut to what is left of the bar, later ones are dropped
+    assert repaired == ["x2n", "x4n", "x4n"]
+    assert issues == ["bar is 6 beats, truncated to 4"]
+
+def test_short_bar_is_padded_with_rests():
+    repaired, issues = repair_stream(["x4n", "x8n"], "drums")
+    assert repaired == ["x4n", "x8n", ".2n", ".8n"]
+    assert issues == ["bar is 1.5 beats, padded to 4"]
+
+def test_loose_and_illegal_tokens_are_normalized():
+    repaired, issues = repair_stream(["X 8N", "x8n", "rest4n", "5_4n", "x4n"], "drums")
+    assert repaired == ["X8n", "x8n", ".4n", "x4n", "x4n"]
+    assert "normalized 'X 8N'" in issues
+    assert "'5_' is not valid on drums" in issues
+
+    repaired, issues = repair_stream("x2n, x2n", "bass")
+    assert repaired == ["1_2n", "1_2n"]
+    assert issues[0] == "split a string into tokens"
+    assert "'x' is not valid on bass" in issues
+
+def test_unreadable_token_fails_required_streams_and_drops_optional_ones():
+    patterns = dict(VALID, kick_main=["x4n", "boom", "x2n"], hihat_fill=["x4n", "??"])
+    repaired, issues, failing = validate_patterns(patterns)
+
+    assert failing == ["kick_main"]
+    assert "kick_main" not in repaired and "hihat_fill" not in repaired
+    assert issues["kick_main"] == ["unreadable token 'boom'"]
+    assert issues["hihat_fill"] == ["unreadable token '??'"]
+
+def test_missing_required_streams_are_reported():
+    _, issues, failing = validate_patterns({"kick_main": VALID["kick_main"]})
+    assert failing == sorted(set(REQUIRED_KEYS) - {"kick_main"})
+    assert all(issues[key] == ["missing or empty"] for key in failing)
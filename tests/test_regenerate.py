@@ -0,0 +1,43 @@
+import asyncio
+import pytest
+from services import llm_composer
+from services.llm_composer import build_structure, render_music, regenerate_section, replay_music
+from services.pattern_fallback import procedural_patterns, procedural_structure
+
+PROMPT = "lofi hip hop"
+
+def song_music(seed=11):
+    structure = build_structure(procedural_structure(PROMPT), PROMPT)
+    patterns = [procedural_patterns(sec, PROMPT) for sec in structure["sections"]]
+    return render_music(dict(structure, prompt=PROMPT, patterns=patterns), seed)
+
+@pytest.fixture
+def offline(monkeypatch):
+    # a failed patch call: the regenerated instruments fall back to procedural streams
+    async def failed(prompt, **kwargs):
+        return {}
+
+    monkeypatch.setattr(llm_composer, "get_json", failed)
+
+def regenerate(music, instruments):
+    return asyncio.run(regenerate_section(music, 1, instruments))
+
+def test_regenerated_instruments_replay(offline):
+    music = regenerate(song_music(), ["bass"])
+    assert music["regenerated"]
+    replayed = replay_music(music)
+    assert replayed["clips"] == music["clips"]
+
+def test_instruments_without_stored_patterns_are_refused(offline):
+    music = song_music()
+    patterns = music["sections"][1]["patterns"]
+    music["sections"][1] = dict(music["sections"][1], patterns={key: value for key, value in patterns.items() if not key.startswith("keys_")})
+    with pytest.raises(ValueError, match="no stored patterns for piano"):
+        regenerate(music, ["bass"])
+    # regenerating those instruments too, or the whole section, leaves nothing unreproducible
+    assert regenerate(music, ["bass", "piano"])["regenerated"]
+
+    music["sections"][1].pop("patterns")
+    with pytest.raises(ValueError, match="kick, snare, hat, piano"):
+        regenerate(music, ["bass"])
+    assert regenerate(music, None)["sections"][1]["patterns"]
@@ -0,0 +1,107 @@
+import pytest
+from services.session_store import Session, SessionStore, SessionConflict
+from services.midi_exporter import render_midi_bytes
+
+def note(note_id, pitch, start, duration=0.5, velocity=90):
+    return {"id": note_id, "note": pitch, "start": start, "duration": duration, "velocity": velocity}
+
+def music():
+    return {
+        "bpm": 96,
+        "tracks": [
+            {"id": "t_piano", "instrument": "Piano", "type": "instrument"},
+            {"id": "t_kick", "instrument": "Kick", "type": "percussion"},
+        ],
+        "clips": {
+            "keys": [note("k1", 60, 0.0), note("k2", 64, 1.0)],
+            "kick": [note("d1", 36, 0.0), note("d2", 36, 2.0)],
+        },
+        "arrangement": [
+            {"section": "Verse", "start_bar": 0, "track_id": "t_piano", "clip_id": "keys"},
+            {"section": "Verse", "start_bar": 0, "track_id": "t_kick", "clip_id": "kick"},
+            {"section": "Chorus", "start_bar": 4, "track_id": "t_kick", "clip_id": "kick"},
+        ],
+        "prompt": "test",
+    }
+
+def notes(session, clip_id):
+    return session.music()["clips"][clip_id]
+
+def test_add_update_remove_notes():
+    session = Session(music())
+    session.apply([
+        {"op": "add", "clip": "keys", "note": note("k3", 67, 2.0)},
+        {"op": "update", "clip": "keys", "id": "k1", "changes": {"velocity": 110, "id": "ignored"}},
+        {"op": "remove", "clip": "keys", "id": "k2"},
+    ])
+    assert notes(session, "keys") == [dict(note("k1", 60, 0.0), velocity=110), note("k3", 67, 2.0)]
+    assert session.version == 1
+
+def test_clip_ops_and_bpm():
+    session = Session(music())
+    session.apply([
+        {"op": "clip", "clip": "bass", "track_id": "t_piano", "start_bar": 2, "notes": [note("b1", 40, 0.0, 2.0)]},
+        {"op": "remove_clip", "clip": "kick"},
+        {"op": "bpm", "value": 120},
+    ])
+    data = session.music()
+    assert data["bpm"] == 120
+    assert set(data["clips"]) == {"keys", "bass"}
+    assert [(item["clip_id"], item["start_bar"]) for item in data["arrangement"]] == [("keys", 0), ("bass", 2)]
+    assert data["prompt"] == "test"
+
+def test_bad_op_leaves_the_session_unchanged():
+    session = Session(music())
+    before = session.music()
+    with pytest.raises(ValueError, match="op 1: unknown note 'nope'"):
+        session.apply([
+            {"op": "add", "clip": "keys", "note": note("k3", 67, 2.0)},
+            {"op": "remove", "clip": "keys", "id": "nope"},
+        ])
+    assert session.music() == before
+    with pytest.raises(ValueError, match="velocity must be within 0-127"):
+        session.apply([{"op": "update", "clip": "keys", "id": "k1", "changes": {"velocity": 200}}])
+
+def test_stale_version_is_a_conflict():
+    store = SessionStore()
+    session = store.create(music())
+    store.patch(session.id, [{"op": "bpm", "value": 100}], version=0)
+    with pytest.raises(SessionConflict):
+        store.patch(session.id, [{"op": "bpm", "value": 110}], version=0)
+    assert session.music()["bpm"] == 100
+    assert store.patch(session.id, [{"op": "bpm", "value": 110}], version=1)["version"] == 2
+
+def test_export_after_patches_matches_a_full_render():
+    store = SessionStore()
+    session = store.create(music())
+    assert store.export(session.id) == render_midi_bytes(session.music())
+
+    patches = [
+        [{"op": "add", "clip": "kick", "note": note("d3", 36, 3.0)}],
+        [{"op": "update", "clip": "keys", "id": "k2", "changes": {"start": 1.5}}],
+        [{"op": "bpm", "value": 140}],
+        [{"op": "remove_clip", "clip": "keys"}],
+        [{"op": "clip", "clip": "keys", "track_id": "t_piano", "start_bar": 1, "notes": [note("k9", 72, 0.0)]}],
+    ]
+    for ops in patches:
+        store.patch(session.id, ops)
+        assert store.export(session.id) == render_midi_bytes(session.music())
+
+def test_export_reuses_unchanged_tracks():
+    session = Session(music())
+    session.midi_bytes()
+    kick_chunk = session.track_chunks["t_kick"]
+    session.apply([{"op": "update", "clip": "keys", "id": "k1", "changes": {"note": 62}}])
+    session.midi_bytes()
+    assert session.track_chunks["t_kick"] is kick_chunk
+    assert session.clip_events[("keys", 0)][0] == session.version
+
+def test_clip_op_rejects_incomplete_notes_and_unknown_tracks():
+    store = SessionStore()
+    session = store.create(music())
+    with pytest.raises(ValueError, match="op 0 note 0: note is missing start, duration, velocity"):
+        store.patch(session.id, [{"op": "clip", "clip": "c2", "track_id": "t_piano", "notes": [{"note": 62}]}])
+    with pytest.raises(ValueError, match="op 0: unknown track 't_strings'"):
+        store.patch(session.id, [{"op": "clip", "clip": "c2", "track_id": "t_strings", "notes": [note("s1", 62, 0.0)]}])
+    assert session.version == 0 and "c2" not in session.music()["clips"]
+    assert store.export(session.id) == render_midi_bytes(session.music())
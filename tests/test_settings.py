@@ -0,0 +1,41 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def app_settings(tmp_path, dotenv, expression, imports=""):
+    """Import main.py from a copy of the app next to `dotenv` and evaluate `expression` there."""
+    shutil.copy(os.path.join(REPO, "main.py"), tmp_path)
+    shutil.copytree(os.path.join(REPO, "services"), tmp_path / "services", ignore=shutil.ignore_patterns("__pycache__"))
+    (tmp_path / ".env").write_text("".join(f"{key}={value}\n" for key, value in dotenv.items()))
+    env = {key: value for key, value in os.environ.items() if key not in dotenv}
+    result = subprocess.run(
+        [sys.executable, "-c", f"import json, main\n{imports}\nprint(json.dumps({expression}))"],
+        cwd=tmp_path, env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_pattern_library_settings_come_from_dotenv(tmp_path):
+    settings = app_settings(
+        tmp_path,
+        {"PATTERN_LIBRARY": "reuse", "PATTERN_LIBRARY_THRESHOLD": "0.4", "PATTERN_LIBRARY_PATH": "library.db"},
+        "[main.pattern_library.stats()['mode'], main.pattern_library.stats()['threshold'], main.pattern_library.path]"
+    )
+    assert settings == ["reuse", 0.4, "library.db"]
+
+def test_log_level_comes_from_dotenv(tmp_path):
+    level = app_settings(tmp_path, {"LOG_LEVEL": "ERROR"}, "main.logger.getEffectiveLevel()")
+    assert level == logging.ERROR
+
+def test_groove_templates_path_comes_from_dotenv(tmp_path):
+    (tmp_path / "grooves.json").write_text(json.dumps({"my_swing": {"mpc_swing": 60, "offset": 0.01}}))
+    groove = app_settings(
+        tmp_path, {"GROOVE_TEMPLATES_PATH": "grooves.json"},
+        "GROOVE_TEMPLATES.get('my_swing', {}).get('offset')",
+        imports="from services.groove_engine import GROOVE_TEMPLATES"
+    )
+    assert groove == 0.01
@@ -0,0 +1,41 @@
+import asyncio
+import pytest
+from services import llm_composer
+from services.llm_composer import compose_variations, build_structure
+from services.pattern_fallback import procedural_patterns, procedural_structure
+
+PROMPT = "lofi hip hop"
+
+@pytest.fixture
+def offline(monkeypatch):
+    async def structure(user_prompt, use_cache):
+        return build_structure(procedural_structure(user_prompt), user_prompt)
+
+    async def failed_answers(prompt, n, **kwargs):
+        return [{} for _ in range(n)]
+
+    monkeypatch.setattr(llm_composer, "structure_within_deadline", structure)
+    monkeypatch.setattr(llm_composer, "get_json_variants", failed_answers)
+    return monkeypatch
+
+def compose(count, seed):
+    return asyncio.run(compose_variations(PROMPT, count, use_cache=False, seed=seed))
+
+def check_takes(songs):
+    takes = [song["patterns"] for song in songs]
+    assert all(a != b for i, a in enumerate(takes) for b in takes[i + 1:])
+    # the first take is what a plain generation would fall back to
+    assert takes[0] == [procedural_patterns(sec, PROMPT) for sec in songs[0]["sections"]]
+
+def test_failed_answers_give_different_procedural_takes(offline):
+    songs = compose(4, 7)
+    check_takes(songs)
+    assert [song["patterns"] for song in compose(4, 7)] == [song["patterns"] for song in songs]
+
+def test_section_deadline_gives_different_procedural_takes(offline):
+    async def slow_answers(prompt, n, **kwargs):
+        await asyncio.sleep(5)
+
+    offline.setattr(llm_composer, "get_json_variants", slow_answers)
+    offline.setattr(llm_composer, "SECTION_DEADLINE", 0.01)
+    check_takes(compose(4, 7))